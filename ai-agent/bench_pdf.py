@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+from pathlib import Path
+
+import fitz
+
+from object.LoadPDF import PDF_WORKERS, parse_pdf
+
+# =========================== НАСТРОЙКИ ===========================
+# Бенчмарк parse_pdf: python bench_pdf.py [файл.pdf]
+# Без файла генерируется текстовый PDF на PAGES страниц с таблицеподобными блоками.
+# Сравнивается разбор в одном процессе и постраничный параллельный (WORKERS процессов),
+# результаты обязаны совпасть; отдельно — одно извлечение блоков на страницу против двух (text + blocks)
+PDF_PATH = sys.argv[1] if len(sys.argv) > 1 else None
+PAGES = 400
+WORKERS = max(2, PDF_WORKERS)
+GENERATED_PDF = "./bench_pdf.pdf"
+REPEATS = 3
+
+
+def generate_pdf(path, pages):
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        y = 72
+        for k in range(25):
+            page.insert_text((72, y), f"Страница {i}, пункт {k}: сроки поставки и условия оплаты по договору.",
+                             fontname="helv")
+            y += 14
+        # Блок с числами и разделителями — кандидат в таблицы
+        page.insert_textbox(fitz.Rect(72, y + 10, 520, y + 120),
+                            "\n".join(f"Позиция {k} | {k * 12},5 | {k * 3}.75 | ------" for k in range(6)),
+                            fontname="helv")
+    doc.save(path)
+    doc.close()
+
+
+def best_of(fn, *args, **kwargs):
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def extraction_passes(path, single):
+    with fitz.open(path) as doc:
+        for page in doc:
+            if single:
+                page.get_text("blocks")
+            else:
+                page.get_text("text")
+                page.get_text("blocks")
+
+
+# ==============================
+#           MAIN
+# ==============================
+def main():
+    path = PDF_PATH
+    if path is None:
+        path = GENERATED_PDF
+        generate_pdf(path, PAGES)
+    with fitz.open(path) as doc:
+        page_count = doc.page_count
+    print(f"{path}: {page_count} страниц, ядер: {len(os.sched_getaffinity(0))}")
+
+    two, _ = best_of(extraction_passes, path, False)
+    one, _ = best_of(extraction_passes, path, True)
+    print(f"Извлечение text + blocks: {two:.2f} сек, только blocks: {one:.2f} сек (x{two / one:.2f})")
+
+    sequential, expected = best_of(parse_pdf, path, workers=1)
+    # Первый вызов поднимает пул процессов — в замер не входит
+    parse_pdf(path, workers=WORKERS)
+    parallel, result = best_of(parse_pdf, path, workers=WORKERS)
+
+    print(f"parse_pdf в одном процессе: {sequential:.2f} сек ({page_count / sequential:.1f} стр/с)")
+    print(f"parse_pdf, {WORKERS} процессов: {parallel:.2f} сек ({page_count / parallel:.1f} стр/с), "
+          f"ускорение x{sequential / parallel:.2f}")
+    print(f"Результаты совпадают: {result == expected} ({len(result)} блоков)")
+
+    if PDF_PATH is None:
+        Path(GENERATED_PDF).unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    main()
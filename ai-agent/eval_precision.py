@@ -0,0 +1,148 @@
+import csv
+import difflib
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from object.Models import LLM, Reranker, LogicalRelationship
+from object.SystemSearch import SearchSystem
+
+# =========================== НАСТРОЙКИ ===========================
+# Сравнение режима PRECISION с fp32 на фиксированном наборе вопросов (test_file/input.csv).
+# Каждая стадия получает вход, посчитанный в fp32, поэтому ошибки стадий не накапливаются.
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+PRECISION = "int8"
+
+ENCODER_MODEL = "./model/encoder"
+LLM_MODEL = "./model/qwen3-0.6b"
+RERANKER_MODEL = "./model/reranker"
+LR_MODEL = "./model/lr"
+DB_DATA = "./SearchStartData/pre-best-V4.pkl"
+
+QUESTIONS = "test_file/input.csv"
+MAX_QUESTIONS = 50
+TOP_K = 15
+TOP_K_RERANK = 4
+NLI_THRESHOLD = 0.5
+
+
+def load_models(precision):
+    search = SearchSystem(model=ENCODER_MODEL, device=DEVICE, precision=precision)
+    search.load(DB_DATA)
+    return {
+        "search": search,
+        "reranker": Reranker(model=RERANKER_MODEL, device=DEVICE, precision=precision),
+        "lr": LogicalRelationship(model=LR_MODEL, device=DEVICE, precision=precision),
+        "llm": LLM(model=LLM_MODEL, device=DEVICE, precision=precision),
+    }
+
+
+def timed(times, stage, fn, *args, **kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    times[stage] = times.get(stage, 0.0) + time.time() - start
+    return result
+
+
+def candidates(search, hits):
+    result = []
+    for hit in hits:
+        context_chunks = search.get_context_chunks(hit["payload"]["chunkID"], hit["payload"]["source"], 1)
+        result.append({
+            "source": hit["payload"]["source"],
+            "chunkIDs": [ch["chunkID"] for ch in context_chunks],
+            "texts": [ch["text"] for ch in context_chunks],
+        })
+    return result
+
+
+def hit_ids(hits):
+    return [(h["payload"]["source"], h["payload"]["chunkID"]) for h in hits]
+
+
+def build_context(chunks):
+    return "".join("\n".join(ch["texts"]) + "\n\n---\n" for ch in chunks)
+
+
+def run_stages(models, question, reference, times):
+    """
+    reference — выходы fp32 для этого вопроса (None для самого прогона fp32).
+    Возвращает выходы стадий: hits, reranked, nli, answer.
+    """
+    m = models
+    hits = timed(times, "retrieval", m["search"].search_hybrid, question, top_k=TOP_K, alpha=0.8)
+
+    base_hits = reference["hits"] if reference else hits
+    reranked = timed(times, "rerank", m["reranker"].rerank_results,
+                     question, candidates(m["search"], base_hits), TOP_K_RERANK, -1e9)
+
+    base_reranked = reference["reranked"] if reference else reranked
+    texts = [" ".join(ch["texts"]) for ch in base_reranked]
+    nli = [
+        float(timed(times, "nli", m["lr"].check_conflict, texts[i], texts[j]))
+        for i in range(len(texts)) for j in range(i + 1, len(texts))
+    ]
+
+    answer = timed(times, "answer", m["llm"].generate_answer, [], question, build_context(base_reranked))
+    return {"hits": hits, "reranked": reranked, "nli": nli, "answer": answer}
+
+
+def compare(ref, out):
+    ref_ids, out_ids = set(hit_ids(ref["hits"])), set(hit_ids(out["hits"]))
+    ref_scores = {(r["source"], tuple(r["chunkIDs"])): r["score"] for r in ref["reranked"]}
+    out_scores = {(r["source"], tuple(r["chunkIDs"])): r["score"] for r in out["reranked"]}
+    shared = ref_scores.keys() & out_scores.keys()
+
+    nli_ref, nli_out = np.array(ref["nli"]), np.array(out["nli"])
+    return {
+        "retrieval_overlap": len(ref_ids & out_ids) / len(ref_ids) if ref_ids else 1.0,
+        "rerank_overlap": len(shared) / len(ref_scores) if ref_scores else 1.0,
+        "rerank_top1": float(bool(ref["reranked"]) and bool(out["reranked"])
+                             and ref["reranked"][0]["chunkIDs"] == out["reranked"][0]["chunkIDs"]
+                             and ref["reranked"][0]["source"] == out["reranked"][0]["source"]),
+        "rerank_score_mae": float(np.mean([abs(ref_scores[k] - out_scores[k]) for k in shared])) if shared else 0.0,
+        "nli_mae": float(np.abs(nli_ref - nli_out).mean()) if len(nli_ref) else 0.0,
+        "nli_flips": float(((nli_ref >= NLI_THRESHOLD) != (nli_out >= NLI_THRESHOLD)).mean()) if len(nli_ref) else 0.0,
+        "answer_exact": float(ref["answer"] == out["answer"]),
+        "answer_similarity": difflib.SequenceMatcher(None, ref["answer"], out["answer"]).ratio(),
+    }
+
+
+# ==============================
+#           MAIN
+# ==============================
+def main():
+    input_path = Path(QUESTIONS)
+    if not input_path.exists():
+        print(f"{QUESTIONS} не найден")
+        return
+
+    with open(input_path, newline="", encoding="utf-8") as f_in:
+        questions = [row["question"] for row in csv.DictReader(f_in)][:MAX_QUESTIONS]
+
+    print("1/3 Загрузка моделей fp32")
+    ref_models = load_models("fp32")
+    print(f"2/3 Загрузка моделей {PRECISION}")
+    test_models = load_models(PRECISION)
+
+    print(f"3/3 Сравнение на {len(questions)} вопросах")
+    ref_times, test_times = {}, {}
+    metrics = []
+    for question in questions:
+        ref = run_stages(ref_models, question, None, ref_times)
+        out = run_stages(test_models, question, ref, test_times)
+        metrics.append(compare(ref, out))
+
+    print(f"\n{PRECISION} против fp32:")
+    for key in metrics[0]:
+        print(f"  {key:<20} {np.mean([m[key] for m in metrics]):.4f}")
+
+    print("\nВремя стадий, сек (fp32 -> {}):".format(PRECISION))
+    for stage in ref_times:
+        speedup = ref_times[stage] / test_times[stage] if test_times.get(stage) else 0.0
+        print(f"  {stage:<10} {ref_times[stage]:8.2f} -> {test_times.get(stage, 0.0):8.2f}  (x{speedup:.2f})")
+
+
+if __name__ == "__main__":
+    main()
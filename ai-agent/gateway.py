@@ -1,128 +1,350 @@
 import os
+import json
+import asyncio
 import torch
 import shutil
 import time
-from typing import Literal, List
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from threading import Event
+from typing import Literal, List, Dict, Any, Optional
 from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
 from pydantic import BaseModel
 from pathlib import Path
-from object.LoadDOCX import parse_docx
-from object.LoadPDF import parse_pdf
-from object.LoadDOC_RTF import parse_doc_or_rtf
-from object.GenChunk_old import normalize_pre_chank, add_source_and_id
-from object.GenChunk import merge_chunks_by_source
-from object.SystemSearch import SearchSystem
-from object.Models import Reranker, LogicalRelationship, LLM
-
-
-app = FastAPI()
+from object.LoadPDF import ocr_stats
+from object.ParseFile import get_parser_for_file, parse_file, UnsupportedFileType, ParseError
+from object.GenChunk import merge_chunks_by_source, coalesce_context_windows
+from object.SystemSearch import SearchSystem, load_encoder
+from object.Models import Reranker, LogicalRelationship, LLM as LanguageModel
+from object.ContextPacker import ContextPacker
+from object.ContextCompressor import ContextCompressor
+from object.AnswerCache import AnswerCache
+from object.SessionCache import history_hash
+from object.Scheduler import SchedulerFull
+from object.Executors import StageExecutor, StageBusy, StageTimeout, StageGraph
+from object.LatencyBudget import LatencyBudget, StageCosts, nli_pairs
+from object.Placement import ModelWorker, place, pin, bind_memory
+from object.Startup import StartupState
+from object.IngestionQueue import IngestionQueue, SourceConflict
+
+
+# ======================= COLD START =======================
+# Индекс и модели загружаются в фоне параллельно (load_models), порт открывается сразу.
+# До конца загрузки и прогрева запросы к моделям получают 503 + Retry-After;
+# /healthz — процесс жив, /readyz — все стадии готовы
+STARTUP = StartupState(["index", "reranker", "nli", "llm", "link", "warmup"])
+STARTUP_RETRY_AFTER = 10
+WARMUP_QUESTION = "Какие сроки и суммы указаны в договоре?"
+WARMUP_NEW_TOKENS = 8
+
+# Заполняются load_models
+DB_SEARCH = None
+RERANKER = None
+LR = None
+LLM = None
+PACKER = None
+COMPRESSOR = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    STARTUP.start(load_models)
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-
-DB_SEARCH = SearchSystem(device=DEVICE)
-DB_SEARCH.load("./SearchStartData/pre-best-V4.pkl")
-
-RERANKER = Reranker(model='./model/reranker', device=DEVICE)
-LLM = LLM(model='./model/qwen3-0.6b',device=DEVICE)
-
-LR = LogicalRelationship(model="./model/lr", device=DEVICE)
+# Точность инференса всех моделей: "fp32", "bf16" или "int8" (dynamic quantization, только CPU).
+# Качество относительно fp32 проверяется скриптом eval_precision.py
+PRECISION = "fp32"
+
+# Размещение моделей по ядрам: "encoder", "reranker" и "nli" из MODEL_PLACEMENT работают в своих
+# процессах (ModelWorker) и не делят с другими ядра и пул потоков torch; "llm" — ядра самого gateway.
+# cores — "0-3,8" (по умолчанию ядра numa_node), threads — потоки intra-op (по умолчанию по числу ядер),
+# numa_node — узел для памяти модели. None — все модели в процессе gateway на общем пуле потоков
+MODEL_PLACEMENT = None
+# Пример для 32 ядер на двух NUMA-узлах:
+# MODEL_PLACEMENT = {
+#     "encoder": {"cores": "0-3"},
+#     "reranker": {"cores": "4-11"},
+#     "nli": {"cores": "12-15", "threads": 2},
+#     "llm": {"cores": "16-31", "numa_node": 1},
+# }
+# NUMA-узел для памяти индекса (эмбеддинги, BM25, payloads); None — без привязки
+INDEX_NUMA_NODE = None
+
+# Потоки загрузки и пулов стадий создаются позже и наследуют привязку
+if MODEL_PLACEMENT is not None and "llm" in MODEL_PLACEMENT:
+    pin(**MODEL_PLACEMENT["llm"])
+
+# Каскадный rerank: уверенные лидеры по score гибридного поиска не идут в cross-encoder
+RERANK_CASCADE = True
+RERANK_CASCADE_MARGIN = 0.1
+RERANK_CASCADE_DROP_MARGIN = 0.3
+# KV-кэш бесед: память под past_key_values всех сессий (LRU)
+SESSION_CACHE_BYTES = 2 * 1024 ** 3
+# История чата: последние HISTORY_KEEP_TURNS ходов дословно, старые — в сводку ("summary") или "drop"
+HISTORY_KEEP_TURNS = 4
+HISTORY_MODE = "summary"
+HISTORY_MAX_TOKENS = 1024
+# Speculative decoding: "prompt_lookup" — черновик из контекста документов,
+# "draft" — маленькая модель того же семейства (LLM_DRAFT_MODEL), None — выключено
+LLM_SPECULATIVE = "prompt_lookup"
+LLM_DRAFT_MODEL = None
+# Сколько ответов групп (separate_conflicts) генерируется одним батчем
+LLM_BATCH_SIZE = 4
+# Continuous batching: генерации всех запросов идут через общий цикл декодирования
+LLM_MAX_BATCH_SIZE = 8
+LLM_MAX_QUEUED_TOKENS = 65536
+# Бюджет токенов промпта: системный промпт + история + вопрос + контекст документов
+LLM_PROMPT_BUDGET = 3072
+# Экстрактивное сжатие: в промпт идут только ближайшие к вопросу предложения и строки таблиц
+CONTEXT_COMPRESSION = False
+# Кэш ответов: похожий вопрос (косинус >= порога) по тем же чанкам контекста
+ANSWER_CACHE = AnswerCache(threshold=0.95, max_entries=1024)
+
+# Пулы стадий с ограниченными очередями: большая загрузка не отнимает потоки у чата.
+# Генерация ждёт общий цикл декодирования, поэтому её потоков не меньше LLM_MAX_BATCH_SIZE
+INGESTION_EXECUTOR = StageExecutor("ingestion", workers=2, max_queue=32, retry_after=30)
+RETRIEVAL_EXECUTOR = StageExecutor("retrieval", workers=4, max_queue=32)
+NLI_EXECUTOR = StageExecutor("nli", workers=2, max_queue=32)
+GENERATION_EXECUTOR = StageExecutor("generation", workers=LLM_MAX_BATCH_SIZE, max_queue=32)
+# Таймауты запросов, сек (ChatRequest.timeout переопределяет CHAT_TIMEOUT)
+CHAT_TIMEOUT = 120
+INGESTION_TIMEOUT = 60
+
+# Бюджет задержки (ChatRequest.latency_budget): стоимость стадий учится по завершённым запросам,
+# при нехватке времени деградации включаются по порядку
+SEARCH_TOP_K = 15
+LLM_MAX_NEW_TOKENS = 256
+MIN_NEW_TOKENS = 64
+LATENCY_COSTS = StageCosts({"retrieval": 0.02, "nli": 0.05, "generation": 0.03})
+# (шаг, параметр smart_search_chunk, значение)
+RETRIEVAL_DEGRADATIONS = [
+    ("top_k", "top_k", 8),
+    ("context_expansion", "context_n", 0),
+    ("rerank_candidates", "rerank_candidates", 6),
+]
+
+
+@app.exception_handler(SchedulerFull)
+def scheduler_full_handler(request, exc: SchedulerFull):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "5"})
+
+
+@app.exception_handler(UnsupportedFileType)
+def unsupported_file_type_handler(request, exc: UnsupportedFileType):
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
+
+
+@app.exception_handler(SourceConflict)
+def source_conflict_handler(request, exc: SourceConflict):
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
+
+
+@app.exception_handler(ParseError)
+def parse_error_handler(request, exc: ParseError):
+    return JSONResponse(status_code=500, content={"detail": str(exc)})
+
+
+@app.exception_handler(StageBusy)
+def stage_busy_handler(request, exc: StageBusy):
+    return JSONResponse(status_code=429, content={"detail": str(exc)}, headers={"Retry-After": str(exc.retry_after)})
+
+
+@app.exception_handler(StageTimeout)
+def stage_timeout_handler(request, exc: StageTimeout):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": str(exc.retry_after)})
+
+
+@app.middleware("http")
+async def require_ready(request, call_next):
+    if STARTUP.ready or request.url.path in ("/healthz", "/readyz"):
+        return await call_next(request)
+    return JSONResponse(status_code=503, content={"detail": "models are loading"},
+                        headers={"Retry-After": str(STARTUP_RETRY_AFTER)})
+
+
+def remaining(deadline):
+    """Сколько секунд осталось до дедлайна запроса (None — без ограничения)."""
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
 
 
 tmp_folder = Path("inputTMP")
 tmp_folder.mkdir(exist_ok=True)
 
 
-def save_temp_file(upload: UploadFile) -> Path:
+def save_temp_file(upload: UploadFile, name=None) -> Path:
     tmp_folder.mkdir(parents=True, exist_ok=True)
 
-    tmp_path = tmp_folder / upload.filename
+    tmp_path = tmp_folder / (name or upload.filename)
     with tmp_path.open("wb") as f:
         shutil.copyfileobj(upload.file, f)
 
     return tmp_path
 
-def get_parser_for_file(path: Path):
-    ext = path.suffix.lower()
 
-    mapping = {
-        ".docx": parse_docx,
-        ".doc": parse_doc_or_rtf,
-        ".pdf": parse_pdf,
-        ".rtf": parse_doc_or_rtf,
-    }
+# ======================= INGESTION JOBS =======================
+# Загрузка возвращает задачу сразу (202), разбор / OCR и эмбеддинги идут в пуле INGESTION_WORKERS потоков,
+# индекс меняется по задачам в порядке загрузки. Задачи, готовые за INGESTION_COALESCE_DELAY сек,
+# публикуются одной перестройкой индекса. Состояние — GET /jobs/{job_id}
+INGESTION_WORKERS = 2
+INGESTION_MAX_PENDING = 32
+INGESTION_COALESCE_DELAY = 1.0
+# Копия индекса, которую меняют задачи до публикации (поиск идёт по DB_SEARCH)
+INDEX_DRAFT = None
+# Публикация снимка для воркеров serve.py (IndexWriter), None — один процесс
+INDEX_PUBLISHER = None
 
-    parser = mapping.get(ext)
-    if not parser:
-        raise HTTPException(status_code=400, detail=f"Unsupported file type: {ext}")
 
-    return parser
+def prepare_ingestion(job, set_state):
+    """Пул задач: разбор файла и эмбеддинги чанков, индекс не меняется."""
+    if job["op"] == "delete":
+        return None
 
-@app.post("/create_file")
-def create_file(file: UploadFile = File(...)):
-    temp_path = save_temp_file(file)
+    temp_path = Path(job["payload"])
+    try:
+        set_state("parsing")
+        chunks = parse_file(temp_path, job["source"])
+        set_state("embedding")
+        return DB_SEARCH.prepare_chunks(chunks)
+    finally:
+        temp_path.unlink(missing_ok=True)
 
-    if DB_SEARCH.file_exists(temp_path.stem):
-        raise HTTPException(status_code=400, detail=f"File {temp_path.name} already exists")
 
-    parser = get_parser_for_file(temp_path)
+def apply_ingestion(job, prepared):
+    """
+    Поток индекса: изменение копии индекса одной задачей. Запроса здесь нет — SourceConflict
+    попадает в ошибку задачи (GET /jobs/{job_id}), а в обработчике запроса — в ответ 400.
+    """
+    global INDEX_DRAFT
+    if INDEX_DRAFT is None:
+        INDEX_DRAFT = DB_SEARCH.copy()
 
-    try:
-        pre_chunks = parser(temp_path)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Parse error: {e}")
+    op, source = job["op"], job["source"]
+    exists = INDEX_DRAFT.file_exists(source)
+    if op == "create" and exists:
+        raise SourceConflict(f"File {job['filename']} already exists")
+    if op != "create" and not exists:
+        raise SourceConflict(f"File {job['filename']} not exists")
 
-    chunks = normalize_pre_chank(pre_chunks, 50, 120)
-    chunks = add_source_and_id(chunks, temp_path.stem)
+    if exists:
+        INDEX_DRAFT.remove_by_source(source)
+    if prepared is not None:
+        INDEX_DRAFT._add_internal(**prepared)
+    return source
 
-    DB_SEARCH.add_chunks(chunks)
-    DB_SEARCH.build_index()
 
-    temp_path.unlink(missing_ok=True)
+def commit_ingestion(sources):
+    """Одна перестройка индекса на все применённые задачи, затем подмена и публикация."""
+    global INDEX_DRAFT
+    draft, INDEX_DRAFT = INDEX_DRAFT, None
+    if draft.index.payloads:
+        draft.build_index()
+    DB_SEARCH.replace_with(draft)
 
-    return {"status": "created", "filename": temp_path.stem}
+    for source in sources:
+        ANSWER_CACHE.invalidate_source(source)
+    if INDEX_PUBLISHER is not None:
+        INDEX_PUBLISHER.publish(sources)
 
 
-@app.post("/update_file")
-def update_file(file: UploadFile = File(...)):
-    temp_path = save_temp_file(file)
+INGESTION_JOBS = IngestionQueue(
+    prepare_ingestion, apply_ingestion, commit_ingestion,
+    workers=INGESTION_WORKERS, max_pending=INGESTION_MAX_PENDING, coalesce_delay=INGESTION_COALESCE_DELAY,
+    retry_after=30,
+)
+
+
+# ======================= MULTI-PROCESS SERVING =======================
+# В воркере serve.py — IndexClient: очередь задач и индекс живут в родительском процессе (IndexWriter),
+# воркер передаёт ему задачи и подключает опубликованные снимки. None — всё в этом процессе
+INDEX_WRITER = None
+
+
+def init_worker(index_client):
+    """Воркер serve.py после fork: потоки родителя не наследуются, цикл декодирования запускается заново."""
+    global INDEX_WRITER
+    INDEX_WRITER = index_client
+    LLM.attach_scheduler(max_batch_size=LLM_MAX_BATCH_SIZE, max_queued_tokens=LLM_MAX_QUEUED_TOKENS)
+
+
+def ingestion_call(method, *args):
+    """Вызов INGESTION_JOBS (submit / get) в процессе, где живёт очередь: в писателе serve.py — через IndexClient."""
+    if INDEX_WRITER is None:
+        return getattr(INGESTION_JOBS, method)(*args)
+    return INDEX_WRITER.call(method, *args)
+
+
+def apply_writer_call(method, *args):
+    """Процесс-писатель serve.py: вызов очереди от воркера; публикует commit_ingestion, не писатель."""
+    return getattr(INGESTION_JOBS, method)(*args), []
+
 
-    if not DB_SEARCH.file_exists(temp_path.stem):
-        raise HTTPException(status_code=400, detail=f"File {temp_path.name} not exists")
+def refresh_index():
+    """Воркер: подключает новый снимок индекса, если писатель его опубликовал."""
+    if INDEX_WRITER is None:
+        return
+    for source in INDEX_WRITER.refresh(DB_SEARCH):
+        ANSWER_CACHE.invalidate_source(source)
 
-    DB_SEARCH.remove_by_source(temp_path.stem)
 
-    parser = get_parser_for_file(temp_path)
+async def refresh_index_async(deadline):
+    # Подключение снимка (pickle + BM25) — в пуле retrieval, проверка версии — без переключения потоков
+    if INDEX_WRITER is not None and INDEX_WRITER.stale():
+        await RETRIEVAL_EXECUTOR.run(refresh_index, timeout=remaining(deadline))
 
+
+def submit_ingestion(op, file):
+    if op == "delete":
+        return ingestion_call("submit", op, file, os.path.splitext(file)[0])
+
+    # Расширение проверяется сразу; файл сохраняется под уникальным именем — одинаковые загрузки не мешают
+    suffix = Path(file.filename).suffix
+    get_parser_for_file(Path(file.filename))
+    temp_path = save_temp_file(file, name=f"{uuid.uuid4().hex}{suffix}")
     try:
-        pre_chunks = parser(temp_path)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Parse error: {e}")
+        return ingestion_call("submit", op, file.filename, Path(file.filename).stem, str(temp_path))
+    except Exception:
+        temp_path.unlink(missing_ok=True)
+        raise
 
-    chunks = normalize_pre_chank(pre_chunks, 50, 120)
-    chunks = add_source_and_id(chunks, temp_path.stem)
 
-    DB_SEARCH.add_chunks(chunks)
-    DB_SEARCH.build_index()
+async def submit_ingestion_async(op, file):
+    job = await INGESTION_EXECUTOR.run(submit_ingestion, op, file, timeout=INGESTION_TIMEOUT)
+    return JSONResponse(status_code=202, content=job)
 
-    temp_path.unlink(missing_ok=True)
 
-    return {"status": "created", "filename": temp_path.stem}
+# Сохранение файла и постановка в очередь — в пуле ingestion; разбор и индексация — в INGESTION_JOBS
+@app.post("/create_file")
+async def create_file(file: UploadFile = File(...)):
+    return await submit_ingestion_async("create", file)
+
+
+@app.post("/update_file")
+async def update_file(file: UploadFile = File(...)):
+    return await submit_ingestion_async("update", file)
 
 
 @app.delete("/delete_file/{filename}")
-def delete_file(filename: str):
-    name_without_ext = os.path.splitext(filename)[0]
-    if not DB_SEARCH.file_exists(name_without_ext):
-        raise HTTPException(status_code=400, detail=f"File {filename} not exists")
+async def delete_file(filename: str):
+    return await submit_ingestion_async("delete", filename)
+
 
-    DB_SEARCH.remove_by_source(name_without_ext)
-    DB_SEARCH.build_index()
-    return {"status": "deleted", "filename": filename}
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = await INGESTION_EXECUTOR.run(ingestion_call, "get", job_id, timeout=INGESTION_TIMEOUT)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
 
 
-def smart_search_chunk(searchSystem: SearchSystem, reranker: Reranker, question: str):
-    chunks = searchSystem.search_hybrid(question, top_k=15, alpha=0.8)
+def smart_search_chunk(searchSystem: SearchSystem, reranker: Reranker, question: str, q_emb=None, bm25_scores=None,
+                       top_k=SEARCH_TOP_K, context_n=1, rerank_candidates=None):
+    chunks = searchSystem.search_hybrid(question, top_k=top_k, alpha=0.8, q_emb=q_emb, bm25_scores=bm25_scores)
 
     filter_result = []
 
@@ -130,20 +352,39 @@ def smart_search_chunk(searchSystem: SearchSystem, reranker: Reranker, question:
         context_chunks = searchSystem.get_context_chunks(
             chunk["payload"]["chunkID"],
             chunk["payload"]["source"],
+            context_n
         )
 
         chunk_ids = [ch["chunkID"] for ch in context_chunks]
         texts = [ch["text"] for ch in context_chunks]
+        chunk_hashes = [ch["chunkHash"] for ch in context_chunks]
 
         filter_result.append({
             "source": chunk["payload"]["source"],
             "chunkIDs": chunk_ids,
-            "texts": texts
+            "texts": texts,
+            "chunkHashes": chunk_hashes,
+            "hybrid_score": chunk["score"]
         })
 
-    reranker_output = reranker.rerank_results(question, filter_result, 4, 0.35)
+    # Соседние попадания дают пересекающиеся окна — склеиваем их до rerank
+    filter_result, coalesce_stats = coalesce_context_windows(filter_result)
+
+    # Под бюджетом задержки в reranker идут только лучшие по гибридному score
+    if rerank_candidates is not None:
+        filter_result = sorted(filter_result, key=lambda r: r["hybrid_score"], reverse=True)[:rerank_candidates]
+
+    if not RERANK_CASCADE:
+        reranker_output = reranker.rerank_results(question, filter_result, 4, 0.35)
+        rerank_stats = {"candidates": len(filter_result), "full_scored": len(filter_result), "full_fraction": 1.0}
+    else:
+        reranker_output, rerank_stats = reranker.rerank_results_cascade(
+            question, filter_result, 4, 0.35,
+            margin=RERANK_CASCADE_MARGIN,
+            drop_margin=RERANK_CASCADE_DROP_MARGIN
+        )
 
-    return reranker_output
+    return reranker_output, {"coalesce": coalesce_stats, "rerank": rerank_stats}
 
 class ChatAnswer(BaseModel):
     role: Literal["assistant"]
@@ -153,6 +394,7 @@ class ChatAnswer(BaseModel):
 
 class ChatAnswerResponse(BaseModel):
     chat: List[ChatAnswer]
+    stats: Dict[str, Any] = {}
 
 class ChatMessage(BaseModel):
     role: Literal["system", "user", "assistant"]
@@ -161,66 +403,513 @@ class ChatMessage(BaseModel):
 class ChatRequest(BaseModel):
     separate_conflicts: bool
     chat: List[ChatMessage]
+    # Идентификатор беседы: включает переиспользование KV-кэша между ходами
+    conversation_id: Optional[str] = None
+    # Не брать ответ из кэша ответов (свежий ответ всё равно сохраняется)
+    bypass_cache: bool = False
+    # Таймаут запроса, сек (по умолчанию CHAT_TIMEOUT)
+    timeout: Optional[float] = None
+    # Бюджет задержки, сек: при нехватке времени ответ упрощается (stats.degradations)
+    latency_budget: Optional[float] = None
+
+def build_context(chunks_group):
+    context = ""
+    source_chunks = set()
+    for chunk_source in chunks_group:
+        source_chunks.add(chunk_source["source"])
+        context += f"Файл: {chunk_source['source']}\n"
+        context += "\n\n".join(chunk_source["texts"]) + "\n\n"
+    return context, source_chunks
+
+
+def pack_group(group_chunks, reserved_tokens):
+    # Спаны в порядке reranker укладываются в бюджет промпта, затем группируются по файлам
+    packed, pack_stats = PACKER.pack(group_chunks, reserved_tokens)
+    context, source_chunks = build_context(merge_chunks_by_source(packed))
+    return context, source_chunks, pack_stats
+
+
+def answer_cache_key(req: ChatRequest, context_chunks):
+    chunk_ids = {(c["source"], h) for c in context_chunks for h in c.get("chunkHashes", [])}
+    history_key = history_hash([{"role": m.role, "content": m.message} for m in req.chat[:-1]])
+    return AnswerCache.make_key(chunk_ids, req.separate_conflicts, history_key)
+
+
+def lookup_answer_cache(req: ChatRequest, cache_key, q_emb, search_stats):
+    if req.bypass_cache:
+        ANSWER_CACHE.record_bypass()
+        search_stats["answer_cache"] = "bypass"
+        return None
+
+    cached = ANSWER_CACHE.get(cache_key, q_emb)
+    search_stats["answer_cache"] = "hit" if cached is not None else "miss"
+    return cached
+
+
+def store_answer_cache(cache_key, q_emb, answers, search_stats, version):
+    """
+    Упрощённый ответ не кэшируется: запрос без бюджета должен получить полный.
+    version — ANSWER_CACHE.current_version() до retrieval: ответ по индексу, который успели
+    обновить (commit_ingestion, refresh_index), не сохраняется.
+    """
+    if not search_stats["degradations"]:
+        ANSWER_CACHE.put(cache_key, q_emb, answers, version=version)
+
+
+def compress_context(top_k_chunks, q_emb, search_stats):
+    if not CONTEXT_COMPRESSION:
+        return top_k_chunks
+    top_k_chunks, search_stats["compression"] = COMPRESSOR.compress(top_k_chunks, q_emb)
+    return top_k_chunks
+
+
+def retrieve(question, q_emb=None, bm25_scores=None, search_params=None):
+    """Стадия retrieval: гибридный поиск, rerank и сжатие контекста (эмбеддинг и BM25 — если не посчитаны)."""
+    if q_emb is None:
+        q_emb = DB_SEARCH.encode_query(question)
+    top_k_chunks, search_stats = smart_search_chunk(DB_SEARCH, RERANKER, question, q_emb, bm25_scores,
+                                                    **(search_params or {}))
+    context_chunks = compress_context(top_k_chunks, q_emb, search_stats)
+    return q_emb, top_k_chunks, context_chunks, search_stats
+
+
+def plan_answer_groups(req: ChatRequest, context_chunks, conflicts):
+    reserved_tokens = LLM.count_prompt_tokens([msg.dict() for msg in req.chat], req.chat[-1].message)
+    return build_answer_groups(context_chunks, conflicts, req.separate_conflicts, reserved_tokens)
+
+
+def generate_group_answers(req: ChatRequest, context_chunks, conflicts, cancel=None, max_new_tokens=None):
+    """Стадия generation: упаковка контекста групп и генерация их ответов одним батчем."""
+    groups = plan_answer_groups(req, context_chunks, conflicts)
+    group_answers = LLM.generate_answers(
+        [msg.dict() for msg in req.chat], req.chat[-1].message, [g["context"] for g in groups],
+        attention="", batch_size=LLM_BATCH_SIZE, session_id=req.conversation_id, cancel=cancel,
+        max_new_tokens=max_new_tokens
+    )
+    return groups, group_answers
+
+
+# ======================= LATENCY BUDGET =======================
+def retrieval_units(search_params):
+    # Без расширения контекста текст кандидата примерно втрое короче
+    candidates = min(search_params["top_k"], search_params["rerank_candidates"] or search_params["top_k"])
+    return candidates * (1.0 if search_params["context_n"] else 1 / 3)
+
+
+def plan_retrieval(budget: Optional[LatencyBudget]):
+    """Параметры smart_search_chunk: ужимаются по RETRIEVAL_DEGRADATIONS, пока весь запрос не влезет в бюджет."""
+    search_params = {"top_k": SEARCH_TOP_K, "context_n": 1, "rerank_candidates": None}
+    if budget is None:
+        return search_params
+
+    # До поиска число пар NLI неизвестно: берём все пары из 4 чанков reranker
+    rest = LATENCY_COSTS.estimate("nli", 6) + LATENCY_COSTS.estimate("generation", LLM_MAX_NEW_TOKENS)
+    for step, key, value in RETRIEVAL_DEGRADATIONS:
+        if budget.fits(LATENCY_COSTS.estimate("retrieval", retrieval_units(search_params)) + rest):
+            break
+        search_params[key] = value
+        budget.apply(step, value)
+    return search_params
+
+
+def plan_generation(budget: Optional[LatencyBudget], req: ChatRequest, top_k_chunks):
+    """Решает после retrieval: запускать ли NLI и какой max_new_tokens влезет в остаток бюджета."""
+    if budget is None:
+        return True, None
 
-@app.post("/chat/answer")
-def chat_answer(req: ChatRequest):
+    nli_cost = LATENCY_COSTS.estimate("nli", nli_pairs(top_k_chunks))
+    min_generation = LATENCY_COSTS.estimate("generation", MIN_NEW_TOKENS)
 
-    start_total = time.time()
+    # При separate_conflicts генерация может начаться только после NLI, иначе они идут параллельно
+    run_nli = budget.fits(nli_cost + min_generation if req.separate_conflicts else nli_cost)
+    if not run_nli:
+        budget.apply("skip_nli", True)
 
-    question = req.chat[-1].message
-
-    search_chunk_with_context = time.time()
-    top_k_chunks = smart_search_chunk(DB_SEARCH, RERANKER, question)
-    search_chunk_with_context = time.time() - search_chunk_with_context
-
-    merge_by_source = merge_chunks_by_source(top_k_chunks)
-    matrix, conflicts = LR.build_document_conflict_matrix(top_k_chunks)
-
-    llm_time = time.time()
-    answers = []
+    available = budget.remaining() - (nli_cost if run_nli and req.separate_conflicts else 0.0)
+    max_new_tokens = int(available / LATENCY_COSTS.estimate("generation", 1))
+    if max_new_tokens >= LLM_MAX_NEW_TOKENS:
+        return run_nli, None
+
+    max_new_tokens = max(MIN_NEW_TOKENS, max_new_tokens)
+    budget.apply("max_new_tokens", max_new_tokens)
+    return run_nli, max_new_tokens
 
-    def build_context(chunks_group):
-        context = ""
-        source_chunks = set()
-        for chunk_source in chunks_group:
-            source_chunks.add(chunk_source["source"])
-            context += f"Файл: {chunk_source['source']}\n"
-            context += "\n\n".join(chunk_source["texts"]) + "\n\n"
-        return context, source_chunks
 
-    if conflicts and req.separate_conflicts:
+def observe_costs(timings, search_params, top_k_chunks, nli_ran, group_answers):
+    """Обновляет StageCosts по времени стадий завершённого запроса."""
+    stages = timings["stages"]
+    LATENCY_COSTS.observe("retrieval", stages["retrieval"]["duration"], retrieval_units(search_params))
+    if nli_ran and "nli" in stages:
+        LATENCY_COSTS.observe("nli", stages["nli"]["duration"], nli_pairs(top_k_chunks))
+
+    generation = "generation_groups" if "generation_groups" in stages else "generation"
+    tokens = max(len(LLM.tokenizer(a, add_special_tokens=False).input_ids) for a in group_answers)
+    LATENCY_COSTS.observe("generation", stages[generation]["duration"], tokens)
+
+
+def build_answer_groups(top_k_chunks, conflicts, separate_conflicts, reserved_tokens=0):
+    """
+    Разбивает найденные чанки на группы, по каждой из которых генерируется отдельный ответ.
+    Возвращает список {"context", "files_used", "attention", "packing"}.
+    """
+    groups = []
+
+    if conflicts and separate_conflicts:
         non_conflicting_groups = LR.build_non_conflicting_groups(conflicts)
         for group_sources in non_conflicting_groups:
-            group_chunks = [c for c in merge_by_source if c["source"] in group_sources]
-            context, source_chunks = build_context(group_chunks)
+            group_chunks = [c for c in top_k_chunks if c["source"] in group_sources]
+            context, source_chunks, pack_stats = pack_group(group_chunks, reserved_tokens)
 
             attention_pairs = [[c[0], c[1]] for c in conflicts if c[0] in source_chunks or c[1] in source_chunks]
-
-            answer = LLM.generate_answer([msg.dict() for msg in req.chat], question, context, attention="")
-            answers.append(ChatAnswer(
-                role="assistant",
-                message=answer,
-                files_used=list(source_chunks),
-                attention=attention_pairs
-            ))
+            groups.append({"context": context, "files_used": list(source_chunks), "attention": attention_pairs,
+                           "packing": pack_stats})
     else:
         attention_pairs = [[c[0], c[1]] for c in conflicts] if conflicts else []
 
-        context, source_chunks = build_context(merge_by_source)
-        answer = LLM.generate_answer([msg.dict() for msg in req.chat], question, context, attention="")
+        context, source_chunks, pack_stats = pack_group(top_k_chunks, reserved_tokens)
+        groups.append({"context": context, "files_used": list(source_chunks), "attention": attention_pairs,
+                       "packing": pack_stats})
+
+    return groups
+
+
+# ======================= LOAD MODELS =======================
+def load_index():
+    global DB_SEARCH
+    # Политика NUMA у потока: на INDEX_NUMA_NODE попадает только память индекса
+    if INDEX_NUMA_NODE is not None:
+        bind_memory(INDEX_NUMA_NODE)
+    search = SearchSystem(
+        device=DEVICE, precision=PRECISION,
+        encoder=place("encoder", load_encoder, "./model/encoder", DEVICE, PRECISION, placement=MODEL_PLACEMENT)
+    )
+    search.load("./SearchStartData/pre-best-V4.pkl")
+    DB_SEARCH = search
+
+
+def load_reranker():
+    global RERANKER
+    RERANKER = place("reranker", Reranker, placement=MODEL_PLACEMENT,
+                     model='./model/reranker', device=DEVICE, precision=PRECISION)
+
+
+def load_nli():
+    global LR
+    LR = place("nli", LogicalRelationship, placement=MODEL_PLACEMENT,
+               model="./model/lr", device=DEVICE, precision=PRECISION)
+
+
+def load_llm():
+    global LLM
+    # Через place — под общей блокировкой загрузки моделей (в ModelWorker LLM не выносится)
+    llm = place(
+        "llm", LanguageModel,
+        model='./model/qwen3-0.6b',
+        device=DEVICE,
+        prefix_cache=True,
+        session_cache_bytes=SESSION_CACHE_BYTES,
+        history_keep_turns=HISTORY_KEEP_TURNS,
+        history_mode=HISTORY_MODE,
+        history_max_tokens=HISTORY_MAX_TOKENS,
+        speculative=LLM_SPECULATIVE,
+        draft_model=LLM_DRAFT_MODEL,
+        precision=PRECISION
+    )
+    # Кэш системного префикса используется, только если greedy-ответы с ним и без него совпадают
+    if not llm.verify_prefix_cache():
+        print("Prefix KV-cache: проверка не пройдена, кэш отключён")
+        llm.prefix_cache = None
+    llm.attach_scheduler(max_batch_size=LLM_MAX_BATCH_SIZE, max_queued_tokens=LLM_MAX_QUEUED_TOKENS)
+    LLM = llm
+
+
+def link_models():
+    global PACKER, COMPRESSOR
+    # Чанки токенизируются один раз при индексации; reranker, NLI и LLM склеивают готовые id.
+    # Модели в ModelWorker токенизируют сами: индекс токенов живёт в процессе gateway
+    for model in (RERANKER, LR, LLM):
+        if not isinstance(model, ModelWorker):
+            model.attach_token_store(DB_SEARCH.token_store)
+
+    PACKER = ContextPacker(LLM.tokenizer, prompt_budget=LLM_PROMPT_BUDGET, count_chunk=LLM.count_context_tokens)
+    COMPRESSOR = ContextCompressor(DB_SEARCH.encoder, ratio=0.3, max_tokens=None)
+
+
+def warmup():
+    """Тестовый вопрос через все стадии: первые запросы не платят за ленивую инициализацию моделей."""
+    req = ChatRequest(separate_conflicts=False, chat=[ChatMessage(role="user", message=WARMUP_QUESTION)])
+    if not DB_SEARCH.index.payloads:
+        DB_SEARCH.encode_query(WARMUP_QUESTION)
+        generate_group_answers(req, [], [], max_new_tokens=WARMUP_NEW_TOKENS)
+        return
+
+    _, top_k_chunks, context_chunks, _ = retrieve(WARMUP_QUESTION)
+    LR.build_document_conflict_matrix(top_k_chunks)
+    generate_group_answers(req, context_chunks, [], max_new_tokens=WARMUP_NEW_TOKENS)
+
+
+def load_models():
+    """
+    Индекс и модели независимы и грузятся параллельно (модели этого процесса — по одной, см. place),
+    затем связываются и прогреваются.
+    """
+    loaders = {"index": load_index, "reranker": load_reranker, "nli": load_nli, "llm": load_llm}
+    with ThreadPoolExecutor(max_workers=len(loaders), thread_name_prefix="load") as pool:
+        loaded = list(pool.map(STARTUP.run, loaders, loaders.values()))
+
+    if all(loaded) and STARTUP.run("link", link_models) and STARTUP.run("warmup", warmup):
+        print(f"Gateway готов за {STARTUP.stats()['uptime']:.1f} сек")
+
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    stats = STARTUP.stats()
+    return JSONResponse(status_code=200 if stats["ready"] else 503, content=stats)
+
+
+@app.post("/chat/answer")
+async def chat_answer(req: ChatRequest):
+
+    start_total = time.time()
+    deadline = time.monotonic() + (req.timeout or CHAT_TIMEOUT)
+
+    question = req.chat[-1].message
+    await refresh_index_async(deadline)
+    cache_version = ANSWER_CACHE.current_version()
+
+    budget = LatencyBudget(req.latency_budget, LATENCY_COSTS) if req.latency_budget else None
+    search_params = plan_retrieval(budget)
+
+    graph = StageGraph(deadline)
+    # graph.close() снимает только asyncio-задачи: потоки генерации останавливаются через cancel
+    # (таймаут, ошибка, отключение клиента)
+    cancel, groups_cancel = Event(), Event()
+    try:
+        # Эмбеддинг вопроса и BM25 не зависят друг от друга
+        q_emb, bm25_scores = await asyncio.gather(
+            graph.add("encode", RETRIEVAL_EXECUTOR, DB_SEARCH.encode_query, question),
+            graph.add("bm25", RETRIEVAL_EXECUTOR, DB_SEARCH.bm25_scores, question),
+        )
+        q_emb, top_k_chunks, context_chunks, search_stats = await graph.add(
+            "retrieval", RETRIEVAL_EXECUTOR, retrieve, question, q_emb, bm25_scores, search_params,
+            after=("encode", "bm25")
+        )
+        search_stats["degradations"] = budget.applied if budget else []
+
+        # Тот же вопрос по тем же чанкам — отдаём сохранённый ответ без NLI и LLM
+        cache_key = answer_cache_key(req, context_chunks)
+        cached = lookup_answer_cache(req, cache_key, q_emb, search_stats)
+        if cached is not None:
+            print(f"Ответ из кэша, общее время:                          {time.time() - start_total:.1f} сек")
+            search_stats["timings"] = graph.report()
+            return ChatAnswerResponse(chat=cached, stats=search_stats)
+
+        # NLI влияет только на разбиение на группы: ответ одной группой генерируется параллельно с ним
+        # (при separate_conflicts — спекулятивно) и отменяется, если NLI найдёт конфликты
+        # Под бюджетом задержки NLI может быть пропущен, а длина ответа — ограничена
+        run_nli, max_new_tokens = plan_generation(budget, req, top_k_chunks)
+        if run_nli:
+            nli = graph.add("nli", NLI_EXECUTOR, LR.build_document_conflict_matrix, top_k_chunks, after=("retrieval",))
+        single = graph.add(
+            "generation", GENERATION_EXECUTOR, generate_group_answers, req, context_chunks, [], cancel,
+            max_new_tokens, after=("retrieval",)
+        )
+        matrix, conflicts = await nli if run_nli else (None, [])
+
+        if conflicts and req.separate_conflicts:
+            cancel.set()
+            graph.cancel("generation")
+            groups, group_answers = await graph.add(
+                "generation_groups", GENERATION_EXECUTOR, generate_group_answers, req, context_chunks, conflicts,
+                groups_cancel, max_new_tokens, after=("nli",)
+            )
+        else:
+            groups, group_answers = await single
+            groups[0]["attention"] = [[c[0], c[1]] for c in conflicts] if conflicts else []
+    finally:
+        cancel.set()
+        groups_cancel.set()
+        graph.close()
+
+    search_stats["packing"] = [g["packing"] for g in groups]
+    search_stats["timings"] = timings = graph.report()
+    observe_costs(timings, search_params, top_k_chunks, run_nli, group_answers)
+
+    answers = []
+    for group, answer in zip(groups, group_answers):
         answers.append(ChatAnswer(
             role="assistant",
             message=answer,
-            files_used=list(source_chunks),
-            attention=attention_pairs
+            files_used=group["files_used"],
+            attention=group["attention"]
         ))
 
-    llm_time = time.time() - llm_time
-
     total_time = time.time() - start_total
-    print(f"Поиска чанков и контекста(RAG + BM25) время:         {search_chunk_with_context:.1f} сек")
-    print(f"{len(answers)} LLM генераций по времи:                {llm_time:.1f} сек")
+    llm_stage = "generation_groups" if "generation_groups" in timings["stages"] else "generation"
+    print(f"Поиска чанков и контекста(RAG + BM25) время:         {timings['stages']['retrieval']['end']:.1f} сек")
+    print(f"{len(answers)} LLM генераций по времи:                {timings['stages'][llm_stage]['duration']:.1f} сек")
+    print(f"Критический путь:                                    {' -> '.join(timings['critical_path'])}")
+    print(f"Сэкономлено токенов склейкой окон:                   {search_stats['coalesce']['tokens_saved']}")
+    print(f"Доля кандидатов через полный reranker:               {search_stats['rerank']['full_fraction']:.2f}")
+    print(f"Токенов контекста в промптах / отброшено:            "
+          f"{sum(p['tokens_used'] for p in search_stats['packing'])} / {sum(p['tokens_dropped'] for p in search_stats['packing'])}")
     print(f"Общее время:                                         {total_time:.1f} сек")
 
-    response_data = ChatAnswerResponse(chat=answers)
-    return response_data
\ No newline at end of file
+    store_answer_cache(cache_key, q_emb, answers, search_stats, cache_version)
+
+    response_data = ChatAnswerResponse(chat=answers, stats=search_stats)
+    return response_data
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {
+        "answer_cache": ANSWER_CACHE.stats(),
+        "sessions": LLM.sessions.stats() if LLM.sessions is not None else None,
+        "tokens": DB_SEARCH.token_store.stats(),
+    }
+
+
+@app.get("/llm/stats")
+async def llm_stats():
+    return {
+        "scheduler": LLM.scheduler.stats() if LLM.scheduler is not None else None,
+        # acceptance_rate и tokens_per_sec speculative decoding
+        "speculative": LLM.speculative.stats() if LLM.speculative is not None else None,
+    }
+
+
+@app.get("/stages/stats")
+async def stages_stats():
+    return {
+        **{
+            executor.name: executor.stats()
+            for executor in (INGESTION_EXECUTOR, RETRIEVAL_EXECUTOR, NLI_EXECUTOR, GENERATION_EXECUTOR)
+        },
+        # Оценки стоимости единицы работы для бюджета задержки, сек
+        "latency_costs": LATENCY_COSTS.stats(),
+        # Очередь задач индексации (в воркере serve.py — у писателя)
+        "ingestion_jobs": await INGESTION_EXECUTOR.run(ingestion_call, "stats", timeout=INGESTION_TIMEOUT),
+        # Пул и кэш OCR сканов (None — сканов в этом процессе ещё не было)
+        "ocr": ocr_stats(),
+        # Процессы моделей из MODEL_PLACEMENT
+        "workers": {
+            model.name: model.stats()
+            for model in (DB_SEARCH.encoder, RERANKER, LR) if isinstance(model, ModelWorker)
+        },
+    }
+
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/chat/answer/stream")
+async def chat_answer_stream(req: ChatRequest):
+    """
+    Потоковый вариант /chat/answer (Server-Sent Events):
+    retrieval — найденные файлы сразу после rerank,
+    groups    — группы ответов после проверки конфликтов,
+    token     — очередной фрагмент ответа группы {"group", "text"},
+    answer    — готовый ChatAnswer группы,
+    error     — стадия переполнена или истёк таймаут {"detail", "retry_after"},
+    done      — статистика запроса.
+    """
+    start_total = time.time()
+    deadline = time.monotonic() + (req.timeout or CHAT_TIMEOUT)
+    question = req.chat[-1].message
+    await refresh_index_async(deadline)
+    cache_version = ANSWER_CACHE.current_version()
+
+    # Retrieval до начала ответа: переполнение очереди ещё можно вернуть статусом 429
+    q_emb, top_k_chunks, context_chunks, search_stats = await RETRIEVAL_EXECUTOR.run(
+        retrieve, question, timeout=remaining(deadline)
+    )
+    # Бюджета задержки у потока нет, но статистика и правило кэширования — как у /chat/answer
+    search_stats["degradations"] = []
+
+    async def events():
+        yield sse_event("retrieval", {
+            "files_used": sorted({c["source"] for c in top_k_chunks}),
+            # score — cross-encoder, у лидеров каскада его нет: их ранжирует fast_score
+            "chunks": [
+                {"source": c["source"], "chunkIDs": c["chunkIDs"], "score": c.get("score"),
+                 "fast_score": c.get("fast_score")}
+                for c in top_k_chunks
+            ],
+        })
+
+        cache_key = answer_cache_key(req, context_chunks)
+        cached = lookup_answer_cache(req, cache_key, q_emb, search_stats)
+        if cached is not None:
+            for i, answer in enumerate(cached):
+                yield sse_event("answer", {"group": i, **answer.dict()})
+            yield sse_event("done", {**search_stats, "total_time": time.time() - start_total})
+            return
+
+        first_token_time = None
+        answers = []
+        try:
+            matrix, conflicts = await NLI_EXECUTOR.run(
+                LR.build_document_conflict_matrix, top_k_chunks, timeout=remaining(deadline)
+            )
+            groups = await GENERATION_EXECUTOR.run(
+                plan_answer_groups, req, context_chunks, conflicts, timeout=remaining(deadline)
+            )
+            search_stats["packing"] = [g["packing"] for g in groups]
+            yield sse_event("groups", [
+                {"group": i, "files_used": g["files_used"], "attention": g["attention"]}
+                for i, g in enumerate(groups)
+            ])
+
+            for i, group in enumerate(groups):
+                parts = []
+                # Кэш беседы имеет смысл только для единственной группы
+                session_id = req.conversation_id if len(groups) == 1 else None
+                # Таймаут или отключение клиента останавливают генерацию, а не только чтение фрагментов
+                cancel = Event()
+                try:
+                    async with asyncio.timeout(remaining(deadline)):
+                        async for piece in LLM.stream_answer_async(
+                            [msg.dict() for msg in req.chat], question, group["context"],
+                            attention="", session_id=session_id, submit=GENERATION_EXECUTOR.submit, cancel=cancel
+                        ):
+                            if first_token_time is None:
+                                first_token_time = time.time() - start_total
+                            parts.append(piece)
+                            yield sse_event("token", {"group": i, "text": piece})
+                finally:
+                    cancel.set()
+
+                answer = ChatAnswer(
+                    role="assistant",
+                    message="".join(parts).strip(),
+                    files_used=group["files_used"],
+                    attention=group["attention"]
+                )
+                answers.append(answer)
+                yield sse_event("answer", {"group": i, **answer.dict()})
+        except (StageBusy, StageTimeout) as e:
+            yield sse_event("error", {"detail": str(e), "retry_after": e.retry_after})
+            return
+        except SchedulerFull as e:
+            yield sse_event("error", {"detail": str(e), "retry_after": 5})
+            return
+        except TimeoutError:
+            yield sse_event("error", {"detail": "request timed out", "retry_after": GENERATION_EXECUTOR.retry_after})
+            return
+
+        store_answer_cache(cache_key, q_emb, answers, search_stats, cache_version)
+
+        yield sse_event("done", {
+            **search_stats,
+            "first_token_time": first_token_time,
+            "total_time": time.time() - start_total,
+        })
+
+    return StreamingResponse(events(), media_type="text/event-stream")
@@ -0,0 +1,297 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import pickle
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from object.ParseFile import get_parser_for_file, parse_file, UnsupportedFileType
+from object.SystemSearch import SearchSystem
+
+# =========================== НАСТРОЙКИ ===========================
+# Массовая индексация каталога документов: python ingest.py [каталог] [--output индекс.pkl]
+# Файлы разбираются в пуле процессов, чанки кодируются большими батчами и пишутся шардами в STATE_DIR
+# вместе с журналом manifest.jsonl: прерванный запуск продолжается с необработанных файлов.
+# В конце шарды вливаются в индекс --output (SearchSystem.save): документы, уже бывшие в нём, остаются,
+# новые версии файлов заменяют старые. После сохранения шарды удаляются.
+# По умолчанию индекс пишется отдельно от того, что загружает gateway.py (pre-best-V4.pkl)
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+PRECISION = "fp32"
+
+ENCODER_MODEL = "./model/encoder"
+INPUT_DIR = "./documents"
+OUTPUT = "./SearchStartData/ingest-index.pkl"
+STATE_DIR = "./SearchStartData/ingest"
+
+PARSE_WORKERS = len(os.sched_getaffinity(0))
+ENCODE_BATCH_SIZE = 128
+# Сколько чанков копится до кодирования и записи шарда
+SHARD_CHUNKS = 4096
+
+
+# ======================= ФАЙЛЫ И ЖУРНАЛ =======================
+def file_key(path):
+    stat = path.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def scan(root):
+    """Поддерживаемые файлы каталога (рекурсивно): source (имя без расширения) -> путь."""
+    files = {}
+    for path in sorted(Path(root).rglob("*")):
+        if not path.is_file():
+            continue
+        try:
+            get_parser_for_file(path)
+        except UnsupportedFileType:
+            continue
+        if path.stem in files:
+            print(f"Пропуск {path}: source {path.stem} уже занят {files[path.stem]}")
+            continue
+        files[path.stem] = path
+    return files
+
+
+def read_manifest(state_dir):
+    """Последняя запись журнала по каждому source."""
+    entries = {}
+    path = state_dir / "manifest.jsonl"
+    if not path.exists():
+        return entries
+
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Недописанная строка прерванного запуска
+                break
+            entries[entry["source"]] = entry
+    return entries
+
+
+def append_manifest(state_dir, entries):
+    with open(state_dir / "manifest.jsonl", "a", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def compact_manifest(state_dir, manifest):
+    """
+    После сохранения индекса: по записи на source, чанки влитых файлов — уже в индексе (merged),
+    ссылок на шарды не остаётся. Журнал подменяется целиком через временный файл.
+    """
+    tmp_path = state_dir / "manifest.jsonl.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for entry in manifest.values():
+            if entry["error"] is None:
+                entry = {**entry, "shard": None, "merged": True}
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, state_dir / "manifest.jsonl")
+
+
+def is_done(entry, key, indexed):
+    """Файл не нужно разбирать заново: та же версия уже в шарде или в индексе."""
+    if entry is None or entry["key"] != key or entry["error"] is not None:
+        return False
+    if entry.get("merged"):
+        # Индекс могли заменить или удалить — тогда файл разбирается снова
+        return entry["chunks"] == 0 or entry["source"] in indexed
+    return True
+
+
+def next_shard(state_dir):
+    numbers = [int(p.stem.split("-")[1]) for p in state_dir.glob("shard-*.pkl")]
+    return max(numbers, default=0) + 1
+
+
+# ======================= РАЗБОР И КОДИРОВАНИЕ =======================
+def parse_one(job):
+    """Процесс пула: файл -> чанки, ошибка передаётся текстом."""
+    source, path, key = job
+    try:
+        chunks, error = parse_file(Path(path), source), None
+    except Exception as e:
+        chunks, error = [], str(e)
+    return {"source": source, "path": path, "key": key, "chunks": len(chunks), "shard": None, "error": error}, chunks
+
+
+def write_shard(state_dir, number, search, entries, chunks):
+    if not chunks:
+        append_manifest(state_dir, entries)
+        return False
+
+    prepared = search.prepare_chunks(chunks, batch_size=ENCODE_BATCH_SIZE)
+
+    name = f"shard-{number:05d}.pkl"
+    tmp_path = state_dir / f"{name}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(prepared, f)
+    os.replace(tmp_path, state_dir / name)
+
+    # Журнал пишется после шарда: запись в manifest значит, что чанки файла уже на диске
+    for entry in entries:
+        entry["shard"] = name
+    append_manifest(state_dir, entries)
+    return True
+
+
+def build(state_dir, manifest, files, search):
+    """
+    Шарды вливаются в индекс search одним build_index: прежние чанки разобранных заново файлов
+    удаляются, чанки старых версий в шардах отбрасываются. Документы индекса, которых нет
+    в каталоге, остаются. Возвращает число влитых файлов (0 — индекс не менялся).
+    """
+    pending = [
+        source for source, entry in manifest.items()
+        if source in files and entry["error"] is None and not entry.get("merged")
+    ]
+    if not pending:
+        return 0
+
+    sources_by_shard = {}
+    for source in pending:
+        if manifest[source]["shard"] is not None:
+            sources_by_shard.setdefault(manifest[source]["shard"], set()).add(source)
+
+    indexed = {p["source"] for p in search.index.payloads}
+    for source in pending:
+        if source in indexed:
+            search.remove_by_source(source)
+
+    ids, vectors, payloads = [], [], []
+    for name in sorted(sources_by_shard):
+        with open(state_dir / name, "rb") as f:
+            data = pickle.load(f)
+        keep = [i for i, p in enumerate(data["payloads"]) if p["source"] in sources_by_shard[name]]
+        if not keep:
+            continue
+        ids.extend(data["ids"][i] for i in keep)
+        vectors.append(data["vectors"][keep])
+        payloads.extend(data["payloads"][i] for i in keep)
+
+    if payloads:
+        # Один vstack вместо add_chunks на каждый шард
+        search._add_internal(ids=ids, vectors=np.vstack(vectors), payloads=payloads)
+    if search.index.payloads:
+        search.build_index()
+    return len(pending)
+
+
+# ==============================
+#           MAIN
+# ==============================
+def parse_args():
+    parser = argparse.ArgumentParser(description="Массовая индексация каталога документов")
+    parser.add_argument("input", nargs="?", default=INPUT_DIR, help="каталог с документами")
+    parser.add_argument("--output", default=OUTPUT,
+                        help="индекс SearchSystem: существующий дополняется, иначе создаётся")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    root, output = Path(args.input), Path(args.output)
+    if not root.is_dir():
+        print(f"{root} не найден")
+        return
+
+    state_dir = Path(STATE_DIR)
+    state_dir.mkdir(parents=True, exist_ok=True)
+
+    # Пул создаётся до загрузки энкодера: процессы разбора не наследуют его веса
+    pool = mp.get_context("fork").Pool(PARSE_WORKERS)
+    search = SearchSystem(model=ENCODER_MODEL, device=DEVICE, precision=PRECISION)
+    if output.exists():
+        search.load(output)
+    indexed = {p["source"] for p in search.index.payloads}
+
+    files = scan(root)
+    manifest = read_manifest(state_dir)
+    # Повторно разбираются новые, изменённые, упавшие в прошлый раз и пропавшие из индекса файлы
+    todo = [
+        (source, str(path), file_key(path))
+        for source, path in files.items()
+        if not is_done(manifest.get(source), file_key(path), indexed)
+    ]
+    print(f"1/3 Файлов: {len(files)}, готово с прошлых запусков: {len(files) - len(todo)}, к разбору: {len(todo)}, "
+          f"в индексе {output}: {len(indexed)} файлов")
+
+    print(f"2/3 Разбор ({PARSE_WORKERS} процессов) и кодирование (батчи по {ENCODE_BATCH_SIZE})")
+    start = time.time()
+    number = next_shard(state_dir)
+    done_files = done_chunks = failed = 0
+    pending_entries, pending_chunks = [], []
+
+    def flush():
+        nonlocal number, done_files, done_chunks
+        if pending_entries:
+            if write_shard(state_dir, number, search, pending_entries, pending_chunks):
+                number += 1
+            done_files += len(pending_entries)
+            done_chunks += len(pending_chunks)
+            pending_entries.clear()
+            pending_chunks.clear()
+
+            elapsed = time.time() - start
+            print(f"  {done_files + failed}/{len(todo)} файлов: {done_files / elapsed:.2f} файл/с, "
+                  f"{done_chunks / elapsed:.1f} чанк/с")
+
+    # Кодирование идёт в этом процессе, пока пул разбирает следующие файлы
+    for entry, chunks in pool.imap_unordered(parse_one, todo):
+        manifest[entry["source"]] = entry
+        if entry["error"] is not None:
+            failed += 1
+            print(f"  Ошибка {entry['path']}: {entry['error']}")
+            append_manifest(state_dir, [entry])
+            continue
+
+        pending_entries.append(entry)
+        pending_chunks.extend(chunks)
+        if len(pending_chunks) >= SHARD_CHUNKS:
+            flush()
+    flush()
+    pool.close()
+    pool.join()
+
+    elapsed = max(time.time() - start, 1e-9)
+    print(f"Разобрано {done_files} файлов ({failed} с ошибкой), {done_chunks} чанков за {elapsed:.1f} сек: "
+          f"{done_files / elapsed:.2f} файл/с, {done_chunks / elapsed:.1f} чанк/с")
+
+    print("3/3 Построение индекса")
+    start = time.time()
+    merged = build(state_dir, manifest, files, search)
+    if not merged:
+        print(f"Новых файлов нет, {output} не изменён")
+        return
+    if not search.index.payloads:
+        print("Нет чанков для индекса")
+        return
+
+    # Запись через временный файл: прерванное сохранение не портит прежний индекс
+    output.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = f"{output}.tmp"
+    search.save(tmp_path)
+    os.replace(tmp_path, output)
+
+    # Чанки шардов теперь в индексе: журнал без ссылок на шарды, затем шарды удаляются.
+    # Прерванный до этого запуск вольёт те же шарды повторно — результат тот же
+    compact_manifest(state_dir, manifest)
+    for shard in state_dir.glob("shard-*.pkl"):
+        shard.unlink()
+
+    payloads = search.index.payloads
+    print(f"Индекс: {merged} файлов влито, всего {len(payloads)} чанков из {len({p['source'] for p in payloads})} "
+          f"файлов, сохранён в {output} за {time.time() - start:.1f} сек")
+
+
+if __name__ == "__main__":
+    main()
@@ -42,12 +42,11 @@ def smart_search_chunk(searchSystem: SearchSystem, reranker: Reranker, question:
                 "source": chunk["payload"]["source"],
                 "chunkIDs": chunk_ids,
                 "texts": texts,
+                "hybrid_score": chunk["score"],
             }
         )
-    # Получение лучших чанков(с контекстом)
-    reranker_output = reranker.rerank_results(question, filter_result, 5, 0.0)
-
-    return reranker_output
+    # Получение лучших чанков(с контекстом): уверенные лидеры пропускают cross-encoder
+    return reranker.rerank_results_cascade(question, filter_result, 5, 0.0)
 
 
 # ==============================
@@ -75,6 +74,7 @@ def main():
     # ============================== ОБРАБОТКА ===============================
     start_processing = time.time()
     total_questions = 0
+    total_full_fraction = 0.0
     with (
         open("test_file/input.csv", newline="", encoding="utf-8") as f_in,
         open("output.csv", "w", newline="", encoding="utf-8") as f_out,
@@ -89,7 +89,8 @@ def main():
             question = row["question"]
 
             # Нахождение нужных чанков
-            top_k_chunks = smart_search_chunk(searchSystem, reranker, question)
+            top_k_chunks, rerank_stats = smart_search_chunk(searchSystem, reranker, question)
+            total_full_fraction += rerank_stats["full_fraction"]
 
             # Генерация отвера по чанкам
             context = ""
@@ -113,6 +114,7 @@ def main():
     print(f"Всего вопросов:      {total_questions}")
     print(f"Время обработки:     {total_processing_time:.1f} сек")
     print(f"Средняя скорость:    {avg_speed:.2f} вопросов в секунду")
+    print(f"Доля полного rerank: {total_full_fraction / total_questions:.2f}")
     print(f"Общее время:         {total_time:.1f} сек")
     print("ГОТОВО! output.csv сохранён.")
 
@@ -0,0 +1,124 @@
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+
+# ======================= ANSWER CACHE =======================
+class AnswerCache:
+    """
+    Семантический кэш ответов /chat/answer.
+    Точный ключ: множество (source, chunkHash) в контексте, флаг separate_conflicts
+    и хэш истории чата; внутри ключа вопрос ищется по косинусной близости эмбеддингов.
+    Записи удаляются при обновлении или удалении любого процитированного source.
+    Каждая инвалидация увеличивает version: ответ, найденный по индексу до неё (version при retrieval
+    не совпадает с текущей), не сохраняется.
+    """
+
+    def __init__(self, threshold=0.95, max_entries=1024):
+        self.threshold = threshold
+        self.max_entries = max_entries
+
+        self.entries = OrderedDict()   # entry_id -> entry
+        self.by_key = {}               # exact key -> [entry_id]
+        self.by_source = {}            # source -> {entry_id}
+        self.next_id = 0
+        self.version = 0
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.invalidated = 0
+        self.stale = 0
+
+    @staticmethod
+    def make_key(chunk_ids, separate_conflicts, history_key=""):
+        return frozenset(chunk_ids), bool(separate_conflicts), history_key
+
+    # ======================= GET =======================
+    def get(self, key, q_emb):
+        with self.lock:
+            best_id, best_sim = None, self.threshold
+            for entry_id in self.by_key.get(key, []):
+                sim = float(np.dot(self.entries[entry_id]["q_emb"], q_emb))
+                if sim >= best_sim:
+                    best_id, best_sim = entry_id, sim
+
+            if best_id is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(best_id)
+            return self.entries[best_id]["value"]
+
+    # ======================= PUT =======================
+    def current_version(self):
+        with self.lock:
+            return self.version
+
+    def put(self, key, q_emb, value, version=None):
+        """version — current_version() на момент retrieval; если с тех пор была инвалидация, ответ не сохраняется."""
+        sources = {source for source, _ in key[0]}
+
+        with self.lock:
+            if version is not None and version != self.version:
+                self.stale += 1
+                return False
+
+            entry_id = self.next_id
+            self.next_id += 1
+
+            self.entries[entry_id] = {"key": key, "q_emb": np.asarray(q_emb), "value": value, "sources": sources}
+            self.by_key.setdefault(key, []).append(entry_id)
+            for source in sources:
+                self.by_source.setdefault(source, set()).add(entry_id)
+
+            while len(self.entries) > self.max_entries:
+                old_id = next(iter(self.entries))
+                self._remove(old_id)
+            return True
+
+    def _remove(self, entry_id):
+        entry = self.entries.pop(entry_id)
+
+        ids = self.by_key.get(entry["key"], [])
+        if entry_id in ids:
+            ids.remove(entry_id)
+        if not ids:
+            self.by_key.pop(entry["key"], None)
+
+        for source in entry["sources"]:
+            refs = self.by_source.get(source)
+            if refs is not None:
+                refs.discard(entry_id)
+                if not refs:
+                    del self.by_source[source]
+
+    # ======================= INVALIDATE =======================
+    def invalidate_source(self, source):
+        with self.lock:
+            self.version += 1
+            entry_ids = list(self.by_source.get(source, ()))
+            for entry_id in entry_ids:
+                self._remove(entry_id)
+            self.invalidated += len(entry_ids)
+            return len(entry_ids)
+
+    def record_bypass(self):
+        with self.lock:
+            self.bypassed += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "bypassed": self.bypassed,
+                "invalidated": self.invalidated,
+                "stale": self.stale,
+            }
@@ -0,0 +1,120 @@
+import re
+
+import numpy as np
+
+from object.GenChunk import tokenize_len, select_span_chunks
+
+
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?…])\s+(?=[A-ZА-ЯЁ0-9«\"(])")
+
+
+def is_table_row(line):
+    return "\t" in line or line.startswith("|")
+
+
+def split_units(text):
+    """
+    Делит текст чанка на единицы отбора: строки таблиц целиком, обычный текст — на предложения.
+    """
+    units = []
+    for line in text.split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+        if is_table_row(line):
+            units.append(line)
+        else:
+            units.extend(s for s in SENTENCE_SPLIT.split(line) if s.strip())
+    return units
+
+
+def join_units(units):
+    text = ""
+    for u in units:
+        if text:
+            text += "\n" if is_table_row(u) else " "
+        text += u
+    return text
+
+
+# ======================= CONTEXT COMPRESSOR =======================
+class ContextCompressor:
+    """
+    Экстрактивное сжатие контекста: предложения и строки таблиц внутри спанов
+    оцениваются по близости к эмбеддингу вопроса, остаются только лучшие.
+    encoder — тот же SentenceTransformer, что в SearchSystem.
+    """
+
+    def __init__(self, encoder, ratio=0.3, max_tokens=None, batch_size=64):
+        self.encoder = encoder
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.batch_size = batch_size
+
+    def compress(self, spans, q_emb):
+        """
+        spans — выход Reranker ({"source", "chunkIDs", "texts", ...}),
+        q_emb — нормализованный эмбеддинг вопроса (SearchSystem.encode_query).
+        Возвращает (spans, stats); порядок предложений внутри чанков сохраняется.
+        """
+        # (номер спана, номер чанка, текст)
+        units = []
+        for si, span in enumerate(spans):
+            for ci, text in enumerate(span["texts"]):
+                units.extend((si, ci, u) for u in split_units(text))
+
+        tokens_before = sum(tokenize_len(u) for _, _, u in units)
+        stats = {"units": len(units), "units_kept": len(units), "tokens_before": tokens_before,
+                 "tokens_after": tokens_before}
+        if not units:
+            return spans, stats
+
+        limit = int(tokens_before * self.ratio)
+        if self.max_tokens is not None:
+            limit = min(limit, self.max_tokens)
+
+        vectors = self.encoder.encode(
+            [u for _, _, u in units],
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        )
+        scores = vectors @ np.asarray(q_emb, dtype=vectors.dtype)
+        order = np.argsort(-scores)
+
+        # Лучшая единица каждого спана остаётся всегда — спан уже выбран reranker
+        keep = set()
+        seen_spans = set()
+        for i in order:
+            if units[i][0] not in seen_spans:
+                seen_spans.add(units[i][0])
+                keep.add(int(i))
+
+        used = sum(tokenize_len(units[i][2]) for i in keep)
+        for i in order:
+            i = int(i)
+            if i in keep:
+                continue
+            size = tokenize_len(units[i][2])
+            if used + size > limit:
+                continue
+            keep.add(i)
+            used += size
+
+        # Собираем чанки обратно в исходном порядке
+        kept_units = {}
+        for i in sorted(keep):
+            si, ci, u = units[i]
+            kept_units.setdefault((si, ci), []).append(u)
+
+        result = []
+        for si, span in enumerate(spans):
+            chunk_idx = [ci for ci in range(len(span["texts"])) if (si, ci) in kept_units]
+            result.append(select_span_chunks(
+                span, chunk_idx,
+                texts=[join_units(kept_units[(si, ci)]) for ci in chunk_idx]
+            ))
+
+        stats["units_kept"] = len(keep)
+        stats["tokens_after"] = used
+        return result, stats
@@ -0,0 +1,81 @@
+from object.GenChunk import select_span_chunks
+
+
+# ======================= CONTEXT PACKER =======================
+class ContextPacker:
+    """
+    Укладывает спаны контекста ({"source", "chunkIDs", "texts", ...}) в бюджет
+    токенов промпта LLM. Спаны идут в порядке reranker (лучшие первыми),
+    поэтому обрезаются и выбрасываются в первую очередь наименее ценные.
+    """
+
+    def __init__(self, tokenizer, prompt_budget=3072, min_trim_tokens=32, count_chunk=None):
+        self.tokenizer = tokenizer
+        self.prompt_budget = prompt_budget
+        # Меньше этого остаток чанка не обрезаем, а выбрасываем целиком
+        self.min_trim_tokens = min_trim_tokens
+        # Размер чанка в промпте (LLM.count_context_tokens — из TokenStore без токенизации)
+        self.count_chunk = count_chunk or self.count
+
+    def count(self, text) -> int:
+        return len(self.tokenizer(text, add_special_tokens=False).input_ids)
+
+    def _trim(self, text, max_tokens):
+        ids = self.tokenizer(text, add_special_tokens=False).input_ids[:max_tokens]
+        return self.tokenizer.decode(ids, skip_special_tokens=True)
+
+    # ======================= PACK =======================
+    def pack(self, spans, reserved_tokens=0):
+        """
+        reserved_tokens — токены промпта без контекста (системный промпт, история, вопрос).
+        Возвращает (packed_spans, stats).
+        """
+        budget = max(0, self.prompt_budget - reserved_tokens)
+        left = budget
+
+        packed = []
+        stats = {
+            "budget": budget,
+            "reserved": reserved_tokens,
+            "tokens_used": 0,
+            "tokens_dropped": 0,
+            "spans_trimmed": 0,
+            "spans_dropped": 0,
+        }
+
+        for span in spans:
+            header = self.count(f"Файл: {span['source']}\n")
+            sizes = [self.count_chunk(t) for t in span["texts"]]
+
+            if header + sum(sizes) <= left:
+                packed.append(span)
+                left -= header + sum(sizes)
+                stats["tokens_used"] += header + sum(sizes)
+                continue
+
+            # Спан не влезает целиком — берём его начало
+            keep_texts = []
+            room = left - header
+            for text, size in zip(span["texts"], sizes):
+                if size <= room:
+                    keep_texts.append(text)
+                    room -= size
+                elif room >= self.min_trim_tokens:
+                    keep_texts.append(self._trim(text, room))
+                    room = 0
+                    break
+                else:
+                    break
+
+            if keep_texts:
+                used = left - room
+                packed.append(select_span_chunks(span, range(len(keep_texts)), texts=keep_texts, trimmed=True))
+                left -= used
+                stats["tokens_used"] += used
+                stats["tokens_dropped"] += header + sum(sizes) - used
+                stats["spans_trimmed"] += 1
+            else:
+                stats["tokens_dropped"] += header + sum(sizes)
+                stats["spans_dropped"] += 1
+
+        return packed, stats
@@ -0,0 +1,171 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+
+
+class StageBusy(Exception):
+    """Очередь стадии заполнена — клиенту 429 + Retry-After."""
+
+    def __init__(self, stage, retry_after):
+        super().__init__(f"stage '{stage}' queue is full")
+        self.stage = stage
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        # Передаётся из процесса-писателя serve.py в воркер
+        return type(self), (self.stage, self.retry_after)
+
+
+class StageTimeout(Exception):
+    """Запрос не уложился в свой таймаут — клиенту 503 + Retry-After."""
+
+    def __init__(self, stage, retry_after):
+        super().__init__(f"stage '{stage}' timed out")
+        self.stage = stage
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        return type(self), (self.stage, self.retry_after)
+
+
+# ======================= STAGE EXECUTOR =======================
+class StageExecutor:
+    """
+    Пул потоков одной стадии (ingestion, retrieval, nli, generation) с ограниченной очередью.
+    workers задач выполняются, ещё max_queue ждут; сверх этого submit сразу бросает StageBusy,
+    вместо того чтобы копить работу, которая всё равно не успеет.
+    """
+
+    def __init__(self, name, workers=1, max_queue=16, retry_after=5):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"stage-{name}")
+        self.slots = BoundedSemaphore(workers + max_queue)
+
+        self.lock = Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    # ======================= SUBMIT =======================
+    def submit(self, fn, *args, **kwargs):
+        """Ставит fn в очередь стадии; возвращает asyncio.Future (вызывать из event loop)."""
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise StageBusy(self.name, self.retry_after)
+
+        with self.lock:
+            self.pending += 1
+        future = self.pool.submit(fn, *args, **kwargs)
+        # Слот освобождается и при отмене задачи, которая ещё не начала выполняться
+        future.add_done_callback(self._release)
+        return asyncio.wrap_future(future)
+
+    def _release(self, future):
+        self.slots.release()
+        with self.lock:
+            self.pending -= 1
+            self.completed += 1
+
+    async def run(self, fn, *args, timeout=None, **kwargs):
+        """
+        submit + ожидание результата не дольше timeout секунд.
+        Отменяется только ещё не начатая задача: начатая работа дорабатывает в пуле.
+        """
+        future = self.submit(fn, *args, **kwargs)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            with self.lock:
+                self.timed_out += 1
+            raise StageTimeout(self.name, self.retry_after) from None
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "pending": self.pending,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+            }
+
+
+# ======================= STAGE GRAPH =======================
+class StageGraph:
+    """
+    Граф стадий одного запроса: каждая стадия — задача asyncio в своём StageExecutor,
+    независимые стадии выполняются одновременно. after — стадии, от результатов которых
+    зависит эта (для критического пути); ожидание результатов — в вызывающем коде.
+    Все стадии укладываются в общий дедлайн запроса.
+    """
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.origin = time.monotonic()
+        self.tasks = {}
+        self.after = {}
+        self.timings = {}
+        self.cancelled = set()
+
+    def remaining(self):
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+    def add(self, name, executor, fn, *args, after=()):
+        """Запускает fn(*args) в executor; возвращает asyncio.Task с результатом."""
+        async def stage():
+            start = time.monotonic() - self.origin
+            try:
+                return await executor.run(fn, *args, timeout=self.remaining())
+            finally:
+                self.timings[name] = (start, time.monotonic() - self.origin)
+
+        self.after[name] = tuple(after)
+        self.tasks[name] = asyncio.ensure_future(stage())
+        return self.tasks[name]
+
+    def cancel(self, name):
+        self.cancelled.add(name)
+        self.tasks[name].cancel()
+
+    def close(self):
+        """Отменяет незавершённые стадии (ошибка или ранний ответ)."""
+        for name, task in self.tasks.items():
+            if not task.done():
+                self.cancel(name)
+            elif not task.cancelled():
+                # Ошибка стадии, результат которой уже не нужен, не должна всплыть в лог asyncio
+                task.exception()
+
+    # ======================= TIMINGS =======================
+    def report(self):
+        """
+        Время стадий от начала запроса и критический путь: от стадии, закончившейся последней,
+        назад по зависимостям, завершившимся позже всех.
+        """
+        stages = {
+            name: {"start": start, "end": end, "duration": end - start, "cancelled": name in self.cancelled}
+            for name, (start, end) in self.timings.items()
+        }
+
+        done = [n for n in stages if not stages[n]["cancelled"]]
+        path = []
+        name = max(done, key=lambda n: stages[n]["end"]) if done else None
+        while name is not None:
+            path.append(name)
+            deps = [d for d in self.after.get(name, ()) if d in stages]
+            name = max(deps, key=lambda d: stages[d]["end"]) if deps else None
+
+        path.reverse()
+        return {
+            "stages": stages,
+            "critical_path": path,
+            "critical_path_time": stages[path[-1]]["end"] if path else 0.0,
+        }
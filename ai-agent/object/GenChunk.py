@@ -19,8 +19,12 @@ def merge_chunks_by_source(chunks):
 
     for ch in chunks:
         source = ch["source"]
-        grouped[source]["chunkIDs"].extend(ch.get("chunkID", []))
-        grouped[source]["texts"].extend(ch.get("text", []))
+        for chunk_id, text in zip(ch.get("chunkIDs", []), ch.get("texts", [])):
+            # один и тот же чанк мог попасть в несколько окон — берём один раз
+            if chunk_id in grouped[source]["chunkIDs"]:
+                continue
+            grouped[source]["chunkIDs"].append(chunk_id)
+            grouped[source]["texts"].append(text)
 
     # Превращаем в список и сортируем по source
     result = []
@@ -33,6 +37,80 @@ def merge_chunks_by_source(chunks):
     return result
 
 
+def span_list_keys(span):
+    """Поля спана-списки, выровненные с chunkIDs (texts, chunkHashes, ...)."""
+    n = len(span["chunkIDs"])
+    return [k for k, v in span.items() if isinstance(v, list) and len(v) == n]
+
+
+def select_span_chunks(span, indices, **overrides):
+    """Копия спана только с чанками indices (все выровненные поля фильтруются вместе)."""
+    selected = {**span}
+    for k in span_list_keys(span):
+        selected[k] = [span[k][i] for i in indices]
+    selected.update(overrides)
+    return selected
+
+
+def coalesce_context_windows(windows, score_key="hybrid_score"):
+    """
+    Объединяет пересекающиеся окна контекста одного source
+    ({"source", "chunkIDs", "texts", ...}) в непрерывные спаны.
+    Поля-списки, выровненные с chunkIDs, объединяются поэлементно,
+    у спана остаётся лучший score_key.
+
+    Возвращает (spans, stats), stats["tokens_saved"] — сколько токенов
+    (слов) не придётся повторно отдавать reranker/NLI/LLM.
+    """
+    by_source = defaultdict(list)
+    for w in windows:
+        if w.get("chunkIDs"):
+            by_source[w["source"]].append(w)
+
+    def merge(span, w):
+        keys = [k for k in span_list_keys(w) if k in span]
+        items = {cid: i for i, cid in enumerate(span["chunkIDs"])}
+        rows = [(cid, {k: span[k][i] for k in keys}) for cid, i in items.items()]
+        for i, cid in enumerate(w["chunkIDs"]):
+            if cid not in items:
+                rows.append((cid, {k: w[k][i] for k in keys}))
+        rows.sort(key=lambda r: r[0])
+
+        merged = {**span}
+        for k in keys:
+            merged[k] = [row[k] for _, row in rows]
+        if score_key in w:
+            merged[score_key] = max(span.get(score_key, w[score_key]), w[score_key])
+        merged["windows"] = span.get("windows", 1) + 1
+        return merged
+
+    spans = []
+    for source, group in by_source.items():
+        group = sorted(group, key=lambda w: min(w["chunkIDs"]))
+        current = None
+        for w in group:
+            if current is not None and min(w["chunkIDs"]) <= max(current["chunkIDs"]):
+                current = merge(current, w)
+            else:
+                if current is not None:
+                    spans.append(current)
+                current = {**w, "windows": 1}
+        spans.append(current)
+
+    spans.sort(key=lambda sp: sp.get(score_key, 0.0), reverse=True)
+
+    tokens_before = sum(tokenize_len(t) for w in windows for t in w.get("texts", []))
+    tokens_after = sum(tokenize_len(t) for sp in spans for t in sp["texts"])
+    stats = {
+        "windows": len(windows),
+        "spans": len(spans),
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+        "tokens_saved": tokens_before - tokens_after,
+    }
+    return spans, stats
+
+
 def tokenize_len(text: str) -> int:
     """Простейший токенайзер: считает слова."""
     return len(text.split())
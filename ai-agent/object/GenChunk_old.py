@@ -1,8 +1,31 @@
 import hashlib
+from pathlib import Path
+
 import nltk
+
+# punkt_tab кладётся в ai-agent/nltk_data при сборке образа (Dockerfile): на старте ничего не скачивается
+NLTK_DATA = Path(__file__).resolve().parent.parent / "nltk_data"
+nltk.data.path.insert(0, str(NLTK_DATA))
+
+
+def punkt_available() -> bool:
+    try:
+        nltk.data.find("tokenizers/punkt_tab/english/")
+        return True
+    except LookupError:
+        return False
+
+
+# Без punkt_tab границы предложений и слов, а значит чанки и их хэши, были бы другими,
+# чем в образе: запуск останавливается, а не режет текст иначе
+if not punkt_available():
+    raise LookupError(
+        f"NLTK punkt_tab не найден ни в {NLTK_DATA}, ни в каталогах NLTK_DATA. "
+        f"Скачайте его из каталога ai-agent: python -m nltk.downloader -d nltk_data punkt_tab"
+    )
+
 from nltk.tokenize import sent_tokenize, word_tokenize
 
-nltk.download('punkt_tab', quiet=True)
 
 def add_source_and_id(chanks, source):
     for id in range(len(chanks)):
@@ -0,0 +1,166 @@
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Thread
+
+from object.Executors import StageBusy
+
+JOB_STATES = ("queued", "parsing", "embedding", "indexed", "failed")
+
+
+class SourceConflict(ValueError):
+    """Задача противоречит индексу: загружаемый файл уже есть или изменяемого / удаляемого нет."""
+
+
+# ======================= INGESTION QUEUE =======================
+class IngestionQueue:
+    """
+    Фоновая индексация загруженных файлов: submit сразу возвращает задачу, её состояние — get(job_id).
+
+    prepare(job, set_state) — разбор, чанки и эмбеддинги в пуле из workers потоков (индекс не меняется);
+    apply(job, prepared) -> source — изменение индекса, по одной задаче в порядке submit;
+    commit(sources) — одна перестройка и публикация индекса на все задачи, готовые к этому моменту.
+    Задачи, подготовленные за coalesce_delay секунд, попадают в одну публикацию.
+    """
+
+    def __init__(self, prepare, apply, commit, workers=2, max_pending=32, coalesce_delay=1.0,
+                 keep_finished=1000, retry_after=30):
+        self.prepare = prepare
+        self.apply = apply
+        self.commit = commit
+        self.workers = workers
+        self.max_pending = max_pending
+        self.coalesce_delay = coalesce_delay
+        self.keep_finished = keep_finished
+        self.retry_after = retry_after
+
+        self.cond = Condition()
+        self.jobs = OrderedDict()    # job_id -> задача (и завершённые, последние keep_finished)
+        self.pending = deque()       # незавершённые задачи в порядке submit
+        self.prepared = {}           # job_id -> результат prepare
+        self.commits = 0
+
+        # Потоки запускаются при первой задаче: в serve.py очередь работает в родителе уже после fork
+        self.pool = None
+
+    def _start(self):
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ingestion")
+        Thread(target=self._index_loop, name="ingestion-index", daemon=True).start()
+
+    # ======================= SUBMIT =======================
+    def submit(self, op, filename, source, payload=None):
+        """Ставит задачу в очередь; при max_pending незавершённых задач — StageBusy."""
+        now = time.time()
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "op": op,
+            "filename": filename,
+            "source": source,
+            "payload": payload,
+            "state": "queued",
+            "error": None,
+            "created": now,
+            "updated": now,
+            "timings": {"queued": 0.0},
+            "done": False,
+        }
+
+        with self.cond:
+            if len(self.pending) >= self.max_pending:
+                raise StageBusy("ingestion", self.retry_after)
+            if self.pool is None:
+                self._start()
+            self.jobs[job["job_id"]] = job
+            self.pending.append(job)
+
+        self.pool.submit(self._prepare, job)
+        return self._public(job)
+
+    def _set_state(self, job, state, error=None):
+        with self.cond:
+            job["state"] = state
+            job["error"] = error
+            job["updated"] = time.time()
+            job["timings"][state] = job["updated"] - job["created"]
+
+    def _prepare(self, job):
+        try:
+            prepared = self.prepare(job, lambda state: self._set_state(job, state))
+        except Exception as e:
+            prepared = None
+            self._set_state(job, "failed", str(e))
+
+        with self.cond:
+            self.prepared[job["job_id"]] = prepared
+            job["done"] = True
+            self.cond.notify_all()
+
+    # ======================= INDEX =======================
+    def _ready_count(self):
+        # Индекс меняется строго в порядке submit: берётся только готовый префикс очереди
+        count = 0
+        for job in self.pending:
+            if not job["done"]:
+                break
+            count += 1
+        return count
+
+    def _index_loop(self):
+        while True:
+            with self.cond:
+                while not self._ready_count():
+                    self.cond.wait()
+
+            # Задачи, которые успеют подготовиться за это время, войдут в ту же публикацию
+            time.sleep(self.coalesce_delay)
+
+            with self.cond:
+                batch = [self.pending.popleft() for _ in range(self._ready_count())]
+                prepared = [self.prepared.pop(job["job_id"]) for job in batch]
+
+            applied, sources = [], []
+            for job, data in zip(batch, prepared):
+                if job["state"] == "failed":
+                    continue
+                try:
+                    sources.append(self.apply(job, data))
+                    applied.append(job)
+                except Exception as e:
+                    self._set_state(job, "failed", str(e))
+
+            if applied:
+                try:
+                    self.commit(sources)
+                    for job in applied:
+                        self._set_state(job, "indexed")
+                except Exception as e:
+                    for job in applied:
+                        self._set_state(job, "failed", str(e))
+
+            with self.cond:
+                self.commits += bool(applied)
+                for job in batch:
+                    job["payload"] = None
+                finished = [i for i, job in self.jobs.items() if job["state"] in ("indexed", "failed")]
+                for job_id in finished[:max(0, len(finished) - self.keep_finished)]:
+                    del self.jobs[job_id]
+
+    # ======================= STATUS =======================
+    @staticmethod
+    def _public(job):
+        public = {k: v for k, v in job.items() if k not in ("payload", "done")}
+        public["timings"] = dict(job["timings"])
+        return public
+
+    def get(self, job_id):
+        with self.cond:
+            job = self.jobs.get(job_id)
+            return self._public(job) if job is not None else None
+
+    def stats(self):
+        with self.cond:
+            states = {state: 0 for state in JOB_STATES}
+            for job in self.jobs.values():
+                states[job["state"]] += 1
+            return {"pending": len(self.pending), "commits": self.commits, "states": states}
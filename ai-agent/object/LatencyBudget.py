@@ -0,0 +1,62 @@
+import time
+from collections import Counter
+from itertools import combinations
+from threading import Lock
+
+
+def nli_pairs(chunks):
+    """Сколько пар чанков сравнит LogicalRelationship.build_document_conflict_matrix."""
+    counts = Counter(c["source"] for c in chunks)
+    return sum(a * b for a, b in combinations(counts.values(), 2))
+
+
+# ======================= STAGE COSTS =======================
+class StageCosts:
+    """
+    Скользящее среднее (EWMA) стоимости единицы работы стадий, сек:
+    retrieval — на кандидата rerank, nli — на пару чанков, generation — на токен ответа.
+    priors — оценки до первых наблюдений.
+    """
+
+    def __init__(self, priors, alpha=0.2):
+        self.costs = dict(priors)
+        self.alpha = alpha
+        self.lock = Lock()
+
+    def observe(self, stage, seconds, units):
+        if units <= 0:
+            return
+        with self.lock:
+            self.costs[stage] = (1 - self.alpha) * self.costs[stage] + self.alpha * seconds / units
+
+    def estimate(self, stage, units):
+        with self.lock:
+            return self.costs[stage] * units
+
+    def stats(self):
+        with self.lock:
+            return dict(self.costs)
+
+
+# ======================= LATENCY BUDGET =======================
+class LatencyBudget:
+    """
+    Бюджет времени одного запроса. Перед стадиями вызывающий код сверяет оценку оставшейся
+    работы (StageCosts) с остатком бюджета и по шагам включает деградации;
+    applied — список включённых шагов для ответа.
+    """
+
+    def __init__(self, seconds, costs):
+        self.seconds = seconds
+        self.deadline = time.monotonic() + seconds
+        self.costs = costs
+        self.applied = []
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+    def fits(self, seconds):
+        return seconds <= self.remaining()
+
+    def apply(self, step, value):
+        self.applied.append({"step": step, "value": value})
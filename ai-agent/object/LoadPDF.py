@@ -1,8 +1,46 @@
 import fitz
 import re
-import io
+import os
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 import pytesseract
+from collections import deque
+
+from object.OcrEngine import OcrEngine
+
+# tesserocr (libtesseract без CLI) получает сырые пиксели; без него — pytesseract
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+# Страницы большого PDF разбираются параллельно: диапазоны по PDF_PAGES_PER_TASK страниц уходят
+# в пул из PDF_WORKERS процессов, каждый открывает документ сам; результаты склеиваются по порядку страниц.
+# Документы короче PDF_PARALLEL_MIN_PAGES страниц разбираются в текущем процессе
+PDF_WORKERS = len(os.sched_getaffinity(0))
+PDF_PAGES_PER_TASK = 16
+PDF_PARALLEL_MIN_PAGES = 32
+
+# Скан рендерится один раз в оттенках серого (tesseract всё равно работает с яркостью):
+# OCR текста и таблиц читают один буфер pixmap без PNG
+OCR_DPI = 300
+OCR_LANG = "rus+eng"
+# Режимы PIL для числа каналов pixmap
+PIX_MODES = {1: "L", 2: "LA", 3: "RGB", 4: "RGBA"}
+
+# tesseract — в пуле OcrEngine из OCR_WORKERS процессов; результаты кэшируются в OCR_CACHE
+# по хэшу пикселей страницы / зоны, языку и PSM. Сканов в очереди не больше OCR_INFLIGHT_PAGES страниц
+OCR_WORKERS = len(os.sched_getaffinity(0))
+OCR_CACHE = "./SearchStartData/ocr_cache.sqlite"
+OCR_INFLIGHT_PAGES = 2 * OCR_WORKERS
+
+_POOL = None
+_TESSEROCR = threading.local()
+_OCR_ENGINE = None
+# Процесс пула страниц parse_pdf: страницы уже параллельны, OCR — в нём самом
+_IN_PAGE_POOL = False
 
 
 def clean_text(text: str):
@@ -13,27 +51,76 @@ def clean_text(text: str):
     return text.strip()
 
 
-def ocr_image(pix, table_mode=False):
-    """OCR изображения.
+def render_page(page):
+    return page.get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY, alpha=False)
+
+
+def recognize(rows, width, height, channels, stride, psm, lang):
+    """tesseract по сырым строкам пикселей (выполняется в процессе пула OcrEngine)."""
+    if tesserocr is None:
+        # pytesseract передаёт изображение CLI через временный файл — единственное кодирование
+        mode = PIX_MODES[channels]
+        image = Image.frombuffer(mode, (width, height), rows, "raw", mode, stride, 1)
+        return pytesseract.image_to_string(image, lang=lang, config=f"--psm {psm}")
+
+    # PyTessBaseAPI не потокобезопасен: свой на поток
+    api = getattr(_TESSEROCR, "api", None)
+    if api is None:
+        api = _TESSEROCR.api = tesserocr.PyTessBaseAPI(lang=lang)
+    api.SetPageSegMode(psm)
+    api.SetImageBytes(bytes(rows), width, height, channels, stride)
+    # SetImageBytes не знает DPI страницы: без него tesseract берёт разрешение по умолчанию
+    api.SetSourceResolution(OCR_DPI)
+    return api.GetUTF8Text()
+
+
+def ocr_engine():
+    global _OCR_ENGINE
+    # После fork (пул ingest.py) движок и соединение с кэшем родителя не используются
+    if _OCR_ENGINE is None or _OCR_ENGINE[0] != os.getpid():
+        # В daemon-процессах (пул ingest.py) и в пуле страниц свой пул не создаётся: они уже параллельны
+        inline = _IN_PAGE_POOL or mp.current_process().daemon
+        _OCR_ENGINE = os.getpid(), OcrEngine(recognize, cache_path=OCR_CACHE, workers=0 if inline else OCR_WORKERS,
+                                             lang=OCR_LANG)
+    return _OCR_ENGINE[1]
+
+
+def ocr_stats():
+    if _OCR_ENGINE is None:
+        return None
+    return {**_OCR_ENGINE[1].stats(), "backend": "tesserocr" if tesserocr is not None else "pytesseract"}
+
+
+def submit_ocr(pix, table_mode=False, y0=0, y1=None):
+    """Задача OCR строк [y0, y1) pixmap в OcrEngine; Future с текстом."""
+    y1 = pix.height if y1 is None else y1
+    psm = 6 if table_mode else 3
+    rows = pix.samples_mv[y0 * pix.stride:y1 * pix.stride]
+    return ocr_engine().submit(rows, pix.width, y1 - y0, pix.n, pix.stride, psm)
+
+
+def ocr_image(pix, table_mode=False, y0=0, y1=None):
+    """OCR изображения (строк [y0, y1) pixmap).
     table_mode=True → лучше для таблиц.
     """
-    img_bytes = pix.tobytes("png")
-    img = Image.open(io.BytesIO(img_bytes))
+    return clean_text(submit_ocr(pix, table_mode, y0, y1).result())
 
-    config = "--psm 6" if table_mode else "--psm 3"
-    text = pytesseract.image_to_string(img, lang="rus+eng", config=config)
 
-    return clean_text(text)
+def text_blocks(page):
+    """Текстовые layout-блоки страницы (x0, y0, x1, y1, text) — одно извлечение на страницу."""
+    # (x0, y0, x1, y1, text, block_no, block_type); block_type 1 — изображение
+    return [b[:5] for b in page.get_text("blocks") if b[6] == 0]
 
 
-def detect_table_candidates(page, min_width=80, min_height=40):
+def detect_table_candidates(page, min_width=80, min_height=40, blocks=None):
     """Выделяем блоки-кандидаты под таблицы в обычном PDF (не сканах).
-    Используем layout-блоки PDF.
+    Используем layout-блоки PDF (blocks — уже извлечённые text_blocks).
     """
     tables = []
-    blocks = page.get_text("blocks")  # (x0, y0, x1, y1, text, block_no)
+    if blocks is None:
+        blocks = text_blocks(page)
     for b in blocks:
-        x0, y0, x1, y1, txt, _ = b
+        x0, y0, x1, y1, txt = b
         w, h = x1 - x0, y1 - y0
         txt_clean = clean_text(txt)
 
@@ -48,101 +135,166 @@ def detect_table_candidates(page, min_width=80, min_height=40):
     return tables
 
 
-def extract_table_ocr(page):
-    """OCR таблиц со страницы (сканированный PDF).
-    Выделяем 2-4 крупных блока, делаем OCR в табличном режиме.
-    """
-    pix = page.get_pixmap(dpi=300)
-    img_bytes = pix.tobytes("png")
-    img = Image.open(io.BytesIO(img_bytes))
-
-    width, height = img.size
-    table_candidates = []
-
+def table_regions(pix):
+    width, height = pix.width, pix.height
     # Простая сегментация: делим страницу на 4 зоны и ищем в них таблицы
-    regions = [
+    # (зоны — полосы во всю ширину: срез буфера по строкам)
+    return [
         (0, 0, width, height//2),
         (0, height//2, width, height)
     ]
 
-    for (x0, y0, x1, y1) in regions:
-        crop = img.crop((x0, y0, x1, y1))
-        buf = io.BytesIO()
-        crop.save(buf, format="PNG")
-        crop_pix = fitz.Pixmap(fitz.csRGB, fitz.open("png", buf.getvalue()))
-        text = ocr_image(crop_pix, table_mode=True)
 
+def table_candidates(regions, texts):
+    candidates = []
+    for bbox, text in zip(regions, texts):
+        text = clean_text(text)
         # Эвристика: если похоже на таблицу
         if re.search(r"[|·─—\-]{2,}", text) or len(text.split()) > 20:
-            table_candidates.append({
-                "bbox": (x0, y0, x1, y1),
+            candidates.append({
+                "bbox": bbox,
                 "content": text
             })
+    return candidates
+
 
-    return table_candidates
+def extract_table_ocr(page, pix=None):
+    """OCR таблиц со страницы (сканированный PDF).
+    Выделяем 2-4 крупных блока, делаем OCR в табличном режиме.
+    pix — уже отрендеренная страница (render_page), зоны читаются из её буфера.
+    """
+    if pix is None:
+        pix = render_page(page)
 
+    regions = table_regions(pix)
+    futures = [submit_ocr(pix, table_mode=True, y0=y0, y1=y1) for (_, y0, _, y1) in regions]
+    return table_candidates(regions, [f.result() for f in futures])
 
-def parse_pdf(path):
+
+def submit_scan_page(page):
+    """
+    Скан: OCR текста и зон таблиц ставится в очередь OcrEngine сразу (пиксели копируются в задачи),
+    возвращается функция, которая дождётся результатов и соберёт блоки.
+    """
+    pix = render_page(page)
+    rect = (0, 0, page.rect.width, page.rect.height)
+    text_future = submit_ocr(pix)
+    regions = table_regions(pix)
+    table_futures = [submit_ocr(pix, table_mode=True, y0=y0, y1=y1) for (_, y0, _, y1) in regions]
+
+    def blocks():
+        result = []
+        ocr_txt = clean_text(text_future.result())
+
+        # OCR текста
+        if ocr_txt:
+            result.append({
+                "type": "text",
+                "bbox": rect,
+                "content": ocr_txt,
+                "source": "pdf_ocr"
+            })
+
+        # OCR таблиц
+        for t in table_candidates(regions, [f.result() for f in table_futures]):
+            result.append({
+                "type": "table",
+                "bbox": t["bbox"],
+                "content": t["content"],
+                "source": "ocr_table"
+            })
+        return result
+
+    return blocks
+
+
+def parse_page(page):
+    """Блоки страницы; для скана — функция, которая вернёт их после OCR (submit_scan_page)."""
+    blocks_layout = text_blocks(page)
+    # Тот же текст, что page.get_text("text"): текстовые блоки в том же порядке
+    text_regular = clean_text("\n".join(b[4] for b in blocks_layout))
+
+    # ===== 1. Страница с обычным текстом =====
+    if len(text_regular.replace(" ", "")) > 10:
+
+        # — таблицы из обычного PDF (если есть)
+        table_blocks = detect_table_candidates(page, blocks=blocks_layout)
+
+        blocks = []
+        # Обычный текст — общий блок
+        if text_regular:
+            blocks.append({
+                "type": "text",
+                "bbox": (0, 0, page.rect.width, page.rect.height),
+                "content": text_regular,
+                "source": "pdf_text"
+            })
+
+        # Таблицы добавляем отдельно
+        for t in table_blocks:
+            blocks.append({
+                "type": "table",
+                "bbox": t["bbox"],
+                "content": t["content"],
+                "source": "pdf_table"
+            })
+
+        # сортировка по Y-координате (по порядку появления)
+        blocks.sort(key=lambda b: b["bbox"][1])
+        return blocks
+
+    # ===== 2. Скан → OCR текста и таблиц (в очереди OcrEngine) =====
+    return submit_scan_page(page)
+
+
+def parse_pages(path, start, stop):
+    """Блоки страниц [start, stop); в процессе пула документ открывается заново."""
     doc = fitz.open(path)
-    result = []
+    try:
+        pages, scans = [], deque()
+        for i in range(start, stop):
+            blocks = parse_page(doc[i])
+            if callable(blocks):
+                scans.append(len(pages))
+                # Ограничение очереди: в задачах OCR лежат пиксели страниц
+                if len(scans) > OCR_INFLIGHT_PAGES:
+                    j = scans.popleft()
+                    pages[j] = pages[j]()
+            pages.append(blocks)
 
-    for page in doc:
-        text_regular = clean_text(page.get_text("text"))
+        for j in scans:
+            pages[j] = pages[j]()
+        return [block for blocks in pages for block in blocks]
+    finally:
+        doc.close()
 
-        # ===== 1. Страница с обычным текстом =====
-        if len(text_regular.replace(" ", "")) > 10:
 
-            # — таблицы из обычного PDF (если есть)
-            table_blocks = detect_table_candidates(page)
+def _init_page_pool():
+    global _IN_PAGE_POOL
+    _IN_PAGE_POOL = True
 
-            blocks = []
-            # Обычный текст — общий блок
-            if text_regular:
-                blocks.append({
-                    "type": "text",
-                    "bbox": (0, 0, page.rect.width, page.rect.height),
-                    "content": text_regular,
-                    "source": "pdf_text"
-                })
 
-            # Таблицы добавляем отдельно
-            for t in table_blocks:
-                blocks.append({
-                    "type": "table",
-                    "bbox": t["bbox"],
-                    "content": t["content"],
-                    "source": "pdf_table"
-                })
+def _pool(workers):
+    global _POOL
+    if _POOL is None:
+        # spawn: gateway многопоточен, fork его потоков небезопасен
+        _POOL = ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn"),
+                                    initializer=_init_page_pool)
+    return _POOL
 
-            # сортировка по Y-координате (по порядку появления)
-            blocks.sort(key=lambda b: b["bbox"][1])
-            result.extend(blocks)
-
-        else:
-            # ===== 2. Скан → OCR текста =====
-            pix = page.get_pixmap(dpi=300)
-            ocr_txt = ocr_image(pix)
-
-            # OCR текста
-            if ocr_txt:
-                result.append({
-                    "type": "text",
-                    "bbox": (0, 0, page.rect.width, page.rect.height),
-                    "content": ocr_txt,
-                    "source": "pdf_ocr"
-                })
 
-            # OCR таблиц
-            tables_ocr = extract_table_ocr(page)
-            for t in tables_ocr:
-                result.append({
-                    "type": "table",
-                    "bbox": t["bbox"],
-                    "content": t["content"],
-                    "source": "ocr_table"
-                })
+def parse_pdf(path, workers=None):
+    workers = PDF_WORKERS if workers is None else workers
+    with fitz.open(path) as doc:
+        page_count = doc.page_count
 
-    doc.close()
+    # Процессы пула ingest.py (daemon) не могут создавать свои: файлы там и так параллельны
+    if workers <= 1 or page_count < PDF_PARALLEL_MIN_PAGES or mp.current_process().daemon:
+        result = parse_pages(path, 0, page_count)
+    else:
+        ranges = [(i, min(i + PDF_PAGES_PER_TASK, page_count)) for i in range(0, page_count, PDF_PAGES_PER_TASK)]
+        futures = [_pool(workers).submit(parse_pages, str(path), start, stop) for start, stop in ranges]
+        result = [block for future in futures for block in future.result()]
 
     # финальная очистка
     final = []
@@ -1,28 +1,82 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from threading import Lock
+import copy
 
-from transformers import AutoTokenizer, AutoModelForSequenceClassification, AutoModelForCausalLM
+from transformers import (AutoTokenizer, AutoModelForSequenceClassification, AutoModelForCausalLM,
+                          AsyncTextIteratorStreamer, StoppingCriteria, StoppingCriteriaList)
 from sentence_transformers import CrossEncoder
 from itertools import combinations
 import torch
 import numpy as np
 
+from object.SessionCache import SessionCache, common_prefix_len, history_hash
+from object.Scheduler import GenerationScheduler
+from object.Speculative import SpeculativeDecoder
+from object.Precision import apply_precision
+from object.TokenStore import TokenStore, prompt_pieces
+
 # ======================= RERANK OBJECT =======================
 class Reranker:
-    def __init__(self, model="./model/reranker", device="cpu"):
+    def __init__(self, model="./model/reranker", device="cpu", fast_model=None, precision="fp32"):
         # Cross-encoder reranker
         self.RerankerModel = CrossEncoder(model, device=device) if model else None
+        # Дешёвый cross-encoder для первой стадии каскада (опционально)
+        self.FastRerankerModel = CrossEncoder(fast_model, device=device) if fast_model else None
+
+        # Точность инференса: fp32 / bf16 / int8 (object/Precision.py)
+        for m in (self.RerankerModel, self.FastRerankerModel):
+            if m is not None:
+                apply_precision(m, precision, device)
+
+        # Заранее токенизированные чанки (attach_token_store): id(модели) -> name в TokenStore
+        self.token_store = None
+        self.token_keys = {}
+
+    # ======================= TOKEN STORE =======================
+    def attach_token_store(self, store):
+        """Пары (вопрос, чанк) собираются из id чанков SearchSystem вместо токенизации текста."""
+        for m in (self.RerankerModel, self.FastRerankerModel):
+            if m is None:
+                continue
+            name = store.register(TokenStore.key("reranker", m.tokenizer), m.tokenizer)
+            samples = [store.sample_texts()[i:i + 2] for i in range(0, 4, 2)]
+            if store.verify(name, samples, " ".join):
+                self.token_keys[id(m)] = name
+            else:
+                print(f"TokenStore: склейка id не совпадает с токенизатором {m.tokenizer.name_or_path}, отключено")
+        self.token_store = store
+
+    def _predict(self, model, query, chunks):
+        name = self.token_keys.get(id(model))
+        if name is None:
+            return model.predict([(query, ' '.join(r["texts"])) for r in chunks])
+
+        # То же, что CrossEncoder.predict, но текст чанков уже токенизирован
+        tokenizer = model.tokenizer
+        query_ids = tokenizer(query, add_special_tokens=False)["input_ids"]
+        features = tokenizer.pad(
+            [
+                tokenizer.prepare_for_model(query_ids, self.token_store.encode(name, r["texts"]).tolist(),
+                                            truncation=True)
+                for r in chunks
+            ],
+            return_tensors="pt"
+        ).to(model.device)
+
+        with torch.inference_mode():
+            logits = model.activation_fn(model.model(**features, return_dict=True).logits)
+        if logits.shape[1] == 1:
+            logits = logits[:, 0]
+        return logits.float().cpu().numpy()
 
     # ======================= RERANK =======================
     def rerank_results(self, query, chunks, top_k_rerank=3, threshold=0.0):
         if not self.RerankerModel or not chunks:
             return chunks[:top_k_rerank]
 
-        # Составляем пары для Reranker
+        # Составляем пары для Reranker и получаем score
         # Берем все тексты из chunk['texts']
-        pairs = [(query, ' '.join(r["texts"])) for r in chunks]
-
-        # Получаем score
-        scores = self.RerankerModel.predict(pairs)
+        scores = self._predict(self.RerankerModel, query, chunks)
 
         # Добавляем score в каждый результат
         chunks_with_scores = [
@@ -37,16 +91,105 @@ class Reranker:
 
         return reranked
 
+    # ======================= CASCADE RERANK =======================
+    def rerank_results_cascade(self, query, chunks, top_k_rerank=3, threshold=0.0,
+                               margin=0.1, drop_margin=0.3, min_confident_score=0.0):
+        """
+        Каскадный rerank с ранним выходом.
+        1 стадия — дешёвые score: FastRerankerModel (если задан) или score из search_hybrid.
+        Лидеры, отрыв которых от следующего кандидата >= margin, принимаются без тяжёлой модели.
+        Кандидаты, отстающие от лучшего больше чем на drop_margin, отбрасываются.
+        2 стадия — RerankerModel только для неуверенных кандидатов.
+
+        Шкалы не смешиваются: у всех результатов дешёвый score — в "fast_score", "score" (score
+        RerankerModel, к нему применяется threshold) — только у прошедших 2 стадию.
+        Лидеры идут первыми, за ними — остальные по убыванию "score".
+        Возвращает (reranked, stats), stats["full_fraction"] — доля кандидатов,
+        прошедших через тяжёлую модель.
+        """
+        stats = {"candidates": len(chunks), "confident": 0, "dropped": 0, "full_scored": 0, "full_fraction": 0.0}
+
+        if not self.RerankerModel or not chunks:
+            return chunks[:top_k_rerank], stats
+
+        # ---- 1 стадия: дешёвые score ----
+        if self.FastRerankerModel:
+            cheap_scores = [float(s) for s in self._predict(self.FastRerankerModel, query, chunks)]
+        else:
+            cheap_scores = [float(r.get("hybrid_score", 0.0)) for r in chunks]
+
+        ranked = sorted(zip(chunks, cheap_scores), key=lambda x: x[1], reverse=True)
+
+        # Уверенные лидеры: префикс с явным отрывом от следующего кандидата
+        n_confident = 0
+        for i in range(min(top_k_rerank, len(ranked) - 1)):
+            if ranked[i][1] < min_confident_score or ranked[i][1] - ranked[i + 1][1] < margin:
+                break
+            n_confident = i + 1
+
+        confident = [{**r, "fast_score": s, "rerank_stage": "fast"} for r, s in ranked[:n_confident]]
+
+        # Отбрасываем явно слабых, остальные — на тяжёлую модель
+        best = ranked[0][1]
+        uncertain = []
+        for r, s in ranked[n_confident:]:
+            if best - s > drop_margin:
+                stats["dropped"] += 1
+            else:
+                uncertain.append((r, s))
+
+        need = top_k_rerank - len(confident)
+        if need <= 0:
+            uncertain = []
+
+        # ---- 2 стадия: cross-encoder только для неуверенных ----
+        full = []
+        if uncertain:
+            scores = self._predict(self.RerankerModel, query, [r for r, _ in uncertain])
+            full = [
+                {**r, "fast_score": fs, "score": float(s), "rerank_stage": "full"}
+                for (r, fs), s in zip(uncertain, scores)
+            ]
+            full = [r for r in full if r["score"] >= threshold]
+            full = sorted(full, key=lambda x: x["score"], reverse=True)[:need]
+
+        stats["confident"] = len(confident)
+        stats["full_scored"] = len(uncertain)
+        stats["full_fraction"] = len(uncertain) / len(chunks)
+
+        return confident + full, stats
+
 
 # ======================= LOGICAL RELATIONSHIP =======================
 class LogicalRelationship:
-    def __init__(self, model="./molder/lr", device="cpu"):
+    def __init__(self, model="./molder/lr", device="cpu", precision="fp32"):
         self.tokenizer = AutoTokenizer.from_pretrained(model)
         self.model = AutoModelForSequenceClassification.from_pretrained(model)
+        self.model = apply_precision(self.model, precision, device)
         if torch.cuda.is_available():
             self.cuda()
         self.device = device
 
+        # Заранее токенизированные чанки (attach_token_store)
+        self.token_store = None
+        self.token_key = None
+
+    # ======================= TOKEN STORE =======================
+    def attach_token_store(self, store):
+        name = store.register(TokenStore.key("nli", self.tokenizer), self.tokenizer)
+        samples = [store.sample_texts()[i:i + 2] for i in range(0, 4, 2)]
+        if not store.verify(name, samples, " ".join):
+            print(f"TokenStore: склейка id не совпадает с токенизатором {self.tokenizer.name_or_path}, отключено")
+            return
+        self.token_store = store
+        self.token_key = name
+
+    def _encode(self, texts):
+        """id текста чанка с контекстом (' '.join(texts)) без специальных токенов."""
+        if self.token_key is None:
+            return self.tokenizer(" ".join(texts), add_special_tokens=False)["input_ids"]
+        return self.token_store.encode(self.token_key, texts).tolist()
+
         # ======================= CHECK CONFLICT =======================
 
     def check_conflict(self, text1, text2):
@@ -62,8 +205,29 @@ class LogicalRelationship:
             ).to(self.model.device)
 
             out = self.model(**tokens)
-            proba = torch.softmax(out.logits, -1).cpu().numpy()[0]
+            proba = torch.softmax(out.logits.float(), -1).cpu().numpy()[0]
+
+        return self._contradiction(proba)
+
+    def check_conflict_ids(self, ids1, ids2):
+        """check_conflict для уже токенизированных текстов (_encode): каждый текст токенизируется один раз."""
+        with torch.inference_mode():
+            tokens = self.tokenizer.prepare_for_model(
+                ids1,
+                ids2,
+                truncation=True,
+                max_length=512,
+                padding='max_length',
+                return_tensors='pt',
+                prepend_batch_axis=True
+            ).to(self.model.device)
+
+            out = self.model(**tokens)
+            proba = torch.softmax(out.logits.float(), -1).cpu().numpy()[0]
 
+        return self._contradiction(proba)
+
+    def _contradiction(self, proba):
         # Преобразуем в словарь лейблов
         data = {v: proba[k] for k, v in self.model.config.id2label.items()}
         return data.get('contradiction', 0.0)
@@ -77,8 +241,8 @@ class LogicalRelationship:
         - source_conflicts — список кортежей (sourceA, sourceB, score)
         """
 
-        # 1. Собираем текст каждого чанка
-        texts = [" ".join(c["texts"]) for c in chunks]
+        # 1. Токены текста каждого чанка
+        token_ids = [self._encode(c["texts"]) for c in chunks]
         sources = [c["source"] for c in chunks]
         n = len(chunks)
 
@@ -89,7 +253,7 @@ class LogicalRelationship:
         source_pairs = {}  # (A, B) -> [scores]
 
         for (i, j) in combinations(range(n), 2):
-            score = self.check_conflict(texts[i], texts[j])
+            score = self.check_conflict_ids(token_ids[i], token_ids[j])
             conflict_matrix[i][j] = score
             conflict_matrix[j][i] = score
 
@@ -116,9 +280,8 @@ class LogicalRelationship:
             src = ch['source']
             if src not in docs:
                 docs[src] = []
-            # Объединяем текст чанка с контекстом
-            combined_text = " ".join(ch["texts"])
-            docs[src].append(combined_text)
+            # Токены текста чанка с контекстом
+            docs[src].append(self._encode(ch["texts"]))
 
         # 2. Матрица конфликтов
         sources = list(docs.keys())
@@ -131,9 +294,9 @@ class LogicalRelationship:
             scores = []
 
             # Сравниваем все чанк-пары между документами
-            for text_i in docs[src_i]:
-                for text_j in docs[src_j]:
-                    score = self.check_conflict(text_i, text_j)
+            for ids_i in docs[src_i]:
+                for ids_j in docs[src_j]:
+                    score = self.check_conflict_ids(ids_i, ids_j)
                     scores.append(score)
 
             # Агрегируем score
@@ -189,12 +352,249 @@ SYSTEM_PROMPT = (
     "3. Если ты не знаешь ответа и его нет в контексте, честно скажи: 'К сожалению, у меня нет информации по этому вопросу ни в документах, ни в моей базе знаний'."
 )
 
+SUMMARY_PROMPT = (
+    "Кратко перескажи диалог пользователя с ассистентом: о чём спрашивали и что ответили. "
+    "Сохрани важные факты, названия документов и числа. Не более 5 предложений."
+)
+
+class CancelCriteria(StoppingCriteria):
+    """Останавливает model.generate, когда выставлен threading.Event (ответ больше не нужен)."""
+
+    def __init__(self, cancel):
+        self.cancel = cancel
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.cancel.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
 class LLM:
-    def __init__(self, model="./model/decoder-encoder", device="cpu"):
+    def __init__(self, model="./model/decoder-encoder", device="cpu", prefix_cache=False, session_cache_bytes=0,
+                 history_keep_turns=None, history_mode="summary", history_max_tokens=None, history_step=None,
+                 speculative=None, draft_model=None, num_draft_tokens=8, precision="fp32"):
         self.tokenizer = AutoTokenizer.from_pretrained(model)
+        # Для пакетной генерации промпты выравниваются паддингом слева
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
         self.model = AutoModelForCausalLM.from_pretrained(model).to(device)
+        # Точность применяется до построения KV-кэшей: их dtype совпадает с dtype модели
+        self.model = apply_precision(self.model, precision, device)
         self.device = device
 
+        # KV-кэш неизменного системного префикса
+        self.prefix_ids = None
+        self.prefix_cache = None
+        if prefix_cache:
+            self.build_prefix_cache()
+
+        # KV-кэш бесед (multi-turn), LRU в пределах session_cache_bytes
+        self.sessions = SessionCache(session_cache_bytes) if session_cache_bytes else None
+
+        # Continuous batching (attach_scheduler)
+        self.scheduler = None
+
+        # Speculative decoding: "prompt_lookup" (черновик из контекста) или "draft" (маленькая модель)
+        self.speculative = None
+        if speculative:
+            draft = None
+            if speculative == "draft":
+                draft = AutoModelForCausalLM.from_pretrained(draft_model).to(device)
+                draft = apply_precision(draft, precision, device)
+            self.speculative = SpeculativeDecoder(
+                self.model,
+                eos_token_id=self.tokenizer.eos_token_id,
+                device=device,
+                mode=speculative,
+                draft_model=draft,
+                num_draft_tokens=num_draft_tokens
+            )
+
+        # Политика истории: последние history_keep_turns ходов дословно, более старые —
+        # в сводку ("summary") или отбрасываются ("drop"). Окно сдвигается блоками по
+        # history_step ходов, поэтому сводка (и префикс промпта) меняется не каждый ход.
+        self.history_keep_turns = history_keep_turns
+        self.history_mode = history_mode
+        self.history_max_tokens = history_max_tokens
+        self.history_step = history_step or history_keep_turns or 1
+        self.summaries = OrderedDict()  # hash старых ходов -> сводка
+        self.summaries_lock = Lock()
+        self.max_summaries = 256
+
+        # Заранее токенизированные чанки контекста (attach_token_store)
+        self.token_store = None
+        self.token_key = None
+
+    # ======================= TOKEN STORE =======================
+    @staticmethod
+    def _context_units(text):
+        # В контексте (gateway.build_context) за каждым чанком идёт пустая строка
+        return prompt_pieces(text + "\n\n")
+
+    def attach_token_store(self, store):
+        """Промпт собирается склейкой id кусков (prompt_pieces); куски чанков берутся из TokenStore."""
+        name = store.register(TokenStore.key("llm", self.tokenizer), self.tokenizer, units=self._context_units)
+        context = "Файл: sample.pdf\n" + "\n\n".join(store.sample_texts()) + "\n\n"
+        prompt = self._build_prompt([], "Что сказано в документах?", context)
+
+        self.token_store, self.token_key = store, name
+        if self._prompt_ids(prompt) != self.tokenizer(prompt).input_ids:
+            print(f"TokenStore: склейка id не совпадает с токенизатором {self.tokenizer.name_or_path}, отключено")
+            self.token_store, self.token_key = None, None
+
+    def _prompt_ids(self, text):
+        if self.token_key is None:
+            return self.tokenizer(text, truncation=True).input_ids
+        ids = self.token_store.encode(self.token_key, prompt_pieces(text)).tolist()
+        return self.tokenizer.build_inputs_with_special_tokens(ids)
+
+    def _tokenize_prompts(self, texts):
+        """Как self.tokenizer(texts, return_tensors="pt", padding=True), паддинг слева."""
+        return self.tokenizer.pad({"input_ids": [self._prompt_ids(t) for t in texts]}, return_tensors="pt").to(self.device)
+
+    def count_context_tokens(self, text):
+        """Сколько токенов чанк займёт в контексте промпта (вместе с пустой строкой после него)."""
+        if self.token_key is None:
+            return len(self.tokenizer(text + "\n\n", add_special_tokens=False).input_ids)
+        return len(self.token_store.encode(self.token_key, self._context_units(text)))
+
+    # ======================= SCHEDULER =======================
+    def attach_scheduler(self, max_batch_size=8, max_queued_tokens=32768):
+        """Все генерации идут через общий GenerationScheduler вместо отдельных model.generate."""
+        self.scheduler = GenerationScheduler(
+            self.model,
+            eos_token_id=self.tokenizer.eos_token_id,
+            device=self.device,
+            max_batch_size=max_batch_size,
+            max_queued_tokens=max_queued_tokens,
+            speculative=self.speculative
+        )
+        return self.scheduler
+
+    # ======================= HISTORY =======================
+    @staticmethod
+    def _split_turns(chat_history):
+        """Ведущие system-сообщения и ходы (user + ответы ассистента)."""
+        head, turns = [], []
+        for msg in chat_history:
+            if msg["role"] == "user":
+                turns.append([msg])
+            elif turns:
+                turns[-1].append(msg)
+            else:
+                head.append(msg)
+        return head, turns
+
+    def _summarize(self, turns):
+        key = history_hash([m for t in turns for m in t])
+        with self.summaries_lock:
+            if key in self.summaries:
+                self.summaries.move_to_end(key)
+                return self.summaries[key]
+
+        # Сводка накопительная: ищем закэшированную сводку для самого длинного префикса ходов
+        previous, start = "", 0
+        for n in range(len(turns) - 1, 0, -1):
+            prefix_key = history_hash([m for t in turns[:n] for m in t])
+            with self.summaries_lock:
+                if prefix_key in self.summaries:
+                    previous, start = self.summaries[prefix_key], n
+                    break
+
+        dialog = "\n".join(f"{m['role']}: {m['content']}" for t in turns[start:] for m in t)
+        if previous:
+            dialog = f"Предыдущая сводка: {previous}\n{dialog}"
+
+        text = self.tokenizer.apply_chat_template(
+            [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": dialog}],
+            tokenize=False,
+            add_generation_prompt=True
+        )
+        summary = self._generate_single(text, max_new_tokens=128)
+
+        with self.summaries_lock:
+            self.summaries[key] = summary
+            while len(self.summaries) > self.max_summaries:
+                self.summaries.popitem(last=False)
+        return summary
+
+    def _count_messages(self, messages):
+        return sum(len(self.tokenizer(m["content"], add_special_tokens=False).input_ids) for m in messages)
+
+    def compact_history(self, chat_history):
+        """История для промпта по политике history_* (исходный список не меняется)."""
+        if not self.history_keep_turns:
+            return chat_history
+
+        head, turns = self._split_turns(chat_history)
+
+        # Окно дословных ходов: от keep до keep + step - 1 последних, сдвиг блоками
+        n_old = 0
+        if len(turns) > self.history_keep_turns:
+            n_old = (len(turns) - self.history_keep_turns) // self.history_step * self.history_step
+        old, recent = turns[:n_old], turns[n_old:]
+
+        # Ограничение по токенам: выбрасываем самые старые дословные ходы (кроме последнего)
+        if self.history_max_tokens:
+            while len(recent) > 1 and self._count_messages([m for t in recent for m in t]) > self.history_max_tokens:
+                old.append(recent.pop(0))
+
+        messages = list(head)
+        if old and self.history_mode == "summary":
+            summary = self._summarize(old)
+            messages.append({"role": "system", "content": f"Краткое содержание предыдущего диалога:\n{summary}"})
+        messages.extend(m for t in recent for m in t)
+        return messages
+
+    # ======================= PREFIX KV-CACHE =======================
+    def build_prefix_cache(self):
+        """Один раз считает past_key_values для отрендеренного шаблоном SYSTEM_PROMPT."""
+        prefix_text = self.tokenizer.apply_chat_template(
+            [{"role": "system", "content": SYSTEM_PROMPT}],
+            tokenize=False,
+            add_generation_prompt=False
+        )
+        prefix_ids = self.tokenizer(prefix_text, return_tensors="pt").input_ids.to(self.device)
+
+        with torch.no_grad():
+            out = self.model(input_ids=prefix_ids, use_cache=True)
+
+        self.prefix_ids = prefix_ids[0]
+        self.prefix_cache = out.past_key_values
+
+    def _prefix_cache_kwargs(self, model_inputs):
+        """past_key_values для генерации, если промпт начинается с закэшированного префикса."""
+        if self.prefix_cache is None or model_inputs.input_ids.shape[0] != 1:
+            return {}
+
+        input_ids = model_inputs.input_ids[0]
+        n = len(self.prefix_ids)
+        if len(input_ids) <= n or not torch.equal(input_ids[:n], self.prefix_ids):
+            return {}
+
+        # Каждая генерация достраивает свою копию кэша
+        return {"past_key_values": copy.deepcopy(self.prefix_cache)}
+
+    def verify_prefix_cache(self, question="Что такое NeuroFile?", context_text="", max_new_tokens=32):
+        """
+        Проверка корректности: при greedy-декодировании ответ с кэшем префикса
+        должен совпадать с ответом без него.
+        """
+        if self.prefix_cache is None:
+            return False
+
+        text = self._build_prompt([], question, context_text)
+        model_inputs = self.tokenizer([text], return_tensors="pt").to(self.device)
+        cache_kwargs = self._prefix_cache_kwargs(model_inputs)
+        if not cache_kwargs:
+            return False
+
+        kwargs = {**self._generation_kwargs(), "max_new_tokens": max_new_tokens}
+        with torch.no_grad():
+            plain = self.model.generate(**model_inputs, **kwargs)
+            cached = self.model.generate(**model_inputs, **kwargs, **cache_kwargs)
+
+        return torch.equal(plain, cached)
+
     def generate_answer_old(self, question, context):
         prompt = (
             f"{SYSTEM_PROMPT}\n\n"
@@ -216,23 +616,30 @@ class LLM:
         decoded = self.tokenizer.decode(output[0], skip_special_tokens=True)
         return decoded.split("Ответ:", 1)[-1].strip()
 
-    def generate_answer(self, chat_history, question, context_text, attention=""):
+    def _build_prompt(self, chat_history, question, context_text, attention="", return_prefix=False):
+        """
+        Промпт хода; return_prefix=True — ещё и текст его начала до контекста документов
+        (системный промпт и история): только его KV-кэш переиспользует следующий ход.
+        """
         # Преобразуем ключи, если нужно
         for msg in chat_history:
             if "message" in msg:
                 msg["content"] = msg.pop("message")
 
-        # Добавляем вопрос пользователя в историю
-        chat_history.append({"role": "user", "content": question})
-
         # Формируем временные сообщения для модели
         messages_for_model = [{"role": "system", "content": SYSTEM_PROMPT}]
         if attention != "":
             messages_for_model.append({"role": "system", "content": attention})
+
+        # История чата идёт сразу за системным промптом: так она остаётся общим
+        # префиксом между ходами и её KV-кэш переиспользуется (SessionCache)
+        messages_for_model.extend(self.compact_history(chat_history))
+        n_prefix = len(messages_for_model)
         messages_for_model.append({"role": "system", "content": f"Контекст документов:\n{context_text}"})
+        messages_for_model.append({"role": "user", "content": question})
 
-        # Добавляем историю чата (вопросы и ответы) + текущий вопрос
-        messages_for_model.extend(chat_history)
+        # Добавляем вопрос пользователя в историю
+        chat_history.append({"role": "user", "content": question})
 
         # Применяем шаблон
         text = self.tokenizer.apply_chat_template(
@@ -240,13 +647,23 @@ class LLM:
             tokenize=False,
             add_generation_prompt=True
         )
+        if not return_prefix:
+            return text
+
+        prefix = self.tokenizer.apply_chat_template(
+            messages_for_model[:n_prefix],
+            tokenize=False,
+            add_generation_prompt=False
+        )
+        return text, prefix
 
-        # Токенизация
-        model_inputs = self.tokenizer([text], return_tensors="pt", padding=True, truncation=True).to(self.device)
+    def count_prompt_tokens(self, chat_history, question, attention=""):
+        """Сколько токенов займёт промпт без контекста документов."""
+        text = self._build_prompt([dict(msg) for msg in chat_history], question, "", attention)
+        return len(self.tokenizer(text, add_special_tokens=False).input_ids)
 
-        # Генерация
-        generated_ids = self.model.generate(
-            **model_inputs,
+    def _generation_kwargs(self):
+        return dict(
             max_new_tokens=256,
             do_sample=False,
             temperature=0.3,
@@ -254,15 +671,210 @@ class LLM:
             pad_token_id=self.tokenizer.eos_token_id
         )
 
+    def _session_cache_kwargs(self, model_inputs, session_id, history):
+        """
+        past_key_values из кэша сессии, обрезанные до общего с промптом префикса, и restore():
+        на время генерации запись забрана из SessionCache, restore() возвращает в неё общий префикс,
+        если генерация отменена или упала.
+        """
+        if self.sessions is None or session_id is None:
+            return {}, None
+
+        entry = self.sessions.pop(session_id, history)
+        if entry is None:
+            return {}, None
+
+        input_ids = model_inputs.input_ids[0].tolist()
+        # Хотя бы один токен промпта должен пройти через модель
+        n = min(common_prefix_len(entry["token_ids"], input_ids), len(input_ids) - 1)
+        if n <= 0:
+            return {}, None
+
+        cache = entry["cache"]
+        cache.crop(n)
+
+        def restore():
+            # Генерация дописывает кэш на месте: обрезаем обратно до префикса, который в нём был
+            cache.crop(n)
+            self.sessions.put(session_id, history[:entry["history_len"]], entry["token_ids"][:n], cache)
+
+        return {"past_key_values": cache}, restore
+
+    def _generate_single(self, text, session_id=None, history=None, streamer=None, max_new_tokens=None, cancel=None,
+                         history_prefix=None):
+        model_inputs = self._tokenize_prompts([text])
+
+        # Сначала кэш сессии (история), иначе — кэш системного префикса
+        cache_kwargs, restore = self._session_cache_kwargs(model_inputs, session_id, history)
+        cache_kwargs = cache_kwargs or self._prefix_cache_kwargs(model_inputs)
+
+        generation_kwargs = self._generation_kwargs()
+        if max_new_tokens is not None:
+            generation_kwargs["max_new_tokens"] = max_new_tokens
+        keep_session = self.sessions is not None and session_id is not None
+
+        try:
+            if self.scheduler is not None:
+                # Общий цикл декодирования с остальными запросами; без конкурирующих запросов
+                # планировщик сам переключается на speculative decoding
+                result = self.scheduler.submit(
+                    model_inputs.input_ids[0].tolist(),
+                    generation_kwargs["max_new_tokens"],
+                    past=cache_kwargs.get("past_key_values"),
+                    streamer=streamer,
+                    want_cache=keep_session,
+                    cancel=cancel,
+                    speculative=self.speculative is not None
+                ).result()
+                sequences, cache = result["sequence"], result["cache"]
+            elif self.speculative is not None:
+                result = self.speculative.generate(
+                    model_inputs.input_ids[0].tolist(),
+                    generation_kwargs["max_new_tokens"],
+                    past=cache_kwargs.get("past_key_values"),
+                    streamer=streamer,
+                    cancel=cancel
+                )
+                sequences, cache = result["sequence"], result["cache"]
+            else:
+                outputs = self.model.generate(
+                    **model_inputs,
+                    **generation_kwargs,
+                    **cache_kwargs,
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList([CancelCriteria(cancel)]) if cancel is not None else None,
+                    return_dict_in_generate=True
+                )
+                sequences, cache = outputs.sequences[0].tolist(), outputs.past_key_values
+        except BaseException:
+            if restore is not None:
+                restore()
+            raise
+
+        # Сохраняем KV-кэш хода для следующего запроса этой беседы (отменённый ответ в беседу не попадёт,
+        # но кэш истории до него остаётся). Контекст, вопрос и ответ идут после истории и следующим
+        # ходом не переиспользуются: в кэше остаётся только префикс history_prefix
+        if keep_session and cache is not None and not (cancel is not None and cancel.is_set()):
+            n = cache.get_seq_length()
+            if history_prefix is not None:
+                n = min(n, common_prefix_len(self.tokenizer(history_prefix).input_ids, sequences))
+            if n > 0:
+                cache.crop(n)
+                self.sessions.put(session_id, history, sequences[:n], cache)
+        elif restore is not None:
+            restore()
+
+        new_ids = sequences[model_inputs.input_ids.shape[1]:]
+        return self.tokenizer.decode(new_ids, skip_special_tokens=True).strip()
+
+    def _generate_batch(self, texts, cancel=None, max_new_tokens=None):
+        if len(texts) == 1:
+            return [self._generate_single(texts[0], cancel=cancel, max_new_tokens=max_new_tokens)]
+
+        generation_kwargs = self._generation_kwargs()
+        if max_new_tokens is not None:
+            generation_kwargs["max_new_tokens"] = max_new_tokens
+
+        if self.scheduler is not None:
+            # Планировщик сам объединяет последовательности в батч
+            prompts = [self._prompt_ids(text) for text in texts]
+            futures = [self.scheduler.submit(ids, generation_kwargs["max_new_tokens"], cancel=cancel) for ids in prompts]
+            return [
+                self.tokenizer.decode(f.result()["sequence"][len(ids):], skip_special_tokens=True).strip()
+                for f, ids in zip(futures, prompts)
+            ]
+
+        # Токенизация (паддинг слева — все промпты заканчиваются в одной позиции)
+        model_inputs = self._tokenize_prompts(texts)
+
+        # Генерация
+        generated_ids = self.model.generate(
+            **model_inputs,
+            **generation_kwargs,
+            stopping_criteria=StoppingCriteriaList([CancelCriteria(cancel)]) if cancel is not None else None
+        )
+
         # Обрезаем токены, которые были в prompt, оставляем только новые
         generated_ids = [
             output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
         ]
 
         # Декодируем
-        response = self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0].strip()
+        return [r.strip() for r in self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)]
+
+    def generate_answer(self, chat_history, question, context_text, attention="", session_id=None, cancel=None,
+                        max_new_tokens=None):
+        """
+        session_id — идентификатор беседы: KV-кэш хода сохраняется в SessionCache,
+        и следующий ход префиллит только то, что идёт после общей истории.
+        cancel — threading.Event для досрочной остановки (ответ обрывается).
+        max_new_tokens — лимит длины ответа вместо значения из _generation_kwargs.
+        """
+        history_len = len(chat_history)
+        text, prefix = self._build_prompt(chat_history, question, context_text, attention, return_prefix=True)
+        history = chat_history[:history_len]
+        response = self._generate_single(text, session_id, history, cancel=cancel, max_new_tokens=max_new_tokens,
+                                         history_prefix=prefix)
 
         # Сохраняем ответ модели в историю
         chat_history.append({"role": "assistant", "content": response})
 
-        return response
\ No newline at end of file
+        return response
+
+    def generate_answers(self, chat_history, question, contexts, attention="", batch_size=4, session_id=None,
+                         cancel=None, max_new_tokens=None):
+        """
+        Генерирует ответы на один вопрос по нескольким контекстам (группам документов)
+        одним батчем вместо последовательных вызовов generate_answer.
+        chat_history не изменяется. cancel — threading.Event для досрочной остановки.
+        """
+        if len(contexts) == 1:
+            return [self.generate_answer([dict(msg) for msg in chat_history], question, contexts[0],
+                                         attention, session_id=session_id, cancel=cancel,
+                                         max_new_tokens=max_new_tokens)]
+
+        texts = [
+            self._build_prompt([dict(msg) for msg in chat_history], question, context, attention)
+            for context in contexts
+        ]
+
+        answers = []
+        for i in range(0, len(texts), batch_size):
+            answers.extend(self._generate_batch(texts[i:i + batch_size], cancel=cancel, max_new_tokens=max_new_tokens))
+        return answers
+
+    async def stream_answer_async(self, chat_history, question, context_text, attention="", session_id=None,
+                                  submit=None, cancel=None):
+        """
+        Потоковая генерация: отдаёт фрагменты текста по мере декодирования.
+        Первый фрагмент приходит сразу после prefill, а не после всей генерации.
+        Генерация ставится в пул через submit(fn, *args) (StageExecutor.submit), фрагменты читаются
+        без блокировки event loop. cancel — threading.Event: вызывающий ставит его, когда фрагменты
+        больше не нужны (таймаут, отключение клиента), и генерация освобождает слот пула.
+        """
+        history_len = len(chat_history)
+        text, prefix = self._build_prompt(chat_history, question, context_text, attention, return_prefix=True)
+        history = chat_history[:history_len]
+
+        streamer = AsyncTextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        future = submit(self._generate_streaming, text, session_id, history, streamer, cancel, prefix)
+
+        parts = []
+        async for piece in streamer:
+            if piece:
+                parts.append(piece)
+                yield piece
+        # Ошибка генерации (в т.ч. SchedulerFull) поднимается здесь
+        await future
+
+        # Сохраняем ответ модели в историю
+        chat_history.append({"role": "assistant", "content": "".join(parts).strip()})
+
+    def _generate_streaming(self, text, session_id, history, streamer, cancel=None, history_prefix=None):
+        try:
+            return self._generate_single(text, session_id, history, streamer, cancel=cancel,
+                                         history_prefix=history_prefix)
+        except Exception:
+            # Читатель стримера не должен ждать токенов, которых не будет
+            streamer.end()
+            raise
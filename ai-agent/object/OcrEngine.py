@@ -0,0 +1,133 @@
+import hashlib
+import multiprocessing as mp
+import sqlite3
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from threading import Lock
+
+
+# ======================= OCR ENGINE =======================
+class OcrEngine:
+    """
+    OCR страниц и зон скана: очередь задач в пул из workers процессов и постоянный кэш результатов (sqlite).
+    Ключ кэша — sha256 пикселей отрендеренного изображения, его геометрия, язык и PSM tesseract:
+    повторная загрузка того же скана (/update_file) не вызывает tesseract.
+    Одинаковые изображения, уже стоящие в очереди, распознаются один раз.
+
+    recognize(rows, width, height, channels, stride, psm, lang) -> текст выполняется в процессе пула
+    (функция модуля — передаётся по имени); workers=0 — в вызывающем потоке, кэш тот же.
+    """
+
+    def __init__(self, recognize, cache_path=None, workers=1, lang="rus+eng"):
+        self.recognize = recognize
+        self.workers = workers
+        self.lang = lang
+        self.pool = None
+
+        self.lock = Lock()
+        self.inflight = {}    # key -> Future
+        self.hits = 0
+        self.misses = 0
+        self.seconds = 0.0
+
+        self.db = None
+        if cache_path is not None:
+            Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+            # Кэш общий для процессов (gateway, ingest.py, пул страниц parse_pdf): WAL и ожидание блокировки
+            self.db = sqlite3.connect(cache_path, timeout=30, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS ocr (key TEXT PRIMARY KEY, text TEXT NOT NULL, created REAL)")
+            self.db.commit()
+
+    def key(self, rows, width, height, channels, psm):
+        digest = hashlib.sha256(rows).hexdigest()
+        return f"{digest}:{width}x{height}x{channels}:{self.lang}:{psm}"
+
+    # ======================= SUBMIT =======================
+    def submit(self, rows, width, height, channels, stride, psm):
+        """Future с текстом; при попадании в кэш — уже готовый."""
+        key = self.key(rows, width, height, channels, psm)
+
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is not None:
+                self.hits += 1
+                return future
+
+            text = self._cached(key)
+            if text is not None:
+                self.hits += 1
+                future = Future()
+                future.set_result(text)
+                return future
+
+            self.misses += 1
+            future = Future()
+            if self.workers > 0:
+                if self.pool is None:
+                    # spawn: вызывающий процесс (gateway) многопоточен
+                    self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=mp.get_context("spawn"))
+                task = self.pool.submit(_timed, self.recognize, bytes(rows), width, height, channels, stride,
+                                        psm, self.lang)
+                self.inflight[key] = future
+
+        if self.workers > 0:
+            # Колбэк вешается вне lock: у уже завершённой задачи он выполняется сразу в этом потоке
+            task.add_done_callback(lambda t: self._done(key, t, future))
+            return future
+
+        try:
+            text, seconds = _timed(self.recognize, rows, width, height, channels, stride, psm, self.lang)
+        except Exception as e:
+            future.set_exception(e)
+            return future
+        self._store(key, text, seconds)
+        future.set_result(text)
+        return future
+
+    def _done(self, key, task, future):
+        # Сначала запись в кэш, затем снятие из очереди: повторный submit найдёт одно из двух
+        error = task.exception()
+        if error is None:
+            text, seconds = task.result()
+            self._store(key, text, seconds)
+        with self.lock:
+            self.inflight.pop(key, None)
+
+        if error is None:
+            future.set_result(text)
+        else:
+            future.set_exception(error)
+
+    # ======================= CACHE =======================
+    def _cached(self, key):
+        if self.db is None:
+            return None
+        row = self.db.execute("SELECT text FROM ocr WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _store(self, key, text, seconds):
+        with self.lock:
+            self.seconds += seconds
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO ocr (key, text, created) VALUES (?, ?, ?)",
+                                (key, text, time.time()))
+                self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "workers": self.workers,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "queued": len(self.inflight),
+                "ocr_seconds": self.seconds,
+            }
+
+
+def _timed(recognize, *args):
+    start = time.monotonic()
+    return recognize(*args), time.monotonic() - start
@@ -0,0 +1,46 @@
+from pathlib import Path
+
+from object.LoadDOCX import parse_docx
+from object.LoadPDF import parse_pdf
+from object.LoadDOC_RTF import parse_doc_or_rtf
+from object.GenChunk_old import normalize_pre_chank, add_source_and_id
+
+
+class UnsupportedFileType(ValueError):
+    """Для расширения файла нет парсера."""
+
+
+class ParseError(Exception):
+    """Парсер не смог разобрать файл."""
+
+
+# ======================= PARSE FILE =======================
+# Разбор загруженного файла в чанки — общий для gateway.py и ingest.py
+PARSERS = {
+    ".docx": parse_docx,
+    ".doc": parse_doc_or_rtf,
+    ".pdf": parse_pdf,
+    ".rtf": parse_doc_or_rtf,
+}
+
+
+def get_parser_for_file(path: Path):
+    ext = path.suffix.lower()
+
+    parser = PARSERS.get(ext)
+    if not parser:
+        raise UnsupportedFileType(f"Unsupported file type: {ext}")
+
+    return parser
+
+
+def parse_file(temp_path: Path, source: str):
+    parser = get_parser_for_file(temp_path)
+
+    try:
+        pre_chunks = parser(temp_path)
+    except Exception as e:
+        raise ParseError(f"Parse error: {e}") from e
+
+    chunks = normalize_pre_chank(pre_chunks, 50, 120)
+    return add_source_and_id(chunks, source)
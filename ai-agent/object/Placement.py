@@ -0,0 +1,244 @@
+import importlib
+import itertools
+import multiprocessing as mp
+import os
+import pickle
+import queue
+import time
+from concurrent.futures import Future
+from ctypes import CDLL, util
+from threading import Lock, Thread
+
+
+# ======================= CPU / NUMA =======================
+def parse_cpus(spec):
+    """"0-3,8,10-11" -> {0, 1, 2, 3, 8, 10, 11}; список номеров ядер возвращается множеством."""
+    if not isinstance(spec, str):
+        return set(spec)
+
+    cpus = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        cpus.update(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def numa_node_cpus(node):
+    with open(f"/sys/devices/system/node/node{node}/cpulist") as f:
+        return parse_cpus(f.read())
+
+
+def _libnuma():
+    path = util.find_library("numa")
+    if path is None:
+        return None
+    try:
+        lib = CDLL(path)
+    except OSError:
+        return None
+    return lib if lib.numa_available() >= 0 else None
+
+
+def bind_memory(node):
+    """
+    Новая память процесса выделяется на NUMA-узле node (None — на узле ядра, где идёт выделение).
+    Нужна libnuma; без неё привязка пропускается.
+    """
+    lib = _libnuma()
+    if lib is None:
+        print(f"NUMA: libnuma недоступна, привязка памяти к узлу {node} пропущена")
+        return False
+    lib.numa_set_preferred(-1 if node is None else node)
+    return True
+
+
+def pin(cores=None, threads=None, numa_node=None):
+    """
+    Привязка текущего процесса: ядра cores (по умолчанию — ядра numa_node), память — к numa_node,
+    threads потоков intra-op torch (по умолчанию по одному на ядро).
+    Вызывается до загрузки моделей: потоки OpenMP наследуют affinity при создании.
+    """
+    if numa_node is not None:
+        bind_memory(numa_node)
+        if cores is None:
+            cores = numa_node_cpus(numa_node)
+
+    if cores is not None:
+        cores = parse_cpus(cores)
+        os.sched_setaffinity(0, cores)
+
+    threads = threads or (len(cores) if cores is not None else None)
+    if threads:
+        # В новом процессе torch ещё не импортирован: пул OpenMP/MKL сразу создаётся нужного размера
+        os.environ["OMP_NUM_THREADS"] = str(threads)
+        os.environ["MKL_NUM_THREADS"] = str(threads)
+        import torch
+        torch.set_num_threads(threads)
+    return cores, threads
+
+
+# ======================= MODEL WORKER =======================
+def _factory_path(factory):
+    return factory if isinstance(factory, str) else f"{factory.__module__}:{factory.__qualname__}"
+
+
+def _load(factory):
+    module, _, name = _factory_path(factory).partition(":")
+    return getattr(importlib.import_module(module), name)
+
+
+def portable_error(error):
+    """Исключение для передачи в другой процесс; не переживающее pickle заменяется текстом."""
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return RuntimeError(f"{type(error).__name__}: {error}")
+
+
+def _serve(factory, args, kwargs, placement, requests, responses):
+    pin(**placement)
+    try:
+        model = _load(factory)(*args, **kwargs)
+    except BaseException as e:
+        responses.put((None, False, portable_error(e), 0.0))
+        return
+    responses.put((None, True, None, 0.0))
+
+    parent = mp.parent_process()
+    while True:
+        try:
+            call = requests.get(timeout=1)
+        except queue.Empty:
+            # gateway завершился аварийно — процесс модели не остаётся сиротой
+            if not parent.is_alive():
+                break
+            continue
+        if call is None:
+            break
+
+        call_id, method, args, kwargs = call
+        start = time.monotonic()
+        try:
+            result = pickle.dumps(getattr(model, method)(*args, **kwargs))
+            responses.put((call_id, True, result, time.monotonic() - start))
+        except Exception as e:
+            responses.put((call_id, False, portable_error(e), time.monotonic() - start))
+
+
+class ModelWorker:
+    """
+    Модель в отдельном процессе со своими ядрами, числом потоков torch и NUMA-узлом (placement),
+    чтобы одновременные стадии разных моделей не делили ядра и пул потоков.
+    Методы модели вызываются как у локального объекта (worker.rerank_results(...)): вызов уходит
+    в очередь процесса, вызовы выполняются по одному, поток-вызыватель ждёт результат.
+    factory — класс или функция, собирающая модель (или строка "module:name").
+    """
+
+    def __init__(self, name, factory, *args, placement=None, **kwargs):
+        # spawn: чистый процесс, torch импортируется уже после привязки к ядрам
+        ctx = mp.get_context("spawn")
+        self.name = name
+        self.placement = dict(placement or {})
+        self.requests = ctx.Queue()
+        self.responses = ctx.Queue()
+        self.process = ctx.Process(
+            target=_serve, name=f"model-{name}", daemon=True,
+            args=(_factory_path(factory), args, kwargs, self.placement, self.requests, self.responses),
+        )
+
+        self.lock = Lock()
+        self.pending = {}
+        self.ids = itertools.count()
+        self.error = None
+        self.calls = 0
+        self.failed = 0
+        self.busy_time = 0.0
+
+        self.process.start()
+        _, ok, error, _ = self._next_response()
+        if not ok:
+            self.process.join()
+            raise error
+
+        Thread(target=self._read, name=f"model-{name}-reader", daemon=True).start()
+
+    def _next_response(self):
+        while True:
+            try:
+                return self.responses.get(timeout=1)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    return None, False, RuntimeError(f"model worker '{self.name}' exited"), 0.0
+
+    def _read(self):
+        while True:
+            call_id, ok, payload, seconds = self._next_response()
+            if call_id is None:
+                # Процесс завершился: ожидающие вызовы получают ошибку
+                with self.lock:
+                    self.error = payload
+                    pending, self.pending = self.pending, {}
+                for future in pending.values():
+                    future.set_exception(payload)
+                return
+
+            with self.lock:
+                future = self.pending.pop(call_id)
+                self.calls += 1
+                self.failed += not ok
+                self.busy_time += seconds
+            if ok:
+                future.set_result(pickle.loads(payload))
+            else:
+                future.set_exception(payload)
+
+    # ======================= CALL =======================
+    def call(self, method, *args, **kwargs):
+        future = Future()
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            call_id = next(self.ids)
+            self.pending[call_id] = future
+        self.requests.put((call_id, method, args, kwargs))
+        return future.result()
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        return lambda *args, **kwargs: self.call(method, *args, **kwargs)
+
+    def close(self):
+        self.requests.put(None)
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "placement": self.placement,
+                "alive": self.process.is_alive(),
+                "pending": len(self.pending),
+                "calls": self.calls,
+                "failed": self.failed,
+                "busy_time": self.busy_time,
+            }
+
+
+# from_pretrained (transformers / accelerate) на время загрузки подменяет инициализацию модулей
+# на уровне процесса: параллельные загрузки в потоках получают чужие meta-тензоры.
+# Модели в текущем процессе грузятся по одной; ModelWorker и индекс — параллельно с ними
+_LOAD_LOCK = Lock()
+
+
+def place(name, factory, *args, placement=None, **kwargs):
+    """Модель name в ModelWorker, если она есть в placement, иначе — в текущем процессе."""
+    if placement is None or name not in placement:
+        with _LOAD_LOCK:
+            return (factory if callable(factory) else _load(factory))(*args, **kwargs)
+    return ModelWorker(name, factory, *args, placement=placement[name], **kwargs)
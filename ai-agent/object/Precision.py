@@ -0,0 +1,38 @@
+import torch
+
+PRECISIONS = ("fp32", "bf16", "int8")
+
+
+def bf16_supported(device="cpu") -> bool:
+    if device.startswith("cuda"):
+        return torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+    # На CPU bf16 быстрее fp32 только при аппаратной поддержке (AVX512-BF16 / AMX)
+    return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+
+def apply_precision(module, precision="fp32", device="cpu"):
+    """
+    Переводит модель в режим инференса с заданной точностью:
+    fp32 — без изменений,
+    bf16 — веса и активации в bfloat16 (если поддерживается, иначе fp32),
+    int8 — динамическое квантование nn.Linear (только CPU).
+    Возвращает модель (int8 квантуется на месте).
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision должен быть одним из {PRECISIONS}")
+
+    module.eval()
+
+    if precision == "bf16":
+        if not bf16_supported(device):
+            print(f"bf16 не поддерживается на {device}, модель остаётся в fp32")
+            return module
+        return module.to(torch.bfloat16)
+
+    if precision == "int8":
+        if device != "cpu":
+            print("int8 dynamic quantization доступна только на CPU, модель остаётся в fp32")
+            return module
+        return torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    return module
@@ -0,0 +1,263 @@
+from collections import deque
+from concurrent.futures import Future
+from threading import Thread, Condition
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+
+from object.SessionCache import cache_layers
+
+
+class SchedulerFull(Exception):
+    """Очередь генерации переполнена (max_queued_tokens)."""
+
+
+def build_cache(layers):
+    cache = DynamicCache()
+    for i, (k, v) in enumerate(layers):
+        cache.update(k, v, i)
+    return cache
+
+
+class GenerationRequest:
+    def __init__(self, prompt_ids, max_new_tokens, past=None, streamer=None, want_cache=False, cancel=None,
+                 speculative=False):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.past = past
+        self.streamer = streamer
+        self.want_cache = want_cache
+        self.cancel = cancel
+        self.speculative = speculative
+        self.generated = []
+        self.future = Future()
+
+
+# ======================= GENERATION SCHEDULER =======================
+class GenerationScheduler:
+    """
+    Continuous batching для LLM: запросы всех обработчиков попадают в общую очередь,
+    один поток ведёт общий цикл декодирования. Новые последовательности
+    добавляются в батч после своего prefill, завершённые убираются на каждом токене.
+
+    KV-кэш батча выровнен паддингом слева: [B, heads, T, dim] + attention_mask [B, T].
+    Декодирование greedy, как и в LLM.generate_answer.
+
+    speculative — SpeculativeDecoder (опционально): запрос с speculative=True, оказавшийся
+    единственным при пустом батче, декодируется им в потоке цикла. Модель в это время занята
+    только им, пришедшие запросы ждут в очереди.
+    """
+
+    def __init__(self, model, eos_token_id, device="cpu", max_batch_size=8, max_queued_tokens=32768,
+                 speculative=None):
+        self.model = model
+        self.speculative = speculative
+        self.device = device
+        self.eos_token_ids = set(eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id])
+        self.max_batch_size = max_batch_size
+        self.max_queued_tokens = max_queued_tokens
+
+        self.queue = deque()
+        self.queued_tokens = 0
+        self.cond = Condition()
+
+        # Состояние батча (только поток цикла)
+        self.active = []
+        self.layers = None
+        self.mask = None
+
+        self.thread = Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    # ======================= SUBMIT =======================
+    def submit(self, prompt_ids, max_new_tokens=256, past=None, streamer=None, want_cache=False, cancel=None,
+               speculative=False) -> Future:
+        """
+        prompt_ids — список токенов промпта; past — DynamicCache для его префикса (опционально).
+        cancel — threading.Event: после него последовательность завершается на следующем токене.
+        speculative — можно декодировать через SpeculativeDecoder, если запрос окажется один.
+        Future возвращает {"sequence": prompt + сгенерированные токены, "cache": DynamicCache | None}.
+        """
+        req = GenerationRequest(list(prompt_ids), max_new_tokens, past, streamer, want_cache, cancel, speculative)
+
+        with self.cond:
+            if self.queued_tokens + len(req.prompt_ids) > self.max_queued_tokens:
+                raise SchedulerFull(f"queued tokens limit {self.max_queued_tokens} exceeded")
+            self.queue.append(req)
+            self.queued_tokens += len(req.prompt_ids)
+            self.cond.notify()
+
+        return req.future
+
+    def stats(self):
+        with self.cond:
+            return {"active": len(self.active), "queued": len(self.queue), "queued_tokens": self.queued_tokens}
+
+    # ======================= LOOP =======================
+    def _loop(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.active:
+                    self.cond.wait()
+
+                admitted = []
+                while self.queue and len(self.active) + len(admitted) < self.max_batch_size:
+                    req = self.queue.popleft()
+                    self.queued_tokens -= len(req.prompt_ids)
+                    admitted.append(req)
+
+                # Решение принимается в потоке цикла: батч не может начаться, пока идёт speculative
+                solo = None
+                if self.speculative is not None and len(admitted) == 1 and not self.active and not self.queue \
+                        and admitted[0].speculative:
+                    solo = admitted.pop()
+
+            if solo is not None:
+                try:
+                    self._speculate(solo)
+                except Exception as e:
+                    self._fail([solo], e)
+
+            for req in admitted:
+                try:
+                    self._prefill(req)
+                except Exception as e:
+                    self._fail([req], e)
+
+            if self.active:
+                try:
+                    self._decode_step()
+                except Exception as e:
+                    self._fail(self.active, e)
+                    self.active, self.layers, self.mask = [], None, None
+
+    def _fail(self, requests, error):
+        for req in requests:
+            if req.streamer is not None:
+                req.streamer.end()
+            if not req.future.done():
+                req.future.set_exception(error)
+
+    def _is_finished(self, req):
+        return req.generated[-1] in self.eos_token_ids or len(req.generated) >= req.max_new_tokens \
+            or (req.cancel is not None and req.cancel.is_set())
+
+    def _emit(self, req, token):
+        req.generated.append(token)
+        if req.streamer is not None:
+            req.streamer.put(torch.tensor([token]))
+
+    def _finish(self, req, layers=None):
+        if req.streamer is not None:
+            req.streamer.end()
+        cache = build_cache(layers) if req.want_cache and layers is not None else None
+        req.future.set_result({"sequence": req.prompt_ids + req.generated, "cache": cache})
+
+    # ======================= SPECULATIVE =======================
+    def _speculate(self, req):
+        result = self.speculative.generate(
+            req.prompt_ids,
+            req.max_new_tokens,
+            past=req.past,
+            streamer=req.streamer,
+            cancel=req.cancel
+        )
+        req.past = None
+        req.future.set_result({"sequence": result["sequence"], "cache": result["cache"] if req.want_cache else None})
+
+    # ======================= PREFILL =======================
+    def _prefill(self, req):
+        input_ids = torch.tensor([req.prompt_ids], device=self.device)
+        n_past = req.past.get_seq_length() if req.past is not None else 0
+
+        with torch.no_grad():
+            out = self.model(input_ids=input_ids[:, n_past:], past_key_values=req.past, use_cache=True)
+        req.past = None
+
+        if req.streamer is not None:
+            req.streamer.put(input_ids[0].cpu())
+        self._emit(req, int(out.logits[0, -1].argmax()))
+
+        layers = [(k, v) for k, v in cache_layers(out.past_key_values)]
+        if self._is_finished(req):
+            self._finish(req, layers)
+            return
+
+        self._join(req, layers)
+
+    def _join(self, req, layers):
+        """Добавляет последовательность в батч, выравнивая длины паддингом слева."""
+        length = layers[0][0].shape[2]
+        mask = torch.ones((1, length), dtype=torch.long, device=self.device)
+
+        if not self.active:
+            self.active = [req]
+            self.layers = [[k, v] for k, v in layers]
+            self.mask = mask
+            return
+
+        total = self.mask.shape[1]
+        if length < total:
+            layers = [(F.pad(k, (0, 0, total - length, 0)), F.pad(v, (0, 0, total - length, 0))) for k, v in layers]
+            mask = F.pad(mask, (total - length, 0))
+        elif length > total:
+            self.layers = [[F.pad(k, (0, 0, length - total, 0)), F.pad(v, (0, 0, length - total, 0))]
+                           for k, v in self.layers]
+            self.mask = F.pad(self.mask, (length - total, 0))
+
+        self.layers = [[torch.cat([bk, k]), torch.cat([bv, v])] for (bk, bv), (k, v) in zip(self.layers, layers)]
+        self.mask = torch.cat([self.mask, mask])
+        self.active.append(req)
+
+    # ======================= DECODE =======================
+    def _decode_step(self):
+        input_ids = torch.tensor([[r.generated[-1]] for r in self.active], device=self.device)
+        position_ids = torch.tensor(
+            [[len(r.prompt_ids) + len(r.generated) - 1] for r in self.active], device=self.device
+        )
+        mask = torch.cat([self.mask, torch.ones((len(self.active), 1), dtype=torch.long, device=self.device)], dim=1)
+
+        with torch.no_grad():
+            out = self.model(
+                input_ids=input_ids,
+                attention_mask=mask,
+                position_ids=position_ids,
+                past_key_values=build_cache(self.layers),
+                use_cache=True
+            )
+
+        self.layers = [[k, v] for k, v in cache_layers(out.past_key_values)]
+        self.mask = mask
+
+        next_tokens = out.logits[:, -1].argmax(dim=-1).tolist()
+        keep = []
+        for i, (req, token) in enumerate(zip(self.active, next_tokens)):
+            self._emit(req, token)
+            if not self._is_finished(req):
+                keep.append(i)
+                continue
+
+            row_layers = None
+            if req.want_cache:
+                start = int((self.mask[i] == 0).sum())
+                row_layers = [(k[i:i + 1, :, start:], v[i:i + 1, :, start:]) for k, v in self.layers]
+            self._finish(req, row_layers)
+
+        if len(keep) == len(self.active):
+            return
+
+        self.active = [self.active[i] for i in keep]
+        if not keep:
+            self.layers, self.mask = None, None
+            return
+
+        index = torch.tensor(keep, device=self.device)
+        self.layers = [[k.index_select(0, index), v.index_select(0, index)] for k, v in self.layers]
+        self.mask = self.mask.index_select(0, index)
+
+        # Столбцы, где у всех оставшихся последовательностей паддинг, больше не нужны
+        start = int((self.mask.sum(dim=0) == 0).long().cumprod(0).sum())
+        if start:
+            self.layers = [[k[:, :, start:], v[:, :, start:]] for k, v in self.layers]
+            self.mask = self.mask[:, start:]
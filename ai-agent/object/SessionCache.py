@@ -0,0 +1,108 @@
+import hashlib
+import json
+from collections import OrderedDict
+from threading import Lock
+
+
+def history_hash(history) -> str:
+    """Хэш истории чата [{"role", "content"}, ...] — ключ префикса сессии."""
+    data = json.dumps([[m.get("role"), m.get("content")] for m in history], ensure_ascii=False)
+    return hashlib.md5(data.encode("utf-8")).hexdigest()
+
+
+def cache_layers(cache):
+    """Тензоры past_key_values (DynamicCache) по слоям: [(keys, values), ...]."""
+    layers = getattr(cache, "layers", None)
+    if layers is not None:
+        return [(layer.keys, layer.values) for layer in layers if layer.keys is not None]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+def cache_nbytes(cache) -> int:
+    """Размер past_key_values (DynamicCache) в байтах."""
+    return sum(t.numel() * t.element_size() for kv in cache_layers(cache) for t in kv)
+
+
+def common_prefix_len(a, b) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+# ======================= SESSION KV-CACHE =======================
+class SessionCache:
+    """
+    LRU-хранилище past_key_values по conversation_id.
+    Запись валидна, только пока история чата начинается с того же префикса,
+    по которому она была сохранена; иначе — полный prefill.
+    """
+
+    def __init__(self, max_bytes=2 * 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # conversation_id -> entry
+        self.total_bytes = 0
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # ======================= GET =======================
+    def pop(self, conversation_id, history):
+        """
+        Забирает запись сессии (на время генерации она принадлежит одному запросу).
+        Возвращает {"token_ids", "cache"} или None, если префикс истории не совпал.
+        """
+        with self.lock:
+            entry = self.entries.pop(conversation_id, None)
+            if entry is not None:
+                self.total_bytes -= entry["nbytes"]
+
+            if entry is None or len(history) < entry["history_len"] \
+                    or history_hash(history[:entry["history_len"]]) != entry["history_hash"]:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return entry
+
+    # ======================= PUT =======================
+    def put(self, conversation_id, history, token_ids, cache):
+        nbytes = cache_nbytes(cache)
+        if nbytes > self.max_bytes:
+            return
+
+        entry = {
+            "history_len": len(history),
+            "history_hash": history_hash(history),
+            "token_ids": token_ids,
+            "cache": cache,
+            "nbytes": nbytes,
+        }
+
+        with self.lock:
+            old = self.entries.pop(conversation_id, None)
+            if old is not None:
+                self.total_bytes -= old["nbytes"]
+
+            self.entries[conversation_id] = entry
+            self.total_bytes += nbytes
+
+            # Вытесняем самые давние сессии
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted["nbytes"]
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "sessions": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
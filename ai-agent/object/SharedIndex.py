@@ -0,0 +1,126 @@
+import json
+import multiprocessing as mp
+import shutil
+from pathlib import Path
+from threading import Lock
+
+from object.Placement import portable_error
+
+# Сколько последних снимков хранится: воркер, ещё не подключивший предыдущий, не должен его потерять
+SNAPSHOTS_KEEP = 2
+# Сколько записей (версия, source) хранит журнал изменений снимка
+CHANGES_KEEP = 1024
+
+
+# ======================= INDEX WRITER =======================
+class IndexWriter:
+    """
+    Единственный писатель индекса при multi-process serving (родительский процесс serve.py).
+    Воркеры присылают запросы в очередь jobs; писатель выполняет их по одному
+    (apply(*args) -> (result, изменённые source)) и, если индекс изменился, публикует снимок root/v{N}
+    и увеличивает version. Фоновая индексация публикует сама (publish). Воркеры подключают снимок
+    только для чтения (IndexClient.refresh): через mmap общие только массивы (SearchSystem.load_shared),
+    payloads и token_ids каждый воркер распаковывает из data.pkl на каждой публикации.
+    Очереди создаются до fork воркеров и наследуются ими.
+    """
+
+    def __init__(self, search, root, workers, apply):
+        ctx = mp.get_context("fork")
+        self.search = search
+        self.root = Path(root)
+        self.apply = apply
+        self.jobs = ctx.Queue()
+        self.results = [ctx.Queue() for _ in range(workers)]
+        self.version = ctx.Value("i", 0)
+        self.changes = []
+
+        shutil.rmtree(self.root, ignore_errors=True)
+        self.root.mkdir(parents=True)
+        self._write(0)
+        # Массивы самого писателя тоже из снимка: после fork их страницы общие с воркерами
+        search.load_shared(self.root / "v0")
+
+    def _write(self, version):
+        path = self.root / f"v{version}"
+        self.search.save_shared(path)
+        with open(path / "changes.json", "w", encoding="utf-8") as f:
+            json.dump(self.changes, f, ensure_ascii=False)
+
+    def publish(self, sources=()):
+        version = self.version.value + 1
+        self.changes = (self.changes + [[version, s] for s in sources])[-CHANGES_KEEP:]
+        self._write(version)
+        self.version.value = version
+
+        for old in range(version - SNAPSHOTS_KEEP, -1, -1):
+            shutil.rmtree(self.root / f"v{old}", ignore_errors=True)
+
+    def serve(self):
+        """Цикл писателя: до None в очереди jobs."""
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+
+            worker, args = job
+            try:
+                result, sources = self.apply(*args)
+                if sources:
+                    self.publish(sources)
+                self.results[worker].put((True, result))
+            except Exception as e:
+                self.results[worker].put((False, portable_error(e)))
+
+    def stop(self):
+        self.jobs.put(None)
+
+    def client(self, worker):
+        return IndexClient(self, worker)
+
+
+# ======================= INDEX CLIENT =======================
+class IndexClient:
+    """Сторона воркера: изменения индекса уходят писателю, новые снимки подключаются через refresh."""
+
+    def __init__(self, writer, worker):
+        self.worker = worker
+        self.root = writer.root
+        self.jobs = writer.jobs
+        self.results = writer.results[worker]
+        self.version = writer.version
+        self.loaded = writer.version.value
+        self.call_lock = Lock()
+        self.refresh_lock = Lock()
+
+    def call(self, *args):
+        # Ответы писателя приходят в общую очередь воркера, поэтому запросы — по одному
+        with self.call_lock:
+            self.jobs.put((self.worker, args))
+            ok, result = self.results.get()
+        if not ok:
+            raise result
+        return result
+
+    def stale(self):
+        return self.version.value != self.loaded
+
+    def refresh(self, search):
+        """Подключает последний опубликованный снимок; возвращает source, изменённые с прошлого."""
+        with self.refresh_lock:
+            while True:
+                version = self.version.value
+                if version == self.loaded:
+                    return []
+                path = self.root / f"v{version}"
+                try:
+                    search.load_shared(path)
+                    with open(path / "changes.json", encoding="utf-8") as f:
+                        changes = json.load(f)
+                    break
+                except FileNotFoundError:
+                    # Писатель успел опубликовать ещё два снимка — берём новый
+                    continue
+
+            sources = sorted({s for v, s in changes if v > self.loaded})
+            self.loaded = version
+            return sources
@@ -0,0 +1,168 @@
+import time
+from threading import Lock
+
+import torch
+
+
+# ======================= SPECULATIVE DECODING =======================
+class SpeculativeDecoder:
+    """
+    Greedy speculative decoding для LLM.
+    mode="prompt_lookup" — черновик берётся из промпта: ищем последний n-грам
+    сгенерированного текста в промпте (контекст документов) и предлагаем продолжение.
+    mode="draft" — черновик генерирует маленькая модель того же семейства (общий словарь).
+
+    Основная модель проверяет весь черновик одним forward; принимается совпавший
+    префикс + один собственный токен, поэтому ответ совпадает с обычным greedy.
+    """
+
+    def __init__(self, model, eos_token_id, device="cpu", mode="prompt_lookup", draft_model=None,
+                 num_draft_tokens=8, max_ngram_size=3):
+        self.model = model
+        self.draft_model = draft_model
+        self.device = device
+        self.mode = mode
+        self.eos_token_ids = set(eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id])
+        self.num_draft_tokens = num_draft_tokens
+        self.max_ngram_size = max_ngram_size
+
+        if mode == "draft" and draft_model is None:
+            raise ValueError("mode='draft' требует draft_model")
+
+        self.lock = Lock()
+        self.totals = {"requests": 0, "drafted": 0, "accepted": 0, "new_tokens": 0, "seconds": 0.0}
+
+    # ======================= DRAFT =======================
+    def _draft_prompt_lookup(self, seq):
+        for n in range(min(self.max_ngram_size, len(seq) - 1), 0, -1):
+            ngram = seq[-n:]
+            # Самое позднее вхождение n-грама до текущей позиции
+            for start in range(len(seq) - n - 1, -1, -1):
+                if seq[start:start + n] == ngram:
+                    follow = seq[start + n:start + n + self.num_draft_tokens]
+                    if follow:
+                        return follow
+        return []
+
+    def _draft_model(self, seq, state):
+        cache = state.get("cache")
+        fed = cache.get_seq_length() if cache is not None else 0
+
+        draft = []
+        tokens = seq[fed:]
+        with torch.no_grad():
+            for _ in range(self.num_draft_tokens):
+                out = self.draft_model(
+                    input_ids=torch.tensor([tokens], device=self.device),
+                    past_key_values=cache,
+                    use_cache=True
+                )
+                cache = out.past_key_values
+                token = int(out.logits[0, -1].argmax())
+                draft.append(token)
+                if token in self.eos_token_ids:
+                    break
+                tokens = [token]
+
+        state["cache"] = cache
+        return draft
+
+    # ======================= GENERATE =======================
+    def generate(self, prompt_ids, max_new_tokens=256, past=None, streamer=None, cancel=None):
+        """
+        Возвращает {"sequence", "cache", "stats"}; cache покрывает sequence без последнего токена,
+        как past_key_values у model.generate. cancel — threading.Event, останавливает генерацию.
+        """
+        start = time.time()
+        prompt_ids = list(prompt_ids)
+        n_past = past.get_seq_length() if past is not None else 0
+
+        with torch.no_grad():
+            out = self.model(
+                input_ids=torch.tensor([prompt_ids[n_past:]], device=self.device),
+                past_key_values=past,
+                use_cache=True
+            )
+        cache = out.past_key_values
+
+        if streamer is not None:
+            streamer.put(torch.tensor(prompt_ids))
+
+        generated = []
+        drafted = accepted = 0
+        draft_state = {}
+
+        def emit(token):
+            generated.append(token)
+            if streamer is not None:
+                streamer.put(torch.tensor([token]))
+            return token in self.eos_token_ids or len(generated) >= max_new_tokens \
+                or (cancel is not None and cancel.is_set())
+
+        finished = emit(int(out.logits[0, -1].argmax()))
+
+        while not finished:
+            seq = prompt_ids + generated
+            if self.mode == "draft":
+                draft = self._draft_model(seq, draft_state)
+            else:
+                draft = self._draft_prompt_lookup(seq)
+            draft = draft[:max_new_tokens - len(generated)]
+
+            # Проверка черновика одним проходом основной модели
+            cache_len = cache.get_seq_length()
+            with torch.no_grad():
+                out = self.model(
+                    input_ids=torch.tensor([[generated[-1]] + draft], device=self.device),
+                    past_key_values=cache,
+                    use_cache=True
+                )
+            cache = out.past_key_values
+            predicted = out.logits[0].argmax(dim=-1).tolist()
+
+            n_ok = 0
+            while n_ok < len(draft) and predicted[n_ok] == draft[n_ok]:
+                n_ok += 1
+            drafted += len(draft)
+            accepted += n_ok
+
+            # В кэше остаются последний токен и принятая часть черновика
+            cache.crop(cache_len + 1 + n_ok)
+            if self.mode == "draft" and draft_state.get("cache") is not None:
+                draft_state["cache"].crop(min(draft_state["cache"].get_seq_length(), len(seq) + n_ok))
+
+            for token in draft[:n_ok] + [predicted[n_ok]]:
+                finished = emit(token)
+                if finished:
+                    break
+
+        if streamer is not None:
+            streamer.end()
+
+        sequence = prompt_ids + generated
+        if cache.get_seq_length() > len(sequence) - 1:
+            cache.crop(len(sequence) - 1)
+
+        seconds = time.time() - start
+        stats = {
+            "drafted": drafted,
+            "accepted": accepted,
+            "acceptance_rate": accepted / drafted if drafted else 0.0,
+            "new_tokens": len(generated),
+            "tokens_per_sec": len(generated) / seconds if seconds > 0 else 0.0,
+        }
+        with self.lock:
+            self.totals["requests"] += 1
+            self.totals["drafted"] += drafted
+            self.totals["accepted"] += accepted
+            self.totals["new_tokens"] += len(generated)
+            self.totals["seconds"] += seconds
+
+        return {"sequence": sequence, "cache": cache, "stats": stats}
+
+    def stats(self):
+        with self.lock:
+            totals = dict(self.totals)
+        totals["acceptance_rate"] = totals["accepted"] / totals["drafted"] if totals["drafted"] else 0.0
+        totals["tokens_per_sec"] = totals["new_tokens"] / totals["seconds"] if totals["seconds"] else 0.0
+        return totals
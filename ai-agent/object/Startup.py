@@ -0,0 +1,62 @@
+import time
+import traceback
+from threading import Lock, Thread
+
+
+# ======================= STARTUP STATE =======================
+class StartupState:
+    """
+    Холодный старт gateway: стадии загрузки (индекс, модели, прогрев), их состояние
+    (pending / loading / ready / failed), время и ошибка. ready — все стадии готовы.
+    """
+
+    def __init__(self, stages):
+        self.stages = {name: {"state": "pending", "seconds": None, "error": None} for name in stages}
+        self.origin = time.monotonic()
+        self.lock = Lock()
+        self.started = False
+        self.ready = False
+
+    def start(self, target, background=True):
+        """
+        Запускает target один раз: в фоне (порт открывается сразу) или в текущем потоке.
+        Повторный вызов (lifespan воркера после fork, когда всё уже загружено) ничего не делает.
+        """
+        with self.lock:
+            if self.started:
+                return False
+            self.started = True
+
+        if background:
+            Thread(target=target, name="startup", daemon=True).start()
+        else:
+            target()
+        return True
+
+    def run(self, name, fn, *args):
+        """Выполняет стадию name; False — стадия упала (ошибка в stats и в логе)."""
+        with self.lock:
+            self.stages[name]["state"] = "loading"
+
+        start = time.monotonic()
+        try:
+            fn(*args)
+        except Exception as e:
+            traceback.print_exc()
+            with self.lock:
+                self.stages[name].update(state="failed", seconds=time.monotonic() - start,
+                                         error=f"{type(e).__name__}: {e}")
+            return False
+
+        with self.lock:
+            self.stages[name].update(state="ready", seconds=time.monotonic() - start)
+            self.ready = all(s["state"] == "ready" for s in self.stages.values())
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                "ready": self.ready,
+                "uptime": time.monotonic() - self.origin,
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+            }
@@ -1,4 +1,5 @@
 from typing import List, Dict
+from pathlib import Path
 import numpy as np
 import pickle
 import re
@@ -8,6 +9,9 @@ from nltk.stem import SnowballStemmer
 from rank_bm25 import BM25L
 from sentence_transformers import SentenceTransformer
 
+from object.Precision import apply_precision
+from object.TokenStore import TokenStore
+
 
 # ======================= НОРМАЛИЗАЦИЯ =======================
 def normalize_basic(text: str) -> str:
@@ -37,36 +41,133 @@ def bm25_tokenize(text: str) -> list:
     return tokens
 
 
-# ======================= Search System =======================
-class SearchSystem:
-    def __init__(self, model="./model/encoder", device="cpu"):
-        self.encoder = SentenceTransformer(model)
+def load_encoder(model="./model/encoder", device="cpu", precision="fp32"):
+    encoder = SentenceTransformer(model)
+    apply_precision(encoder, precision, device)
+    return encoder
+
+
+# ======================= BM25 SNAPSHOT =======================
+BM25_ARRAYS = ("indptr", "docs", "freqs", "idf", "doc_len")
+
+
+class MappedBM25L:
+    """
+    BM25L снимка save_shared: постинги слов (CSR: indptr, docs, freqs), idf и длины документов —
+    .npy, подключённые через mmap, поэтому воркеры не пересобирают BM25L из корпуса на каждой публикации.
+    get_scores считает то же, что rank_bm25.BM25L.get_scores, но только по документам со словом.
+    """
+
+    def __init__(self, arrays, vocab, k1, b, delta, avgdl):
+        self.arrays = arrays
+        self.vocab = vocab    # слово -> номер строки CSR
+        self.k1, self.b, self.delta, self.avgdl = k1, b, delta, avgdl
+        self.corpus_size = len(arrays["doc_len"])
+
+    @staticmethod
+    def from_bm25(bm25):
+        """Массивы из построенного BM25L (один раз — в процессе, который публикует снимок)."""
+        if isinstance(bm25, MappedBM25L):
+            return bm25
+
+        vocab = {word: i for i, word in enumerate(bm25.idf)}
+        postings = [[] for _ in vocab]
+        for doc, frequencies in enumerate(bm25.doc_freqs):
+            for word, freq in frequencies.items():
+                postings[vocab[word]].append((doc, freq))
+
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(p) for p in postings])
+        arrays = {
+            "indptr": indptr,
+            "docs": np.fromiter((d for p in postings for d, _ in p), dtype=np.int32, count=indptr[-1]),
+            "freqs": np.fromiter((f for p in postings for _, f in p), dtype=np.float64, count=indptr[-1]),
+            "idf": np.fromiter(bm25.idf.values(), dtype=np.float64, count=len(vocab)),
+            "doc_len": np.asarray(bm25.doc_len, dtype=np.float64),
+        }
+        return MappedBM25L(arrays, vocab, bm25.k1, bm25.b, bm25.delta, bm25.avgdl)
 
+    def save(self, path):
+        """Массивы — в path/bm25_*.npy; возвращает остальное для data.pkl."""
+        for name in BM25_ARRAYS:
+            np.save(path / f"bm25_{name}.npy", self.arrays[name])
+        return {"vocab": self.vocab, "params": (self.k1, self.b, self.delta, self.avgdl)}
+
+    @staticmethod
+    def load(path, state):
+        arrays = {name: np.load(path / f"bm25_{name}.npy", mmap_mode="r") for name in BM25_ARRAYS}
+        return MappedBM25L(arrays, state["vocab"], *state["params"])
+
+    def get_scores(self, query):
+        indptr, docs, freqs = self.arrays["indptr"], self.arrays["docs"], self.arrays["freqs"]
+        idf, doc_len = self.arrays["idf"], self.arrays["doc_len"]
+
+        score = np.zeros(self.corpus_size)
+        for q in query:
+            word = self.vocab.get(q)
+            if word is None:
+                continue
+            start, end = indptr[word], indptr[word + 1]
+            d, q_freq = docs[start:end], freqs[start:end]
+            ctd = q_freq / (1 - self.b + self.b * doc_len[d] / self.avgdl)
+            score[d] += idf[word] * q_freq * (self.k1 + 1) * (ctd + self.delta) / \
+                (self.k1 + ctd + self.delta)
+        return score
+
+
+# ======================= INDEX SNAPSHOT =======================
+class SearchIndex:
+    """
+    Снимок индекса одной версии: эмбеддинги, BM25, payloads и ids. После создания не меняется —
+    изменения SearchSystem собирают новый снимок и подменяют ссылку SearchSystem.index одним присваиванием.
+    Поиск читает ссылку один раз, поэтому все массивы запроса — из одной версии, даже если индекс
+    подменили посреди поиска.
+    """
+
+    def __init__(self, matrix=None, norm_matrix=None, payloads=None, ids=None, bm25_corpus=None, bm25=None):
         # Embeddings index
-        self.matrix = None
-        self.norm_matrix = None
+        self.matrix = matrix
+        self.norm_matrix = norm_matrix
 
         # BM25
-        self.bm25 = None
-        self.bm25_corpus = None
+        self.bm25 = bm25
+        self.bm25_corpus = bm25_corpus
 
         # Payloads
-        self.payloads = []
-        self.ids = []
+        self.payloads = payloads if payloads is not None else []
+        self.ids = ids if ids is not None else []
+
+
+# ======================= Search System =======================
+class SearchSystem:
+    def __init__(self, model="./model/encoder", device="cpu", precision="fp32", encoder=None):
+        # encoder — уже собранный load_encoder (например, в ModelWorker); нужен только его encode
+        self.encoder = encoder if encoder is not None else load_encoder(model, device, precision)
+
+        # Текущий снимок индекса (SearchIndex); меняется только подменой ссылки
+        self.index = SearchIndex()
+
+        # Токены чанков для reranker / NLI / LLM (payload["token_ids"])
+        self.token_store = TokenStore()
+        self.token_store.attach(self.index.payloads)
 
     # ======================= ADD CHUNKS =======================
     def add_chunks(self, chunks):
+        self._add_internal(**self.prepare_chunks(chunks))
+
+    def prepare_chunks(self, chunks, batch_size=32):
+        """Эмбеддинги и токены BM25 новых чанков; индекс не меняется (можно считать параллельно с поиском)."""
         raw_texts = [normalize_basic(c["text"]) for c in chunks]
         bm25_tokens = [bm25_tokenize(c["text"]) for c in chunks]
 
         # Embeddings
         vectors = (
             self.encoder.encode(
-                raw_texts, convert_to_numpy=True, normalize_embeddings=False
+                raw_texts, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=False
             ).astype(np.float32)
         )
 
-        self._add_internal(
+        return dict(
             ids=[c["chunkHash"] for c in chunks],
             vectors=vectors,
             payloads=[
@@ -80,127 +181,166 @@ class SearchSystem:
         )
 
     def _add_internal(self, ids, vectors, payloads):
-        if self.matrix is None:
-            self.matrix = vectors
-        else:
-            self.matrix = np.vstack([self.matrix, vectors])
+        index = self.index
+        matrix = vectors if index.matrix is None else np.vstack([index.matrix, vectors])
+        self.token_store.add(payloads)
 
-        self.ids.extend(ids)
-        self.payloads.extend(payloads)
+        # ! ПОСЛЕ нужно сделать build_index()
+        self.index = SearchIndex(matrix, None, index.payloads + payloads, index.ids + ids)
 
     # ======================= BUILD INDEX =======================
     def build_index(self, bm25_k1=1.5, bm25_b=0.1):
+        index = self.index
+
         # Embeddings
-        norms = np.linalg.norm(self.matrix, axis=1, keepdims=True)
-        self.norm_matrix = self.matrix / norms
+        norms = np.linalg.norm(index.matrix, axis=1, keepdims=True)
+        norm_matrix = index.matrix / norms
 
         # BM25
-        self.bm25_corpus = [p["tokens"] for p in self.payloads]
-        self.bm25 = BM25L(
-            self.bm25_corpus,
+        bm25_corpus = [p["tokens"] for p in index.payloads]
+        bm25 = BM25L(
+            bm25_corpus,
             k1=bm25_k1,     # степень влияния частоты слова (TF)
             b=bm25_b       # влияние длины документа
         )
 
+        self.index = SearchIndex(index.matrix, norm_matrix, index.payloads, index.ids, bm25_corpus, bm25)
+
+    # ======================= COPY-ON-WRITE =======================
+    def copy(self):
+        """
+        Копия для изменений в фоне, пока по этому индексу идёт поиск: encoder и снимок общие
+        (изменения копии собирают новый снимок), у копии свой token_store
+        (store поиска переключается на её payloads только в replace_with).
+        """
+        other = SearchSystem.__new__(SearchSystem)
+        other.__dict__.update(self.__dict__)
+        other.token_store = self.token_store.copy()
+        return other
+
+    def replace_with(self, other):
+        """Подменяет индекс снимком изменённой копии (после её build_index) — одной ссылкой."""
+        index = other.index
+        # Сначала токены: запросы, увидевшие новый снимок, находят id его чанков в store
+        self.token_store.attach(index.payloads)
+        self.index = index
+
     # ======================= REMOVE CHUNKS BY SOURCE =======================
     def remove_by_source(self, source_name: str):
-        keep_indices = [i for i, p in enumerate(self.payloads) if p.get("source") != source_name]
+        index = self.index
+        keep_indices = [i for i, p in enumerate(index.payloads) if p.get("source") != source_name]
 
         if not keep_indices:
-            self.matrix = None
-            self.norm_matrix = None
-            self.payloads = []
-            self.ids = []
-            self.bm25_corpus = []
-            self.bm25 = None
+            self.index = SearchIndex(bm25_corpus=[])
+            self.token_store.attach(self.index.payloads)
             return
 
         # фильтруем embeddings, payloads и ids
-        self.matrix = self.matrix[keep_indices]
-        self.payloads = [self.payloads[i] for i in keep_indices]
-        self.ids = [self.ids[i] for i in keep_indices]
+        payloads = [index.payloads[i] for i in keep_indices]
+        self.token_store.attach(payloads)
 
         # ! ПОСЛЕ нужно сделать build_index()
-        self.norm_matrix = None
-        self.bm25_corpus = []
-        self.bm25 = None
+        self.index = SearchIndex(index.matrix[keep_indices], None, payloads,
+                                 [index.ids[i] for i in keep_indices], [])
 
     # ======================= GET CONTEXT CHUNKS =======================
     def get_context_chunks(self, chunk_id: str, source: str, n: int = 1, include_self: bool = True) -> List[Dict]:
+        payloads = self.index.payloads
+
         # Находим все индексы чанков с заданным source
-        source_indices = [i for i, p in enumerate(self.payloads) if p.get("source") == source]
+        source_indices = [i for i, p in enumerate(payloads) if p.get("source") == source]
 
         # Находим индекс целевого чанка в пределах этого source
         try:
-            idx_in_source = next(i for i in source_indices if self.payloads[i]["chunkID"] == chunk_id)
+            idx_in_source = next(i for i in source_indices if payloads[i]["chunkID"] == chunk_id)
         except StopIteration:
             return []
 
         start = max(0, idx_in_source - n)
-        end = min(len(self.payloads), idx_in_source + n + 1)
+        end = min(len(payloads), idx_in_source + n + 1)
 
         context = []
         for i in range(start, end):
             if not include_self and i == idx_in_source:
                 continue
             # Берем только чанки того же source
-            if self.payloads[i]["source"] == source:
-                context.append(self.payloads[i])
+            if payloads[i]["source"] == source:
+                context.append(payloads[i])
 
         return context
 
     # ======================= CHECK IF FILE EXISTS =======================
     def file_exists(self, source_name: str) -> bool:
-        return any(p.get("source") == source_name for p in self.payloads)
+        return any(p.get("source") == source_name for p in self.index.payloads)
 
-    # ======================= SEARCH: EMBEDDINGS =======================
-    def search_embeddings(self, query, top_k=5):
-        q = self.encoder.encode(
+    # ======================= QUERY EMBEDDING =======================
+    def encode_query(self, query):
+        return self.encoder.encode(
             [normalize_basic(query)],
             convert_to_numpy=True,
             normalize_embeddings=True
         )[0]
 
-        scores = self.norm_matrix @ q
+    # ======================= SEARCH: EMBEDDINGS =======================
+    def search_embeddings(self, query, top_k=5):
+        index = self.index
+        q = self.encode_query(query)
+
+        scores = index.norm_matrix @ q
         idx = np.argsort(-scores)[:top_k]
 
         return [
-            {"chunkHash": self.ids[i], "score": float(scores[i]), "payload": self.payloads[i]}
+            {"chunkHash": index.ids[i], "score": float(scores[i]), "payload": index.payloads[i]}
             for i in idx
         ]
 
     # ======================= SEARCH: BM25 =======================
     def search_bm25(self, query, top_k=5):
+        index = self.index
         tokens = bm25_tokenize(query)
-        scores = self.bm25.get_scores(tokens)
+        scores = index.bm25.get_scores(tokens)
 
         # --- нормализация критически важна ---
         scores = (scores - scores.min()) / (scores.max() - scores.min() + 1e-6)
 
         idx = np.argsort(-scores)[:top_k]
         return [
-            {"chunkHash": self.ids[i], "score": float(scores[i]), "payload": self.payloads[i]}
+            {"chunkHash": index.ids[i], "score": float(scores[i]), "payload": index.payloads[i]}
             for i in idx
         ]
 
+    # ======================= BM25 SCORES =======================
+    def bm25_scores(self, query, index=None):
+        """
+        Нормализованные BM25 score всех чанков; не зависит от encode_query и считается параллельно.
+        Возвращает (снимок, score): search_hybrid берёт score, только если поиск идёт по тому же снимку.
+        """
+        if index is None:
+            index = self.index
+        tokens = bm25_tokenize(query)
+        sim_bm25 = index.bm25.get_scores(tokens)
+        return index, (sim_bm25 - sim_bm25.min()) / (sim_bm25.max() - sim_bm25.min() + 1e-6)
+
     # ======================= HYBRID =======================
-    def search_hybrid(self, query, top_k=5, alpha=0.5):
+    def search_hybrid(self, query, top_k=5, alpha=0.5, q_emb=None, bm25_scores=None):
         """
         alpha = 0.5 → 50% embedding + 50% BM25 (нормализованный)
+        q_emb — уже посчитанный encode_query(query), чтобы не кодировать вопрос повторно
+        bm25_scores — уже посчитанный bm25_scores(query)
         """
+        index = self.index
 
         # EMBEDDINGS
-        q_emb = self.encoder.encode(
-            [normalize_basic(query)],
-            convert_to_numpy=True,
-            normalize_embeddings=True
-        )[0]
-        sim_emb = self.norm_matrix @ q_emb
+        if q_emb is None:
+            q_emb = self.encode_query(query)
+        sim_emb = index.norm_matrix @ q_emb
 
         # BM25
-        tokens = bm25_tokenize(query)
-        sim_bm25 = self.bm25.get_scores(tokens)
-        sim_bm25 = (sim_bm25 - sim_bm25.min()) / (sim_bm25.max() - sim_bm25.min() + 1e-6)
+        # Индекс мог быть подменён между подсчётами — тогда BM25 пересчитывается по текущему снимку
+        if bm25_scores is not None and bm25_scores[0] is index:
+            sim_bm25 = bm25_scores[1]
+        else:
+            _, sim_bm25 = self.bm25_scores(query, index)
 
         # Гибрид
         score = alpha * sim_emb + (1 - alpha) * sim_bm25
@@ -210,21 +350,22 @@ class SearchSystem:
 
         return [
             {
-                "chunkHash": self.ids[i],
+                "chunkHash": index.ids[i],
                 "score": float(score[i]),
-                "payload": self.payloads[i]
+                "payload": index.payloads[i]
             }
             for i in idx
         ]
 
     # ======================= SAVE / LOAD =======================
     def save(self, path):
+        index = self.index
         data = {
-            "matrix": self.matrix,
-            "norm_matrix": self.norm_matrix,
-            "payloads": self.payloads,
-            "ids": self.ids,
-            "bm25_corpus": self.bm25_corpus,
+            "matrix": index.matrix,
+            "norm_matrix": index.norm_matrix,
+            "payloads": index.payloads,
+            "ids": index.ids,
+            "bm25_corpus": index.bm25_corpus,
         }
         with open(path, "wb") as f:
             pickle.dump(data, f)
@@ -233,10 +374,54 @@ class SearchSystem:
         with open(path, "rb") as f:
             data = pickle.load(f)
 
-        self.matrix = data["matrix"]
-        self.norm_matrix = data["norm_matrix"]
-        self.payloads = data["payloads"]
-        self.ids = data["ids"]
+        self.token_store.attach(data["payloads"])
+        self.index = SearchIndex(
+            data["matrix"], data["norm_matrix"], data["payloads"], data["ids"],
+            data["bm25_corpus"], BM25L(data["bm25_corpus"])
+        )
 
-        self.bm25_corpus = data["bm25_corpus"]
-        self.bm25 = BM25L(self.bm25_corpus)
+    # ======================= SHARED SNAPSHOT =======================
+    def save_shared(self, path):
+        """
+        Снимок для multi-process serving: массивы (эмбеддинги, статистика BM25) — в .npy (для mmap),
+        payloads (с token_ids), ids и корпус BM25 — в data.pkl.
+        """
+        index = self.index
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for name in ("matrix", "norm_matrix"):
+            if getattr(index, name) is not None:
+                np.save(path / f"{name}.npy", getattr(index, name))
+
+        data = {
+            "payloads": index.payloads,
+            "ids": index.ids,
+            "bm25_corpus": index.bm25_corpus,
+            # Статистика BM25 считается здесь, читающие процессы только подключают массивы
+            "bm25": MappedBM25L.from_bm25(index.bm25).save(path) if index.bm25 is not None else None,
+        }
+        with open(path / "data.pkl", "wb") as f:
+            pickle.dump(data, f)
+
+    def load_shared(self, path):
+        """
+        Подключает снимок save_shared: массивы только для чтения через mmap — страницы общие
+        для всех процессов, читающих снимок. Общие только матрицы эмбеддингов и массивы BM25:
+        data.pkl (payloads с token_ids, ids, корпус BM25) каждый процесс распаковывает сам
+        на каждой публикации, и эти объекты у каждого свои. Снимок собирается заранее
+        и подменяется одной ссылкой (SearchSystem.index).
+        """
+        path = Path(path)
+        with open(path / "data.pkl", "rb") as f:
+            data = pickle.load(f)
+
+        arrays = {
+            name: np.load(path / f"{name}.npy", mmap_mode="r") if (path / f"{name}.npy").exists() else None
+            for name in ("matrix", "norm_matrix")
+        }
+        bm25 = MappedBM25L.load(path, data["bm25"]) if data["bm25"] is not None else None
+        self.token_store.attach(data["payloads"])
+
+        self.index = SearchIndex(
+            arrays["matrix"], arrays["norm_matrix"], data["payloads"], data["ids"], data["bm25_corpus"], bm25
+        )
@@ -0,0 +1,144 @@
+import re
+from threading import Lock
+
+import numpy as np
+
+
+# Граница после перевода строки перед непробельным символом — всегда граница пре-токенизации
+# byte-level BPE, поэтому такие куски промпта можно токенизировать независимо и склеивать.
+# Режем по каждой строке, а не только по пустым: заголовок "Файл: ..." в контексте — отдельный кусок,
+# и первый чанк после него совпадает с сохранённым
+PROMPT_PIECE_SPLIT = re.compile(r"(?<=\n)(?=\S)")
+
+# Проверочные тексты на случай пустого индекса: кириллица, числа, пунктуация, строки таблиц
+SAMPLE_TEXTS = (
+    "Договор № 15-А заключён 01.02.2024 между сторонами.",
+    "Стоимость услуг:\t120 000 руб.\tНДС не облагается",
+    "(см. раздел 3) Ответственность сторон — Liability, art. 7",
+)
+
+
+def prompt_pieces(text):
+    return [p for p in PROMPT_PIECE_SPLIT.split(text) if p]
+
+
+# ======================= TOKEN STORE =======================
+class TokenStore:
+    """
+    Токены чанков для моделей, которые работают с текстом чанков на запросе
+    (reranker, NLI, LLM). Каждый токенизатор регистрируется под своим name.
+    Для каждого зарегистрированного токенизатора id хранятся в payload["token_ids"][name]
+    и сохраняются вместе с индексом SearchSystem; в памяти — словарь кусок текста -> np.int32 ids.
+
+    units(text) задаёт, на какие куски разбит текст чанка (для LLM — в том виде, в каком
+    он стоит в промпте). Модель собирает вход склейкой id кусков; на промах кусок токенизируется.
+    """
+
+    def __init__(self):
+        self.tokenizers = {}   # name -> (tokenizer, units)
+        self.index = {}        # name -> {кусок: ids}
+        self.payloads = []
+        self.lock = Lock()
+        self.counters = {}     # name -> {"hits", "misses"}
+
+    @staticmethod
+    def key(role, tokenizer):
+        # Путь к модели в ключе: id от другого токенизатора из сохранённого индекса не подхватятся
+        return f"{role}:{tokenizer.name_or_path}"
+
+    # ======================= REGISTER =======================
+    def register(self, name, tokenizer, units=None):
+        with self.lock:
+            if name in self.tokenizers:
+                return name
+            self.tokenizers[name] = (tokenizer, units or (lambda text: [text]))
+            self.counters[name] = {"hits": 0, "misses": 0}
+            self.index[name] = self._build_index(name, self.payloads)
+        return name
+
+    def attach(self, payloads):
+        """Новый список payloads SearchSystem (load, remove_by_source): индексы строятся заново."""
+        with self.lock:
+            self.payloads = payloads
+            self.index = {name: self._build_index(name, payloads) for name in self.tokenizers}
+
+    def copy(self):
+        """
+        Отдельный store для копии индекса (SearchSystem.copy): те же токенизаторы, свои индексы,
+        так что attach/add копии не трогают store, по которому идут запросы.
+        """
+        other = TokenStore()
+        with self.lock:
+            other.tokenizers = dict(self.tokenizers)
+            other.index = {name: dict(index) for name, index in self.index.items()}
+            other.payloads = self.payloads
+            other.counters = {name: {"hits": 0, "misses": 0} for name in self.tokenizers}
+        return other
+
+    def add(self, payloads):
+        """Новые чанки (add_chunks): токенизация одним батчем на каждый токенизатор."""
+        with self.lock:
+            for name in self.tokenizers:
+                self.index[name].update(self._build_index(name, payloads))
+
+    def _tokenize(self, name, pieces):
+        tokenizer, _ = self.tokenizers[name]
+        if not pieces:
+            return []
+        return [np.asarray(ids, dtype=np.int32) for ids in tokenizer(pieces, add_special_tokens=False)["input_ids"]]
+
+    def _build_index(self, name, payloads):
+        _, units = self.tokenizers[name]
+        pieces = [units(p["text"]) for p in payloads]
+
+        # Payload без id этого токенизатора (старый индекс) или с другим разбиением — токенизируем
+        missing = [
+            i for i, p in enumerate(payloads)
+            if len(p.get("token_ids", {}).get(name, ())) != len(pieces[i])
+        ]
+        fresh = iter(self._tokenize(name, [piece for i in missing for piece in pieces[i]]))
+        for i in missing:
+            payloads[i].setdefault("token_ids", {})[name] = [next(fresh) for _ in pieces[i]]
+
+        index = {}
+        for p, ps in zip(payloads, pieces):
+            index.update(zip(ps, p["token_ids"][name]))
+        return index
+
+    # ======================= ENCODE =======================
+    def encode(self, name, pieces):
+        """Склейка id кусков; куски, которых нет в индексе, токенизируются одним батчем."""
+        index = self.index[name]
+        found = [index.get(p) for p in pieces]
+        missing = [p for p, ids in zip(pieces, found) if ids is None]
+        if missing:
+            fresh = iter(self._tokenize(name, missing))
+            found = [ids if ids is not None else next(fresh) for ids in found]
+
+        with self.lock:
+            counters = self.counters[name]
+            counters["hits"] += len(pieces) - len(missing)
+            counters["misses"] += len(missing)
+
+        return np.concatenate(found) if found else np.zeros(0, dtype=np.int32)
+
+    def verify(self, name, samples, join):
+        """
+        Склейка id должна совпадать с токенизацией склеенного текста:
+        samples — списки кусков, join(pieces) — текст, который токенизировала бы модель.
+        """
+        tokenizer, _ = self.tokenizers[name]
+        return all(
+            self.encode(name, pieces).tolist() == tokenizer(join(pieces), add_special_tokens=False)["input_ids"]
+            for pieces in samples
+        )
+
+    def sample_texts(self, n=4):
+        return [p["text"] for p in self.payloads[:n]] + list(SAMPLE_TEXTS)
+
+    def stats(self):
+        with self.lock:
+            return {
+                name: {**self.counters[name], "entries": len(self.index[name])}
+                for name in self.tokenizers
+            }
@@ -0,0 +1,89 @@
+import gc
+import multiprocessing as mp
+import os
+import signal
+from threading import Thread
+
+import uvicorn
+
+import gateway
+from object.Placement import ModelWorker, pin
+from object.SharedIndex import IndexWriter
+
+# =========================== НАСТРОЙКИ ===========================
+# Multi-process serving: модели и индекс загружаются один раз (gateway.load_models) в родительском
+# процессе, HTTP-воркеры создаются fork и делят с ним память весов (copy-on-write) и массивов
+# индекса (mmap снимка: матрицы эмбеддингов и BM25; payloads и токены чанков у каждого воркера свои,
+# из data.pkl снимка). Очередь индексации и индекс — только в родителе (IndexWriter), воркеры
+# передают ему задачи и читают опубликованные снимки.
+# Запуск: python serve.py (вместо uvicorn gateway:app)
+HOST = "0.0.0.0"
+PORT = 3001
+WORKERS = len(os.sched_getaffinity(0))
+# Потоков torch на воркер; воркер i занимает ядра [i * THREADS_PER_WORKER, (i + 1) * THREADS_PER_WORKER)
+THREADS_PER_WORKER = 1
+SNAPSHOT_DIR = "./SearchStartData/shared"
+
+
+def worker_cores(i):
+    cpus = sorted(os.sched_getaffinity(0))
+    return [cpus[(i * THREADS_PER_WORKER + j) % len(cpus)] for j in range(THREADS_PER_WORKER)]
+
+
+def run_worker(i, writer, config, sock):
+    pin(cores=worker_cores(i), threads=THREADS_PER_WORKER)
+    gateway.init_worker(writer.client(i))
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+# ==============================
+#           MAIN
+# ==============================
+def main():
+    # Всё загружается и прогревается до fork: воркеры сразу готовы
+    gateway.STARTUP.start(gateway.load_models, background=False)
+    if not gateway.STARTUP.ready:
+        raise RuntimeError(f"serve.py: загрузка не удалась: {gateway.STARTUP.stats()['stages']}")
+
+    # Очереди ModelWorker привязаны к одному процессу и после fork не работают
+    if any(isinstance(m, ModelWorker) for m in (gateway.DB_SEARCH.encoder, gateway.RERANKER, gateway.LR)):
+        raise RuntimeError("serve.py: модели из MODEL_PLACEMENT в ModelWorker несовместимы с fork-воркерами")
+
+    writer = IndexWriter(gateway.DB_SEARCH, SNAPSHOT_DIR, WORKERS, gateway.apply_writer_call)
+    gateway.INDEX_PUBLISHER = writer
+
+    config = uvicorn.Config(gateway.app, host=HOST, port=PORT)
+    sock = config.bind_socket()
+
+    # Объекты, загруженные до fork, больше не обходит gc: иначе он трогает их заголовки
+    # и страницы памяти копируются в каждый воркер
+    gc.collect()
+    gc.freeze()
+
+    ctx = mp.get_context("fork")
+    workers = [
+        ctx.Process(target=run_worker, args=(i, writer, config, sock), name=f"gateway-{i}")
+        for i in range(WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    print(f"Multi-process serving: {WORKERS} воркеров на {HOST}:{PORT}")
+
+    # Писатель запускается после fork: воркеры не наследуют его поток
+    Thread(target=writer.serve, name="index-writer", daemon=True).start()
+
+    def shutdown(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    for worker in workers:
+        worker.join()
+    writer.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -199,7 +199,9 @@ app.post('/api/files', authenticateToken, (req, res) => {
                 if (!aiResponse.ok) {
                     console.error('AI Agent upload failed:', await aiResponse.text())
                 } else {
-                    console.log('File successfully uploaded to AI Agent')
+                    // Индексация идёт в фоне: статус — GET /jobs/{job_id} AI Agent
+                    const job = await aiResponse.json()
+                    console.log(`File queued for indexing in AI Agent, job ${job.job_id}`)
                 }
             } catch (aiErr) {
                 console.error('Error uploading file to AI Agent:', aiErr)
@@ -356,7 +358,8 @@ app.post('/api/chat/send', authenticateToken, async (req, res) => {
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
           separate_conflicts: !!separate_conflicts,
-          chat: chatPayload
+          chat: chatPayload,
+          conversation_id: String(chat_id)
         }),
       })
 